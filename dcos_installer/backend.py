@@ -11,6 +11,7 @@ import botocore.exceptions
 import gen
 import gen.build_deploy.aws
 import gen.calc
+import pkgpanda.util
 import release
 import release.storage.aws
 import release.storage.local
@@ -337,6 +338,11 @@ def do_aws_cf_configure():
             'reproducible_path': package_filename,
             'local_path': 'artifacts/' + package_filename,
         })
+        digest_filename = pkgpanda.util.content_digest_filename(package_filename)
+        artifacts.append({
+            'reproducible_path': digest_filename,
+            'local_path': 'artifacts/' + digest_filename,
+        })
 
     # Upload all the artifacts to the config-id path and then print out what
     # the path that should be used is, as well as saving a local json file for
@@ -5,6 +5,7 @@ import os.path
 import yaml
 
 import gen
+from dcos_installer.constants import CONFIG_VALIDATION_WORKERS
 from gen.build_deploy.bash import onprem_source
 from gen.exceptions import ValidationError
 from pkgpanda.util import load_yaml, write_string, YamlParseError
@@ -117,7 +118,7 @@ class Config():
         sources, targets, _ = gen.get_dcosconfig_source_target_and_templates(user_arguments, [], extra_sources)
         targets = targets + extra_targets
 
-        resolver = gen.internals.resolve_configuration(sources, targets)
+        resolver = gen.internals.resolve_configuration(sources, targets, max_workers=CONFIG_VALIDATION_WORKERS)
         # TODO(cmaloney): kill this function and make the API return the structured
         # results api as was always intended rather than the flattened / lossy other
         # format. This will be an  API incompatible change. The messages format was
@@ -6,14 +6,24 @@ import sys
 import gen
 import gen.build_deploy.bash
 import pkgpanda
-from dcos_installer.constants import ARTIFACT_DIR, CLUSTER_PACKAGES_PATH, SERVE_DIR
+from dcos_installer.constants import (
+    ARTIFACT_DIR,
+    CLUSTER_PACKAGES_PATH,
+    DEPENDENCY_GRAPH_PATH,
+    PACKAGE_CACHE_DIR,
+    SERVE_DIR,
+)
 from pkgpanda.util import make_directory
 
 log = logging.getLogger(__name__)
 
 
 def onprem_generate(config):
-    return gen.generate(config.as_gen_format(), extra_sources=[gen.build_deploy.bash.onprem_source])
+    return gen.generate(
+        config.as_gen_format(),
+        extra_sources=[gen.build_deploy.bash.onprem_source],
+        dependency_graph_path=DEPENDENCY_GRAPH_PATH,
+        package_cache_dir=PACKAGE_CACHE_DIR)
 
 
 def make_serve_dir(gen_out):
@@ -24,6 +34,7 @@ def make_serve_dir(gen_out):
     cached_packages = sorted(
         i['filename'] for i in gen_out.cluster_packages.values() if i['filename'] not in gen_out.stable_artifacts
     )
+    cached_packages += [pkgpanda.util.content_digest_filename(filename) for filename in cached_packages]
     bootstrap_files = [
         "bootstrap/{}.bootstrap.tar.xz".format(gen_out.arguments['bootstrap_id']),
         "bootstrap/{}.active.json".format(gen_out.arguments['bootstrap_id'])
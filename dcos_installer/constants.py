@@ -5,7 +5,11 @@ IP_DETECT_PATH = GENCONF_DIR + '/ip-detect'
 CLUSTER_PACKAGES_PATH = GENCONF_DIR + '/cluster_packages.json'
 SERVE_DIR = GENCONF_DIR + '/serve'
 STATE_DIR = GENCONF_DIR + '/state'
+DEPENDENCY_GRAPH_PATH = STATE_DIR + '/config_dependency_graph.json'
+PACKAGE_CACHE_DIR = STATE_DIR + '/package_cache'
 BOOTSTRAP_DIR = SERVE_DIR + '/bootstrap'
 PACKAGE_LIST_DIR = SERVE_DIR + '/package_lists'
 ARTIFACT_DIR = 'artifacts'
 CHECK_RUNNER_CMD = '/opt/mesosphere/bin/dcos-check-runner check'
+# Threads used to calculate independent config arguments concurrently when validating a config.
+CONFIG_VALIDATION_WORKERS = 4
@@ -302,3 +302,4 @@ def create_fake_build_artifacts(tmpdir):
         ensure=True,
     )
     tmpdir.join('artifacts/packages/package/package--version.tar.xz').write('contents_of_package', ensure=True)
+    tmpdir.join('artifacts/packages/package/package--version.content_digest').write('digest_of_package')
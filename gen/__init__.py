@@ -19,6 +19,7 @@ import os.path
 import pprint
 import textwrap
 from copy import copy, deepcopy
+from functools import lru_cache
 from typing import List
 
 import yaml
@@ -42,8 +43,12 @@ from pkgpanda.util import (
     is_absolute_path,
     is_windows,
     json_prettyprint,
+    load_json,
     load_string,
+    sha1,
     split_by_token,
+    tracer,
+    write_content_digest,
     write_json,
     write_string,
     write_yaml,
@@ -235,8 +240,8 @@ def load_templates(template_dict):
 
             extra_filename = "gen_extra/" + template_name
             if os.path.exists(extra_filename):
-                result_list.append(gen.template.parse_str(
-                    load_string(extra_filename)))
+                result_list.append(gen.template.parse_cached(
+                    extra_filename, load_string(extra_filename)))
         result[name] = result_list
     return result
 
@@ -298,38 +303,54 @@ def write_to_non_taken(base_filename, json):
     return filename
 
 
-def do_gen_package(config, package_filename):
-    # Generate the specific dcos-config package.
+def do_gen_package(config, package_filename, cache_dir=None):
+    """Generate the specific dcos-config package.
+
+    If cache_dir is given, packages are cached there by the hash of their contents and a package
+    with the same contents as a cached one is linked or copied from the cache rather than built.
+    """
     # Version will be setup-{sha1 of contents}
-    with gen.util.pkgpanda_package_tmpdir() as tmpdir:
-        # Only contains package, root
-        assert config.keys() == {"package"}
-
-        # Write out the individual files
-        for file_info in config["package"]:
-            assert file_info.keys() <= {"path", "content", "permissions"}
-            if is_absolute_path(file_info['path']):
-                fileinfo_drive, fileinfo_path = os.path.splitdrive(file_info['path'])
-                path = tmpdir + fileinfo_path
-            else:
-                path = tmpdir + '/' + file_info['path']
-            try:
-                if os.path.dirname(path):
-                    os.makedirs(os.path.dirname(path), mode=0o755)
-            except FileExistsError:
-                pass
-
-            with open(path, 'w') as f:
-                f.write(file_info['content'] or '')
-
-            # the file has special mode defined, handle that.
-            if 'permissions' in file_info:
-                assert isinstance(file_info['permissions'], str)
-                os.chmod(path, int(file_info['permissions'], 8))
-            else:
-                os.chmod(path, 0o644)
+    if cache_dir is not None:
+        cached_filename = gen.util.package_cache_filename(cache_dir, config)
+        if os.path.exists(cached_filename):
+            log.info("Using cached package {} for {}".format(cached_filename, package_filename))
+            gen.util.link_or_copy(cached_filename, package_filename)
+            # Keep the package from being pruned, see gen.util.prune_package_cache().
+            os.utime(cached_filename)
+            return
+
+    # The package may be a link to a cached package which must not be overwritten in place.
+    if os.path.exists(package_filename) and os.stat(package_filename).st_nlink > 1:
+        os.remove(package_filename)
+
+    # Only contains package, root
+    assert config.keys() == {"package"}
+
+    # Collect the individual files, later files with the same path replace earlier ones.
+    files = dict()
+    for file_info in config["package"]:
+        assert file_info.keys() <= {"path", "content", "permissions"}
+        if is_absolute_path(file_info['path']):
+            fileinfo_drive, path = os.path.splitdrive(file_info['path'])
+        else:
+            path = file_info['path']
+
+        # the file has special mode defined, handle that.
+        if 'permissions' in file_info:
+            assert isinstance(file_info['permissions'], str)
+            mode = int(file_info['permissions'], 8)
+        else:
+            mode = 0o644
+
+        # Newlines are written the way a file opened in text mode would have them.
+        content = (file_info['content'] or '').replace('\n', os.linesep)
+        files[path.replace(os.sep, '/')] = (content.encode('utf-8'), mode)
+
+    gen.util.write_pkgpanda_package(files, package_filename)
 
-        gen.util.make_pkgpanda_package(tmpdir, package_filename)
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        gen.util.add_to_package_cache(package_filename, cached_filename)
 
 
 def render_late_content(content, late_values):
@@ -427,9 +448,14 @@ def validate_all_arguments_match_parameters(parameters, setters, arguments):
 def validate(
         arguments,
         extra_templates=list(),
-        extra_sources=list()):
+        extra_sources=list(),
+        max_workers=None):
+    """Return the status_dict of resolving the configuration for arguments.
+
+    If max_workers is more than one, independent arguments are calculated concurrently.
+    """
     sources, targets, _ = get_dcosconfig_source_target_and_templates(arguments, extra_templates, extra_sources)
-    return gen.internals.resolve_configuration(sources, targets).status_dict
+    return gen.internals.resolve_configuration(sources, targets, max_workers=max_workers).status_dict
 
 
 def user_arguments_to_source(user_arguments) -> gen.internals.Source:
@@ -454,6 +480,15 @@ def get_dcosconfig_source_target_and_templates(
         extra_sources: List[gen.internals.Source]):
     log.info("Generating configuration files...")
 
+    base_source, templates = get_dcosconfig_base_source_and_templates(
+        user_arguments.get("enable_windows_agents") == 'true', extra_templates)
+    sources = [base_source, user_arguments_to_source(user_arguments)] + extra_sources
+    return sources, get_dcosconfig_targets(templates), templates
+
+
+def get_dcosconfig_base_source_and_templates(enable_windows_agents: bool, extra_templates: List[str]):
+    """Return the source of all non-user setters and the templates, which don't depend on user arguments
+    other than enable_windows_agents."""
     # TODO(cmaloney): Make these all just defined by the base calc.py
     # There are separate configuration files for windows vs non-windows as a lot
     # of configuration on windows will be different.
@@ -464,7 +499,7 @@ def get_dcosconfig_source_target_and_templates(
 
     template_filenames = [dcos_config_yaml, cloud_config_yaml, 'dcos-metadata.yaml', dcos_services_yaml]
 
-    if user_arguments.get("enable_windows_agents") == 'true':
+    if enable_windows_agents:
         # Create an additional dcos-config-win setup package for Windows agents
         config_package_names.append('dcos-config-win')
         template_filenames.append('dcos-config-win.yaml')
@@ -485,14 +520,6 @@ def get_dcosconfig_source_target_and_templates(
                 "Internal Error: Only know how to merge YAML templates at this point in time. "
                 "Can't merge template {} in template_list {}".format(filename, templates[key]))
 
-    # Include a base target that references variables we need to calculate cluster_packages.
-    base_target = gen.internals.Target({
-        'config_package_names',
-        'dcos_image_commit',
-        'package_ids',
-        'template_filenames',
-    })
-    targets = [base_target] + target_from_templates(templates)
     base_source = gen.internals.Source(is_user=False)
     base_source.add_entry(gen.calc.entry, replace_existing=False)
 
@@ -503,8 +530,6 @@ def get_dcosconfig_source_target_and_templates(
     def add_builtin(name, value):
         base_source.add_must(name, json_prettyprint(value))
 
-    sources = [base_source, user_arguments_to_source(user_arguments)] + extra_sources
-
     # Add builtin variables.
     # TODO(cmaloney): Hash the contents of all the templates rather than using the list of filenames
     # since the filenames might not live in this git repo, or may be locally modified.
@@ -524,7 +549,19 @@ def get_dcosconfig_source_target_and_templates(
     add_builtin('expanded_config', temporary_str)
     add_builtin('expanded_config_full', temporary_str)
 
-    return sources, targets, templates
+    return base_source, templates
+
+
+def get_dcosconfig_targets(templates):
+    """Return new targets for templates. Targets can only be resolved once, so every resolution needs new ones."""
+    # Include a base target that references variables we need to calculate cluster_packages.
+    base_target = gen.internals.Target({
+        'config_package_names',
+        'dcos_image_commit',
+        'package_ids',
+        'template_filenames',
+    })
+    return [base_target] + target_from_templates(templates)
 
 
 def build_late_package(late_files, config_id, provider):
@@ -547,9 +584,9 @@ def build_late_package(late_files, config_id, provider):
     }
 
 
-def validate_and_raise(sources, targets):
+def validate_and_raise(sources, targets, previous_graph=None):
     # TODO(cmaloney): Make it so we only get out the dcosconfig target arguments not all the config target arguments.
-    resolver = gen.internals.resolve_configuration(sources, targets)
+    resolver = gen.internals.resolve_configuration(sources, targets, previous_graph)
     status = resolver.status_dict
 
     if status['status'] == 'errors':
@@ -558,6 +595,57 @@ def validate_and_raise(sources, targets):
     return resolver
 
 
+@lru_cache(maxsize=None)
+def get_code_build_id():
+    """Return an id of the gen and pkgpanda code in use.
+
+    The installer is identified by DCOS_VERSION and the commit its image was built from, a checkout
+    without DCOS_IMAGE_COMMIT set by the source of gen and pkgpanda.
+    """
+    commit = os.getenv('DCOS_IMAGE_COMMIT')
+    if commit:
+        return hash_checkout({'dcos_version': gen.calc.DCOS_VERSION, 'commit': commit})
+    sources = dict()
+    for package in (gen, pkgpanda):
+        package_dir = os.path.dirname(package.__file__)
+        for dir_path, _, filenames in os.walk(package_dir):
+            for filename in filenames:
+                if filename.endswith('.py'):
+                    path = os.path.join(dir_path, filename)
+                    sources[os.path.relpath(path, os.path.dirname(package_dir))] = sha1(path)
+    return hash_checkout(sources)
+
+
+def load_dependency_graph(dependency_graph_path):
+    """Load a dependency graph persisted by generate(), returning None if there isn't a usable one.
+
+    Graphs left by other gen and pkgpanda code aren't usable. The setter fingerprints only cover the
+    modules the setters are defined in, not the code they call.
+    """
+    if dependency_graph_path is None or not os.path.exists(dependency_graph_path):
+        return None
+    try:
+        graph = load_json(dependency_graph_path)
+    except ValueError as ex:
+        log.warning('Ignoring unreadable config dependency graph: {}'.format(ex))
+        return None
+    if not isinstance(graph, dict) or graph.get('build') != get_code_build_id():
+        log.info('Ignoring the config dependency graph of a different build')
+        return None
+    return graph
+
+
+def write_dependency_graph(dependency_graph_path, resolver):
+    graph_dir = os.path.dirname(dependency_graph_path)
+    if graph_dir:
+        os.makedirs(graph_dir, mode=0o755, exist_ok=True)
+    # The graph holds the values of the configuration, only the user running gen may read it. write_json() keeps
+    # the permissions of an existing file.
+    os.close(os.open(dependency_graph_path, os.O_WRONLY | os.O_CREAT, 0o600))
+    os.chmod(dependency_graph_path, 0o600)
+    write_json(dependency_graph_path, dict(resolver.dependency_graph, build=get_code_build_id()))
+
+
 def get_late_variables(resolver, sources):
     # Gather out the late variables. The presence of late variables changes
     # whether or not a late package is created
@@ -627,23 +715,97 @@ def generate(
         arguments,
         extra_templates=list(),
         extra_sources=list(),
-        extra_targets=list()):
-    # To maintain the old API where we passed arguments rather than the new name.
-    user_arguments = arguments
-    arguments = None
-
+        extra_targets=list(),
+        dependency_graph_path=None,
+        package_cache_dir=None):
+    """Resolve the configuration and render all the config packages and templates.
+
+    If dependency_graph_path is given, the dependency graph of the configuration resolution is
+    persisted there, and the graph left by a previous call is used to only recalculate the
+    arguments whose inputs changed since.
+
+    If package_cache_dir is given, config packages are cached there by content, and packages
+    with the same contents as a cached one are not built again (see do_gen_package()).
+    """
     sources, targets, templates = get_dcosconfig_source_target_and_templates(
-        user_arguments, extra_templates, extra_sources)
+        arguments, extra_templates, extra_sources)
+
+    results, resolver = _generate(
+        arguments,
+        sources,
+        targets + extra_targets,
+        templates,
+        load_dependency_graph(dependency_graph_path),
+        package_cache_dir)
+
+    if dependency_graph_path is not None:
+        log.debug('Reused {} previously calculated arguments'.format(len(resolver.reused)))
+        write_dependency_graph(dependency_graph_path, resolver)
+
+    if package_cache_dir is not None:
+        gen.util.prune_package_cache(package_cache_dir)
+
+    return results
 
+
+def generate_many(
+        arguments_list: List[dict],
+        extra_templates=list(),
+        extra_sources=list(),
+        extra_targets=list(),
+        package_cache_dir=None):
+    """Generate the configuration for each dictionary of user arguments in arguments_list.
+
+    Returns the same list of results as calling generate() on each of them, but the setters and
+    templates are only loaded once, and each configuration is resolved against the dependency graph
+    of the one before it, so only arguments depending on user arguments which differ between the
+    configurations are calculated more than once. package_cache_dir is as for generate().
+    """
+    log.info("Generating configuration files...")
+
+    # Keyed by enable_windows_agents, the only user argument the base source and templates depend on.
+    base_sources_and_templates = dict()
+    previous_graph = None
+    results = list()
+    for user_arguments in arguments_list:
+        enable_windows_agents = user_arguments.get("enable_windows_agents") == 'true'
+        if enable_windows_agents not in base_sources_and_templates:
+            base_sources_and_templates[enable_windows_agents] = get_dcosconfig_base_source_and_templates(
+                enable_windows_agents, extra_templates)
+        base_source, templates = base_sources_and_templates[enable_windows_agents]
+
+        sources = [base_source, user_arguments_to_source(user_arguments)] + extra_sources
+        # Targets are finalized by resolution, so every configuration needs its own copies.
+        targets = get_dcosconfig_targets(templates) + deepcopy(extra_targets)
+
+        result, resolver = _generate(user_arguments, sources, targets, templates, previous_graph, package_cache_dir)
+        previous_graph = resolver.dependency_graph
+        results.append(result)
+
+    if package_cache_dir is not None:
+        gen.util.prune_package_cache(package_cache_dir)
+
+    return results
+
+
+def _generate(user_arguments, sources, targets, templates, previous_graph, package_cache_dir=None):
+    with tracer.span(
+            'gen.generate',
+            'gen',
+            provider=user_arguments.get('provider'),
+            variant=user_arguments.get('bootstrap_variant')):
+        return _do_generate(user_arguments, sources, targets, templates, previous_graph, package_cache_dir)
+
+
+def _do_generate(user_arguments, sources, targets, templates, previous_graph, package_cache_dir=None):
     if user_arguments.get("enable_windows_agents") == 'true':
         # Parse the dcos-config-windows.yaml file to check that contained
         # variables are set.  Do not add template for evaluation, as that
         # gets done on the agent node.
         template = gen.template.parse_resources('dcos-config-windows.yaml')
-        target = template.target_from_ast()
-        extra_targets.append(target)
+        targets = targets + [template.target_from_ast()]
 
-    resolver = validate_and_raise(sources, targets + extra_targets)
+    resolver = validate_and_raise(sources, targets, previous_graph)
     argument_dict = get_final_arguments(resolver)
     late_variables = get_late_variables(resolver, sources)
     secret_builtins = ['expanded_config_full', 'user_arguments_full', 'config_yaml_full']
@@ -779,8 +941,12 @@ def generate(
     for package_id_str in config_package_ids:
         package_id = PackageId(package_id_str)
         package_filename = cluster_package_info[package_id.name]['filename']
-        do_gen_package(rendered_templates[package_id.name + '.yaml'], cluster_package_info[package_id.name]['filename'])
+        do_gen_package(
+            rendered_templates[package_id.name + '.yaml'],
+            cluster_package_info[package_id.name]['filename'],
+            package_cache_dir)
         stable_artifacts.append(package_filename)
+        stable_artifacts.append(write_content_digest(package_filename))
 
     # Convert cloud-config to just contain write_files rather than root
     cc = rendered_templates[cloud_config_yaml]
@@ -798,23 +964,26 @@ def generate(
         cc['write_files'].append(item)
     rendered_templates[cloud_config_yaml] = cc
 
-    # Add utils that need to be defined here so they can be bound to locals.
+    # Add utils that need to be defined here so they can be bound to locals. Every call gets its own
+    # utils so the results of one call keep working after another call.
+    call_utils = Bunch(dict(utils.__dict__))
+
     def add_services(cloudconfig, cloud_init_implementation):
         return add_units(cloudconfig, rendered_templates[dcos_services_yaml], cloud_init_implementation)
 
-    utils.add_services = add_services
+    call_utils.add_services = add_services
 
     def add_stable_artifact(filename):
         assert filename not in stable_artifacts + channel_artifacts
         stable_artifacts.append(filename)
 
-    utils.add_stable_artifact = add_stable_artifact
+    call_utils.add_stable_artifact = add_stable_artifact
 
     def add_channel_artifact(filename):
         assert filename not in stable_artifacts + channel_artifacts
         channel_artifacts.append(filename)
 
-    utils.add_channel_artifact = add_channel_artifact
+    call_utils.add_channel_artifact = add_channel_artifact
 
     return Bunch({
         'arguments': argument_dict,
@@ -822,5 +991,5 @@ def generate(
         'stable_artifacts': stable_artifacts,
         'channel_artifacts': channel_artifacts,
         'templates': rendered_templates,
-        'utils': utils
-    })
+        'utils': call_utils
+    }), resolver
@@ -360,7 +360,8 @@ def gen_supporting_template():
             cloudformation)
 
 
-def make_advanced_bundle(variant_args, extra_sources, template_name, cc_params):
+def make_advanced_bundles(arguments_list, extra_sources, template_name, cc_params):
+    """Return a (cloudformation, results) bundle for each dict of user arguments in arguments_list."""
     extra_templates = [
         'aws/dcos-config.yaml',
         'aws/templates/advanced/{}'.format(template_name)
@@ -375,43 +376,54 @@ def make_advanced_bundle(variant_args, extra_sources, template_name, cc_params):
         cloud_init_implementation = 'canonical'
         cc_params['os_type'] = 'el7prereq'
 
-    results = gen.generate(
-        arguments=variant_args,
+    results_list = gen.generate_many(
+        arguments_list,
         extra_templates=extra_templates,
         extra_sources=extra_sources + [aws_base_source],
         # TODO(cmaloney): Merge this with dcos_installer/backend.py::get_aws_advanced_target()
-        extra_targets=[gen.internals.Target(variables={'cloudformation_s3_url_full'})])
+        extra_targets=[gen.internals.Target(variables={'cloudformation_s3_url_full'})],
+        package_cache_dir=util.package_cache_dir)
 
-    cloud_config = results.templates['cloud-config.yaml']
+    bundles = list()
+    for results in results_list:
+        cloud_config = results.templates['cloud-config.yaml']
 
-    # Add general services
-    cloud_config = results.utils.add_services(cloud_config, cloud_init_implementation)
+        # Add general services
+        cloud_config = results.utils.add_services(cloud_config, cloud_init_implementation)
 
-    cc_variant = deepcopy(cloud_config)
-    cc_variant = results.utils.add_units(
-        cc_variant,
-        yaml.safe_load(gen.template.parse_str(late_services).render(cc_params)),
-        cloud_init_implementation)
+        cc_variant = deepcopy(cloud_config)
+        cc_variant = results.utils.add_units(
+            cc_variant,
+            yaml.safe_load(gen.template.parse_str(late_services).render(cc_params)),
+            cloud_init_implementation)
+
+        # Add roles
+        cc_variant = results.utils.add_roles(cc_variant, cc_params['roles'] + ['aws'])
+
+        # NOTE: If this gets printed in string stylerather than '|' the AWS
+        # parameters which need to be split out for the cloudformation to
+        # interpret end up all escaped and undoing it would be hard.
+        variant_cloudconfig = results.utils.render_cloudconfig(cc_variant)
 
-    # Add roles
-    cc_variant = results.utils.add_roles(cc_variant, cc_params['roles'] + ['aws'])
+        # Render the cloudformation
+        cloudformation = render_cloudformation(
+            results.templates[template_name],
+            cloud_config=variant_cloudconfig)
+        print("Validating CloudFormation: {}".format(template_name))
+        validate_cf(cloudformation)
 
-    # NOTE: If this gets printed in string stylerather than '|' the AWS
-    # parameters which need to be split out for the cloudformation to
-    # interpret end up all escaped and undoing it would be hard.
-    variant_cloudconfig = results.utils.render_cloudconfig(cc_variant)
+        bundles.append((cloudformation, results))
 
-    # Render the cloudformation
-    cloudformation = render_cloudformation(
-        results.templates[template_name],
-        cloud_config=variant_cloudconfig)
-    print("Validating CloudFormation: {}".format(template_name))
-    validate_cf(cloudformation)
+    return bundles
 
-    return (cloudformation, results)
 
+def gen_advanced_template(variant_arguments, reproducible_artifact_path, os_type):
+    # All variants of a template are generated together so the configuration they share is only
+    # calculated once.
+    variants = list(variant_arguments.keys())
+    arguments_list = [variant_arguments[variant] for variant in variants]
+    variant_prefixes = [pkgpanda.util.variant_prefix(variant) for variant in variants]
 
-def gen_advanced_template(arguments, variant_prefix, reproducible_artifact_path, os_type):
     for node_type in ['master', 'priv-agent', 'pub-agent']:
         # TODO(cmaloney): This forcibly overwriting arguments might overwrite a user set argument
 
@@ -427,37 +439,36 @@ def gen_advanced_template(arguments, variant_prefix, reproducible_artifact_path,
         template_key = 'advanced-{}'.format(node_type)
         template_name = template_key + '.json'
 
-        def _as_artifact(filename, bundle):
-            yield from _as_artifact_and_pkg(variant_prefix, filename, bundle)
-
         if node_type == 'master':
             for num_masters in [1, 3, 5, 7]:
                 master_tk = '{}-{}-{}'.format(os_type, template_key, num_masters)
                 print('Building {} {} for num_masters = {}'.format(os_type, node_type, num_masters))
                 num_masters_source = Source()
                 num_masters_source.add_must('num_masters', str(num_masters))
-                bundle = make_advanced_bundle(arguments,
-                                              [node_source, local_source, num_masters_source],
-                                              template_name,
-                                              deepcopy(params))
-                yield from _as_artifact('{}.json'.format(master_tk), bundle)
-
-                # Zen template corresponding to this number of masters
-                yield _as_cf_artifact(
-                    '{}{}-zen-{}.json'.format(variant_prefix, os_type, num_masters),
-                    render_cloudformation_transform(
-                        resource_string("gen", "aws/templates/advanced/zen.json").decode(),
-                        variant_prefix=variant_prefix,
-                        reproducible_artifact_path=reproducible_artifact_path,
-                        **bundle[1].arguments))
+                bundles = make_advanced_bundles(arguments_list,
+                                                [node_source, local_source, num_masters_source],
+                                                template_name,
+                                                deepcopy(params))
+                for variant_prefix, bundle in zip(variant_prefixes, bundles):
+                    yield from _as_artifact_and_pkg(variant_prefix, '{}.json'.format(master_tk), bundle)
+
+                    # Zen template corresponding to this number of masters
+                    yield _as_cf_artifact(
+                        '{}{}-zen-{}.json'.format(variant_prefix, os_type, num_masters),
+                        render_cloudformation_transform(
+                            resource_string("gen", "aws/templates/advanced/zen.json").decode(),
+                            variant_prefix=variant_prefix,
+                            reproducible_artifact_path=reproducible_artifact_path,
+                            **bundle[1].arguments))
         else:
             local_source.add_must('num_masters', '1')
             local_source.add_must('nat_ami_mapping', gen_ami_mapping({"natami"}))
-            bundle = make_advanced_bundle(arguments,
-                                          [node_source, local_source],
-                                          template_name,
-                                          deepcopy(params))
-            yield from _as_artifact('{}-{}'.format(os_type, template_name), bundle)
+            bundles = make_advanced_bundles(arguments_list,
+                                            [node_source, local_source],
+                                            template_name,
+                                            deepcopy(params))
+            for variant_prefix, bundle in zip(variant_prefixes, bundles):
+                yield from _as_artifact_and_pkg(variant_prefix, '{}-{}'.format(os_type, template_name), bundle)
 
 
 aws_simple_source = Source({
@@ -476,16 +487,26 @@ aws_simple_source = Source({
 })
 
 
-def gen_simple_template(variant_prefix, filename, arguments, extra_source):
-    results = gen.generate(
-        arguments=arguments,
+def gen_simple_templates(variant_arguments, filename, extra_source):
+    # All variants are generated together so the configuration they share is only calculated once.
+    variants = list(variant_arguments.keys())
+    results_list = gen.generate_many(
+        [variant_arguments[variant] for variant in variants],
         extra_templates=[
             'aws/templates/cloudformation.json',
             'aws/dcos-config.yaml',
             'coreos-aws/cloud-config.yaml',
             'coreos/cloud-config.yaml'],
-        extra_sources=[aws_base_source, aws_simple_source, extra_source])
+        extra_sources=[aws_base_source, aws_simple_source, extra_source],
+        package_cache_dir=util.package_cache_dir)
+
+    for variant, results in zip(variants, results_list):
+        cloudformation = render_simple_cloudformation(results)
+        yield from _as_artifact_and_pkg(
+            pkgpanda.util.variant_prefix(variant), filename, (cloudformation, results))
 
+
+def render_simple_cloudformation(results):
     cloud_config = results.templates['cloud-config.yaml']
 
     # Add general services
@@ -519,7 +540,7 @@ def gen_simple_template(variant_prefix, filename, arguments, extra_source):
     with logger.scope("Validating CloudFormation"):
         validate_cf(cloudformation)
 
-    yield from _as_artifact_and_pkg(variant_prefix, filename, (cloudformation, results))
+    return cloudformation
 
 
 button_template = "<a href='https://console.aws.amazon.com/cloudformation/home?region={region_id}#/stacks/new?templateURL={cloudformation_full_s3_url}/{template_name}.cloudformation.json'><img src='https://s3.amazonaws.com/cloudformation-examples/cloudformation-launch-stack.png' alt='Launch stack button'></a>"  # noqa
@@ -565,32 +586,22 @@ def gen_buttons(build_name, reproducible_artifact_path, tag, commit, variant_arg
 
 def do_create(tag, build_name, reproducible_artifact_path, commit, variant_arguments, all_completes):
     # Generate the single-master and multi-master templates.
-
-    for bootstrap_variant, variant_base_args in variant_arguments.items():
-        variant_prefix = pkgpanda.util.variant_prefix(bootstrap_variant)
-
-        def make(num_masters, filename):
-            num_masters_source = Source()
-            num_masters_source.add_must('num_masters', str(num_masters))
-            yield from gen_simple_template(
-                variant_prefix,
-                filename,
-                variant_base_args,
-                num_masters_source)
-
-        # Single master templates
-        yield from make(1, 'single-master.cloudformation.json')
-
-        # Multi master templates
-        yield from make(3, 'multi-master.cloudformation.json')
-
-        # Advanced templates
-        for os_type in ['coreos', 'el7']:
-            yield from gen_advanced_template(
-                variant_base_args,
-                variant_prefix,
-                reproducible_artifact_path,
-                os_type)
+    # Each template is generated for all variants at once so the configuration shared between the
+    # variants is only calculated once.
+    def make(num_masters, filename):
+        num_masters_source = Source()
+        num_masters_source.add_must('num_masters', str(num_masters))
+        yield from gen_simple_templates(variant_arguments, filename, num_masters_source)
+
+    # Single master templates
+    yield from make(1, 'single-master.cloudformation.json')
+
+    # Multi master templates
+    yield from make(3, 'multi-master.cloudformation.json')
+
+    # Advanced templates
+    for os_type in ['coreos', 'el7']:
+        yield from gen_advanced_template(variant_arguments, reproducible_artifact_path, os_type)
 
     # Button page linking to the basic templates.
     button_page = gen_buttons(build_name, reproducible_artifact_path, tag, commit, variant_arguments)
@@ -147,20 +147,27 @@ def render_arm(
     return json.dumps(template_json)
 
 
-def gen_templates(gen_arguments, arm_template, extra_sources):
+def gen_templates(arguments_list, arm_template, extra_sources):
     '''
-    Render the cloud_config template given a particular set of options
+    Render the cloud_config template given a list of sets of options
 
-    @param user_args: dict, args to pass to the gen library. These are user
-                     input arguments which get filled in/prompted for.
+    Returns a list of (arm, results) tuples, one for each entry in arguments_list.
+
+    @param arguments_list: list of dicts, args to pass to the gen library. These are user
+                           input arguments which get filled in/prompted for.
     @param arm_template: string, path to the source arm template for rendering
                          by the gen library (e.g. 'azure/templates/azuredeploy.json')
     '''
-    results = gen.generate(
-        arguments=gen_arguments,
+    results_list = gen.generate_many(
+        arguments_list,
         extra_templates=['azure/' + cloud_config_yaml, 'azure/templates/' + arm_template + '.json'],
-        extra_sources=[azure_base_source] + extra_sources)
+        extra_sources=[azure_base_source] + extra_sources,
+        package_cache_dir=util.package_cache_dir)
+
+    return [(render_results_arm(results, arm_template), results) for results in results_list]
 
+
+def render_results_arm(results, arm_template):
     cloud_config = results.templates[cloud_config_yaml]
 
     # Add general services
@@ -180,14 +187,12 @@ def gen_templates(gen_arguments, arm_template, extra_sources):
         variant_cloudconfig[variant] = results.utils.render_cloudconfig(cc_variant)
 
     # Render the arm
-    arm = render_arm(
+    return render_arm(
         results.templates[arm_template + '.json'],
         variant_cloudconfig['master'],
         variant_cloudconfig['slave'],
         variant_cloudconfig['slave_public'])
 
-    return (arm, results)
-
 
 def master_list_arm_json(num_masters, varietal):
     '''
@@ -233,13 +238,13 @@ azure_acs_source = Source({
 })
 
 
-def make_template(num_masters, gen_arguments, varietal, bootstrap_variant_prefix):
+def make_templates(num_masters, variant_arguments, varietal):
     '''
-    Return a tuple: the generated template for num_masters and the artifact dict.
+    Yield the generated template for num_masters and its artifacts for every variant.
 
     @param num_masters: int, number of master nodes to embed in the generated template
-    @param gen_arguments: dict, args to pass to the gen library. These are user
-                          input arguments which get filled in/prompted for.
+    @param variant_arguments: dict, bootstrap variant to the args to pass to the gen library. These are
+                              user input arguments which get filled in/prompted for.
     @param varietal: string, indicate template varietal to build for either 'acs' or 'dcos'
     '''
 
@@ -248,39 +253,39 @@ def make_template(num_masters, gen_arguments, varietal, bootstrap_variant_prefix
     master_list_source.add_must('num_masters', str(num_masters))
 
     if varietal == 'dcos':
-        arm, results = gen_templates(
-            gen_arguments,
-            'azuredeploy',
-            extra_sources=[master_list_source, azure_dcos_source])
+        arm_template = 'azuredeploy'
+        varietal_source = azure_dcos_source
     elif varietal == 'acs':
-        arm, results = gen_templates(
-            gen_arguments,
-            'acs',
-            extra_sources=[master_list_source, azure_acs_source])
+        arm_template = 'acs'
+        varietal_source = azure_acs_source
     else:
         raise ValueError("Unknown Azure varietal specified")
 
-    yield {
-        'channel_path': 'azure/{}{}-{}master.azuredeploy.json'.format(bootstrap_variant_prefix, varietal, num_masters),
-        'local_content': arm,
-        'content_type': 'application/json; charset=utf-8'
-    }
-    for filename in results.stable_artifacts:
+    # All variants are generated together so the configuration they share is only calculated once.
+    bootstrap_names = list(variant_arguments.keys())
+    generated = gen_templates(
+        [variant_arguments[bootstrap_name] for bootstrap_name in bootstrap_names],
+        arm_template,
+        extra_sources=[master_list_source, varietal_source])
+
+    for bootstrap_name, (arm, results) in zip(bootstrap_names, generated):
         yield {
-            'reproducible_path': filename,
-            'local_path': filename,
+            'channel_path': 'azure/{}{}-{}master.azuredeploy.json'.format(
+                pkgpanda.util.variant_prefix(bootstrap_name), varietal, num_masters),
+            'local_content': arm,
+            'content_type': 'application/json; charset=utf-8'
         }
+        for filename in results.stable_artifacts:
+            yield {
+                'reproducible_path': filename,
+                'local_path': filename,
+            }
 
 
 def do_create(tag, build_name, reproducible_artifact_path, commit, variant_arguments, all_completes):
     for arm_t in ['dcos', 'acs']:
         for num_masters in [1, 3, 5]:
-            for bootstrap_name, gen_arguments in variant_arguments.items():
-                yield from make_template(
-                    num_masters,
-                    gen_arguments,
-                    arm_t,
-                    pkgpanda.util.variant_prefix(bootstrap_name))
+            yield from make_templates(num_masters, variant_arguments, arm_t)
 
     yield {
         'channel_path': 'azure.html',
@@ -21,19 +21,21 @@ from gen.calc import (
     CHECK_SEARCH_PATH as DEFAULT_CHECK_SEARCH_PATH,
     validate_true_false,
 )
-from gen.internals import Source
+from gen.internals import Source, volatile
 from pkgpanda.constants import (
     cloud_config_yaml, dcos_services_yaml, install_root
 )
 from pkgpanda.util import copy_directory, copy_file, is_windows, logger, make_directory
 
 
+@volatile
 def calculate_custom_check_bins_provided(custom_check_bins_dir):
     if os.path.isdir(custom_check_bins_dir):
         return 'true'
     return 'false'
 
 
+@volatile
 def calculate_custom_check_bins_hash(custom_check_bins_provided, custom_check_bins_dir):
     if custom_check_bins_provided == 'true':
         return checksumdir.dirhash(custom_check_bins_dir, 'sha1')
@@ -58,6 +60,7 @@ def calculate_check_search_path(custom_check_bins_provided, custom_check_bins_pa
     return DEFAULT_CHECK_SEARCH_PATH
 
 
+@volatile
 def calculate_package_ids(bootstrap_variant, custom_check_bins_provided, custom_check_bins_package_id):
     package_ids = dcos_installer.config_util.installer_latest_complete_artifact(bootstrap_variant)['packages']
     if custom_check_bins_provided == 'true':
@@ -84,7 +87,7 @@ onprem_source = Source(entry={
         'resolvers': '["8.8.8.8", "8.8.4.4"]',
         'ip_detect_filename': 'genconf/ip-detect',
         'ip6_detect_filename': '',
-        'bootstrap_id': lambda: calculate_environment_variable('BOOTSTRAP_ID'),
+        'bootstrap_id': volatile(lambda: calculate_environment_variable('BOOTSTRAP_ID')),
         'enable_docker_gc': 'false'
     },
     'must': {
@@ -664,6 +667,7 @@ def make_bash(gen_out) -> None:
         )
         make_custom_check_bins_package(gen_out.arguments['custom_check_bins_dir'], package_filename)
         gen_out.utils.add_stable_artifact(package_filename)
+        gen_out.utils.add_stable_artifact(pkgpanda.util.write_content_digest(package_filename))
 
     setup_flags = ""
     cloud_config = gen_out.templates[cloud_config_yaml]
@@ -807,7 +811,9 @@ def make_installer_docker(variant, variant_info, installer_info):
         copy_to_build('packages/cache/complete', latest_complete_filename)
         for package_id in variant_info['packages']:
             package_name = pkgpanda.PackageId(package_id).name
-            copy_to_build('packages/cache/', packages_dir + '/' + package_name + '/' + package_id + '.tar.xz')
+            package_filename = packages_dir + '/' + package_name + '/' + package_id + '.tar.xz'
+            copy_to_build('packages/cache/', package_filename)
+            copy_to_build('packages/cache/', pkgpanda.util.content_digest_filename(package_filename))
 
         # Copy across gen_extra if it exists
         if os.path.exists('gen_extra'):
@@ -16,6 +16,10 @@ if dcos_image_commit is None:
 
 template_generation_date = str(datetime.utcnow())
 
+# Config packages generated for the provider templates are cached here by content, many of them
+# are identical between templates (see gen.do_gen_package()).
+package_cache_dir = 'packages/cache/gen'
+
 
 def try_makedirs(path):
     try:
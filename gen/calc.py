@@ -166,6 +166,7 @@ def calculate_environment_variable(name):
     return value
 
 
+@gen.internals.volatile
 def calulate_dcos_image_commit():
     dcos_image_commit = os.getenv('DCOS_IMAGE_COMMIT', None)
 
@@ -255,17 +256,20 @@ def calculate_windows_config_yaml():
     return textwrap.indent(s, prefix=('  ' * 3))
 
 
+@gen.internals.volatile
 def calculate_ip_detect_contents(ip_detect_filename):
     assert os.path.exists(ip_detect_filename), "ip-detect script `{}` must exist".format(ip_detect_filename)
     return yaml.dump(open(ip_detect_filename, encoding='utf-8').read())
 
 
+@gen.internals.volatile
 def calculate_ip_detect_public_contents(ip_detect_contents, ip_detect_public_filename):
     if ip_detect_public_filename != '':
         return calculate_ip_detect_contents(ip_detect_public_filename)
     return ip_detect_contents
 
 
+@gen.internals.volatile
 def calculate_ip6_detect_contents(ip6_detect_filename):
     if ip6_detect_filename != '':
         return yaml.dump(open(ip6_detect_filename, encoding='utf-8').read())
@@ -1122,6 +1126,7 @@ def validate_vxlan_vni(vxlan_vni):
     assert vxlan_vni != 1024, 'VXLAN VNI {} should not conflict with that of dcos overlay'
 
 
+@gen.internals.volatile
 def calculate_fault_domain_detect_contents(fault_domain_detect_filename):
     if os.path.exists(fault_domain_detect_filename):
         return yaml.dump(open(fault_domain_detect_filename, encoding='utf-8').read())
@@ -1242,7 +1247,7 @@ entry = {
         'exhibitor_azure_account_key': '',
         'aws_secret_access_key': '',
         'bootstrap_tmp_dir': 'tmp',
-        'bootstrap_variant': lambda: calculate_environment_variable('BOOTSTRAP_VARIANT'),
+        'bootstrap_variant': gen.internals.volatile(lambda: calculate_environment_variable('BOOTSTRAP_VARIANT')),
         'dns_bind_ip_reserved': '["198.51.100.4"]',
         'dns_bind_ip_blacklist': '[]',
         'dns_forward_zones': '{}',
@@ -1,9 +1,13 @@
 import copy
 import enum
 import inspect
+import json
 import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
-from functools import partial, partialmethod
+from functools import lru_cache, partial, partialmethod
 from typing import Any, Callable, Dict, List, Set, Tuple, Union
 
 from gen.exceptions import ValidationError
@@ -50,6 +54,31 @@ def function_id(function: Callable):
     }
 
 
+def volatile(function: Callable):
+    """Mark a calculator as reading state other than its parameters (files, environment, git).
+
+    Incremental resolution never reuses a previously calculated value of a volatile calculator,
+    it is always re-run.
+    """
+    function.is_volatile = True
+    return function
+
+
+@lru_cache(maxsize=None)
+def _source_file_id(filename: str) -> str:
+    with open(filename, encoding='utf-8') as f:
+        return hash_checkout(f.read())
+
+
+def code_id(function: Callable) -> str:
+    """Return an id of the source file `function` is defined in, or '' if it can't be found."""
+    module = inspect.getmodule(function)
+    filename = getattr(module, '__file__', None)
+    if filename is None or not filename.endswith('.py'):
+        return ''
+    return _source_file_id(filename)
+
+
 class Late:
     """A value which is going to be bound 'late' / is only known at cluster launch time."""
 
@@ -96,6 +125,9 @@ class Setter:
         def get_value():
             return value
 
+        self.is_volatile = False
+        self._function = None
+        self._fingerprint = None
         if isinstance(value, str):
             self.calc = get_value
             self.parameters = set()
@@ -110,6 +142,8 @@ class Setter:
             self.calc = value
             self.parameters = get_function_parameters(value)
             self.is_late = False
+            self.is_volatile = getattr(value, 'is_volatile', False)
+            self._function = value
 
     def __repr__(self):
         return "<Setter {}{}{}, conditions: {}{}>".format(
@@ -129,6 +163,105 @@ class Setter:
             'is_user': str(self.is_user)
         }
 
+    def fingerprint(self):
+        """Return a hash of make_id() which also changes when the source of the calculator changes."""
+        if self._fingerprint is None:
+            self._fingerprint = hash_checkout({
+                'id': hash_checkout(self.make_id()),
+                'code': code_id(self._function) if self._function is not None else '',
+            })
+        return self._fingerprint
+
+
+class _ConditionNode:
+    """A node of a SetterIndex trie.
+
+    setters are the (position, setter) pairs whose conditions are all met once the switches on the
+    path to this node are. switches maps a switch name to the node for every value it's tested for.
+    """
+
+    def __init__(self):
+        self.setters = list()
+        self.switches = dict()
+
+
+class SetterIndex:
+    """The setters of every name, indexed by the conditions they're defined under.
+
+    Setters sharing conditions share a path through a trie keyed by switch name and value, so the
+    feasible setters of a name are found by resolving each switch on the way once and looking up
+    its value, rather than by testing the conditions of every setter.
+    """
+
+    def __init__(self, setters: Dict[str, List[Setter]]):
+        self._setters = setters
+        self._roots = dict()
+        for name, setter_list in setters.items():
+            root = _ConditionNode()
+            for position, setter in enumerate(setter_list):
+                node = root
+                for condition_name, condition_value in setter.conditions:
+                    cases = node.switches.setdefault(condition_name, dict())
+                    node = cases.setdefault(condition_value, _ConditionNode())
+                node.setters.append((position, setter))
+            self._roots[name] = root
+
+    def all(self, name: str) -> List[Setter]:
+        """Return every setter of name, whether or not its conditions are met."""
+        return self._setters.get(name, list())
+
+    def components(self) -> Dict[str, int]:
+        """Map every name to the connected component of the setter graph it's in.
+
+        Any name calculating a name may read is a parameter or a switch of one of its setters, so
+        calculating names in different components never reads the same names.
+        """
+        parents = dict()
+
+        def find(name):
+            root = parents.setdefault(name, name)
+            while root != parents[root]:
+                root = parents[root]
+            # Compress the path.
+            while parents[name] != root:
+                parents[name], name = root, parents[name]
+            return root
+
+        for name, setter_list in self._setters.items():
+            for setter in setter_list:
+                neighbours = set(setter.parameters)
+                neighbours.update(condition_name for condition_name, _ in setter.conditions)
+                for neighbour in neighbours:
+                    parents[find(neighbour)] = find(name)
+            find(name)
+
+        component_ids = dict()
+        return {name: component_ids.setdefault(find(name), len(component_ids)) for name in sorted(parents)}
+
+    def feasible(self, name: str, resolve_switch: Callable[[str], str]) -> List[Setter]:
+        """Return the setters of name whose conditions are all met, in the order they were added.
+
+        resolve_switch is called with the name of each switch which needs to be tested and must
+        return its value. Switches below a case which doesn't match are never resolved.
+        """
+        root = self._roots.get(name)
+        if root is None:
+            return list()
+
+        found = list()
+        pending = [root]
+        while pending:
+            node = pending.pop()
+            found += node.setters
+            for switch, cases in node.switches.items():
+                case = cases.get(resolve_switch(switch))
+                if case is not None:
+                    pending.append(case)
+
+        if len(found) > 1:
+            found.sort(key=lambda item: item[0])
+        return [setter for _, setter in found]
+
 
 class Scope:
     """ Abstraction for maintaining the mapping between a parameter and the
@@ -499,55 +632,109 @@ class Validator:
     # how / when each is run. Moving the multi-argument validation to as soon as possible after an
     # argument set is finalized rather than one big pass at the end would likely make it much
     # cleaner.
-    def yield_multi_argument_validate_errors(self, arguments: ArgumentDict):
-        for parameter_set, validate_fns in self._multi_arg_validate.items():
-            # Build up argument map for validate function. If any arguments are
-            # unset then skip this validate function.
-            kwargs = dict()
-            skip = False
-            for parameter in parameter_set:
-                # Exit early if the parameter was never calculated / asked for (We don't
-                # validate things that are never used or given)
-                if parameter not in arguments:
-                    skip = True
-                    break
+    def yield_multi_argument_validate_errors(self, arguments: ArgumentDict, executor=None):
+        """Yield a (parameter_set, message) pair for every failing multi-argument validate function.
 
-                # Exit if the parameter resolved to an error
-                resolvable = arguments[parameter]
-                if resolvable.is_error:
-                    skip = True
-                    break
+        If an executor is given the validate functions are run on it, errors are still yielded in
+        the same order.
+        """
+        def validate(item):
+            return self._multi_argument_validate_error(arguments, *item)
 
-                kwargs[parameter] = arguments[parameter].value
+        if executor is None:
+            results = map(validate, self._multi_arg_validate.items())
+        else:
+            results = executor.map(validate, self._multi_arg_validate.items())
+
+        for error in results:
+            if error is not None:
+                yield error
+
+    def _multi_argument_validate_error(self, arguments: ArgumentDict, parameter_set, validate_fns):
+        # Build up argument map for validate function. If any arguments are
+        # unset then skip this validate function.
+        kwargs = dict()
+        for parameter in parameter_set:
+            # Exit early if the parameter was never calculated / asked for (We don't
+            # validate things that are never used or given)
+            if parameter not in arguments:
+                return None
+
+            # Exit if the parameter resolved to an error
+            resolvable = arguments[parameter]
+            if resolvable.is_error:
+                return None
 
-            if skip:
-                continue
+            kwargs[parameter] = arguments[parameter].value
+
+        # Call the validation function, catching AssertionErrors and turning them into errors in
+        # the error dictionary.
+        try:
+            for validate_fn in validate_fns:
+                validate_fn(**kwargs)
+        except AssertionError as ex:
+            return (parameter_set, ex.args[0])
+        return None
+
+
+# Version of the format of Resolver.dependency_graph. Graphs of any other version are ignored.
+DEPENDENCY_GRAPH_VERSION = 2
 
-            # Call the validation function, catching AssertionErrors and turning them into errors in
-            # the error dictionary.
-            try:
-                for validate_fn in validate_fns:
-                    validate_fn(**kwargs)
-            except AssertionError as ex:
-                yield (parameter_set, ex.args[0])
+
+def _resolvable_state(resolvable):
+    """Return a JSON serializable [state, value hash] pair describing a finalized resolvable.
+
+    Only a hash of the value is recorded, so the values of secret dependencies don't end up in the graph.
+    """
+    if resolvable.is_resolved:
+        return [str(resolvable.State.RESOLVED), hash_checkout(json.dumps(resolvable.value, sort_keys=True))]
+    if resolvable.is_late:
+        return [str(resolvable.State.LATE), None]
+    return [str(resolvable.State.ERROR), None]
 
 
 # Depth first search argument calculator. Detects cycles, as well as unmet
 # dependencies.
+#
+# While resolving, the Resolver records which names were read while calculating every name (the
+# dependency graph). Given the dependency graph of a previous resolution, a name whose setters are
+# unchanged and whose dependencies all finalized to their previous values reuses its previous
+# value rather than running its setter again.
+#
+# Given max_workers, names in different components of the setter graph (see
+# SetterIndex.components()) are resolved concurrently on a thread pool. Every name still resolves
+# to the value it would have sequentially, so the final arguments and config_id don't change.
 # TODO(cmaloney): Separate chain / path building when unwinding from the root
 #                 error messages.
 class Resolver:
-    def __init__(self, setters, validate_fns, targets):
+    def __init__(self, setters: SetterIndex, validate_fns, targets, previous_graph=None, max_workers=None,
+                 secrets=frozenset()):
         self._resolved = False
         self._setters = setters
         self._targets = targets
+        self._max_workers = max_workers
+        self._executor = None
+
+        # Names whose values are never recorded in the dependency graph, so they're always calculated.
+        self._secrets = secrets
+
+        # Seconds spent in the setter of every calculated name, excluding its dependencies.
+        self._timings = dict()
+
+        # Names read while calculating each name, in the order they were first read.
+        self._dependencies = dict()
+        self._setter_fingerprints = dict()
+        self._reused = set()
+        self._previous = None
+        if previous_graph is not None and previous_graph.get('version') == DEPENDENCY_GRAPH_VERSION:
+            self._previous = previous_graph['arguments']
 
         self._errors = dict()
         self._unset = set()
         self._late = set()
 
-        # The current stack of resolvables which are in the process of being resolved.
-        self._eval_stack = list()
+        # The current stack of resolvables which are in the process of being resolved, one per thread.
+        self._local = threading.local()
 
         # Set of Resolvables() which are resolved, being resolved.
         self._arguments = ArgumentDict()
@@ -556,22 +743,26 @@ class Resolver:
 
         self._validator = Validator(validate_fns, targets)
 
+    @property
+    def _eval_stack(self):
+        try:
+            return self._local.eval_stack
+        except AttributeError:
+            self._local.eval_stack = list()
+            return self._local.eval_stack
+
     def _calculate(self, resolvable):
-        # Filter out any setters which have predicates / conditions which are
-        # satisfiably false.
-        def all_conditions_met(setter):
-            for condition_name, condition_value in setter.conditions:
-                try:
-                    if self._resolve_name(condition_name) != condition_value:
-                        return False
-                except CalculatorError as ex:
-                    raise CalculatorError(
-                        ex.message,
-                        ex.chain + ['trying to test condition {}={}'.format(condition_name, condition_value)]) from ex
-            return True
+        # Only consider setters whose predicates / conditions are met.
+        def resolve_switch(condition_name):
+            try:
+                return self._resolve_name(condition_name)
+            except CalculatorError as ex:
+                raise CalculatorError(
+                    ex.message,
+                    ex.chain + ['trying to test condition {}'.format(condition_name)]) from ex
 
         # Find the right setter to calculate the argument.
-        feasible = list(filter(all_conditions_met, self._setters.get(resolvable.name, list())))
+        feasible = self._setters.feasible(resolvable.name, resolve_switch)
 
         if len(feasible) == 0:
             self._unset.add(resolvable.name)
@@ -579,7 +770,7 @@ class Resolver:
 
         # Filter out all optional setters if there is more than one way to set.
         if len(feasible) > 1:
-            final_feasible = list(filter(lambda setter: not setter.is_optional, feasible))
+            final_feasible = [setter for setter in feasible if not setter.is_optional]
             assert final_feasible, "Had multiple optionals and no musts. Template internal error: {!r}".format(feasible)
             feasible = final_feasible
 
@@ -596,8 +787,9 @@ class Resolver:
                     return False
             return True
 
-        if len(feasible) > 1:
-            feasible = list(filter(has_no_late_parameters, feasible))
+        checked_late = len(feasible) > 1
+        if checked_late:
+            feasible = [setter for setter in feasible if has_no_late_parameters(setter)]
 
         # TODO(cmaloney): As long as all paths to set the value evaluate to the same value then
         # having more than one way to calculate is fine. This is true of both multiple internal /
@@ -612,7 +804,7 @@ class Resolver:
 
         setter = feasible[0]
 
-        if not has_no_late_parameters(setter):
+        if not checked_late and not has_no_late_parameters(setter):
             # The setter has late parameters, which means the parameter it's setting is late as
             # well. Stash that it is late. Ideally would also stash the setter / ensure we use the
             # exact same one when actually deploying.
@@ -630,7 +822,9 @@ class Resolver:
             kwargs[parameter] = self._resolve_name(parameter)
 
         try:
+            start = time.perf_counter()
             value = setter.calc(**kwargs)
+            self._timings[resolvable.name] = time.perf_counter() - start
             self._validator.validate_single(resolvable.name, value)
         except AssertionError as ex:
             raise CalculatorError(ex.args[0], [ex]) from ex
@@ -652,7 +846,60 @@ class Resolver:
         foo = self._eval_stack.pop()
         assert foo == name, "Internal consistency error: Unwinding stack seems to not be the order it was built in..."
 
+    def _setters_fingerprint(self, name):
+        if name not in self._setter_fingerprints:
+            self._setter_fingerprints[name] = hash_checkout(
+                [setter.fingerprint() for setter in self._setters.all(name)])
+        return self._setter_fingerprints[name]
+
+    def _reuse_previous(self, resolvable):
+        """Return the (value, setter) of resolvable from the previous dependency graph.
+
+        Returns None if the value can't be reused and must be calculated.
+        """
+        if self._previous is None:
+            return None
+
+        entry = self._previous.get(resolvable.name)
+        if entry is None or entry['setters'] != self._setters_fingerprint(resolvable.name):
+            return None
+
+        setter = None
+        if entry['setter'] is not None:
+            for candidate in self._setters.all(resolvable.name):
+                if candidate.fingerprint() == entry['setter']:
+                    setter = candidate
+                    break
+            if setter is None or setter.is_volatile:
+                return None
+
+        # Dependencies are finalized in the order the previous calculation read them, so up until
+        # the first one which changed, these are exactly the names a calculation would read.
+        for name, state, value in entry['dependencies']:
+            dependency = self._arguments[name]
+            self._ensure_finalized(dependency)
+            if _resolvable_state(dependency) != [state, value]:
+                return None
+
+        if entry['state'] == str(Resolvable.State.LATE):
+            self._reused.add(resolvable.name)
+            raise LateBoundException()
+
+        # Validation may depend on more than the value (e.g. the filesystem), so it is always re-run.
+        try:
+            self._validator.validate_single(resolvable.name, entry['value'])
+        except AssertionError as ex:
+            raise CalculatorError(ex.args[0], [ex]) from ex
+
+        self._reused.add(resolvable.name)
+        return entry['value'], setter
+
     def _ensure_finalized(self, resolvable):
+        if self._eval_stack:
+            dependencies = self._dependencies.setdefault(self._eval_stack[-1], list())
+            if resolvable.name not in dependencies:
+                dependencies.append(resolvable.name)
+
         if resolvable.is_finalized:
             return
 
@@ -663,7 +910,10 @@ class Resolver:
         # when the stack unwinds.
         with self._stack_layer(resolvable.name):
             try:
-                resolvable.finalize_value(*self._calculate(resolvable))
+                result = self._reuse_previous(resolvable)
+                if result is None:
+                    result = self._calculate(resolvable)
+                resolvable.finalize_value(*result)
             except LateBoundException:
                 self._late.add(resolvable.name)
                 resolvable.finalize_late()
@@ -749,12 +999,55 @@ class Resolver:
         assert not self._resolved, "Resolvers should only be resolved once"
         self._resolved = True
 
+        if self._max_workers is not None and self._max_workers > 1:
+            with ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+                self._executor = executor
+                try:
+                    self._resolve()
+                finally:
+                    self._executor = None
+        else:
+            self._resolve()
+
+    def _resolve(self):
+        if self._executor is not None:
+            self._finalize_targets_concurrently(self._targets)
+
         for target in self._targets:
             self._calculate_target(target)
 
-        for parameter_set, error in self._validator.yield_multi_argument_validate_errors(self._arguments):
+        for parameter_set, error in self._validator.yield_multi_argument_validate_errors(
+                self._arguments, self._executor):
             self._errors[parameter_set] = error
 
+    def _finalize_targets_concurrently(self, targets):
+        # Finalize the names targets need one level of sub scopes at a time, since which sub
+        # scopes are needed is only known once the names switching them are finalized. What's left
+        # for _calculate_target() is picking the sub scopes.
+        components = self._setters.components()
+        while targets:
+            # Group the names by component, keeping the order _calculate_target() would use.
+            groups = dict()
+            for target in targets:
+                for name in list(target.variables) + list(target.sub_scopes):
+                    groups.setdefault(components.get(name, name), list()).append(name)
+
+            futures = [self._executor.submit(self._finalize_all, names) for names in groups.values()]
+            for future in futures:
+                future.result()
+
+            sub_targets = list()
+            for target in targets:
+                for name, sub_scope in target.sub_scopes.items():
+                    resolvable = self._arguments[name]
+                    if not resolvable.is_error and resolvable.value in sub_scope.cases:
+                        sub_targets.append(sub_scope.cases[resolvable.value])
+            targets = sub_targets
+
+    def _finalize_all(self, names):
+        for name in names:
+            self._ensure_finalized(self._arguments[name])
+
     @property
     def arguments(self):
         assert self._resolved, "Can't get arguments until they've been resolved"
@@ -765,6 +1058,45 @@ class Resolver:
         assert self._resolved, "Can't get late arguments until the Resolver has been resolved"
         return self._late
 
+    @property
+    def reused(self):
+        """Names whose values were taken from the previous dependency graph rather than calculated."""
+        assert self._resolved, "Can't get reused arguments until the Resolver has been resolved"
+        return self._reused
+
+    @property
+    def timings(self):
+        """Seconds spent running the setter of every calculated name, excluding its dependencies."""
+        assert self._resolved, "Can't get timings until the Resolver has been resolved"
+        return self._timings
+
+    @property
+    def dependency_graph(self):
+        """A JSON serializable record of every resolved argument, its setters and its dependencies.
+
+        Can be passed as `previous_graph` to a later resolve_configuration() call. Secret arguments are
+        left out, and dependencies are recorded by a hash of their value.
+        """
+        assert self._resolved, "Can't get the dependency graph until the Resolver has been resolved"
+        arguments = dict()
+        for name, resolvable in self._arguments.items():
+            if not (resolvable.is_resolved or resolvable.is_late) or name in self._secrets:
+                continue
+            arguments[name] = {
+                'state': _resolvable_state(resolvable)[0],
+                'value': resolvable.value if resolvable.is_resolved else None,
+                'setter': resolvable.setter.fingerprint() if resolvable.setter else None,
+                'setters': self._setters_fingerprint(name),
+                'dependencies': [
+                    [dependency] + _resolvable_state(self._arguments[dependency])
+                    for dependency in self._dependencies.get(name, list())
+                ],
+            }
+        return {
+            'version': DEPENDENCY_GRAPH_VERSION,
+            'arguments': arguments,
+        }
+
     @property
     def status_dict(self):
         assert self._resolved, "Can't retrieve status dictionary until configuration has been resolved"
@@ -802,22 +1134,19 @@ class Resolver:
         }
 
 
-def resolve_configuration(sources: List[Source], targets: List[Target]):
+def resolve_configuration(
+        sources: List[Source],
+        targets: List[Target],
+        previous_graph: dict=None,
+        max_workers: int=None):
+    """Resolve the arguments needed by targets using the setters and validate functions in sources.
 
-    # Merge the sources into a big dictionary of setters + validators, ensuring
-    # that all setters are either strings or functions.
-    validate = list()
-    setters = dict()
+    previous_graph is the dependency_graph of an earlier Resolver. Arguments it records whose
+    setters and dependencies haven't changed are reused rather than calculated again.
 
-    # Merge all the config targets into one big group of setters for providing
-    # to the calculator
-    # TODO(cmaloney): The setter management / set code is very similar to that in ConfigTarget, they
-    # could probably be joined.
-    for source in sources:
-        for name, setter_list in source.setters.items():
-            setters.setdefault(name, list())
-            setters[name] += setter_list
-        validate += source.validate
+    If max_workers is more than one, independent arguments are calculated concurrently on that
+    many threads. The result is the same as resolving sequentially.
+    """
 
     # Re-enable this after sorting out how to have "optional" config targets which
     # add in extra "acceptable" parameters (SSH Config, AWS Advanced Template config, etc)
@@ -837,8 +1166,10 @@ def resolve_configuration(sources: List[Source], targets: List[Target]):
         validate += source.validate
 
     # Use setters to calculate every required parameter
-    resolver = Resolver(setters, validate, targets)
+    secrets = frozenset(name for source in sources for name in source.secret)
+    resolver = Resolver(SetterIndex(setters), validate, targets, previous_graph, max_workers, secrets)
     resolver.resolve()
+    log_slowest_calculations(resolver)
 
     def target_finalized(target):
         return all([arg.is_finalized for arg in target.arguments.values()])
@@ -853,3 +1184,12 @@ def resolve_configuration(sources: List[Source], targets: List[Target]):
     validate_arguments_strings(arg_dict)
 
     return resolver
+
+
+def log_slowest_calculations(resolver: Resolver, count: int=10):
+    """Log the names whose setters took the longest to run at debug level."""
+    if not log.isEnabledFor(logging.DEBUG):
+        return
+    slowest = sorted(resolver.timings.items(), key=lambda item: item[1], reverse=True)[:count]
+    for name, seconds in slowest:
+        log.debug("Calculating %s took %.4fs", name, seconds)
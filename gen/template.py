@@ -15,6 +15,8 @@
 #   switch <identifier>
 #   case <string>:
 #   endswith
+import hashlib
+import re
 from typing import Optional, Tuple
 
 from pkg_resources import resource_string
@@ -26,9 +28,11 @@ identifier_valid_characters = 'abcdefghijklmnopqrstuvwxyz_0123456789'
 
 class SyntaxError(Exception):
 
-    def __init__(self, message, filename=None):
+    def __init__(self, message, filename=None, line=None, column=None):
         self.message = message
         self.filename = filename
+        self.line = line
+        self.column = column
 
     def __str__(self):
         if self.filename:
@@ -37,11 +41,21 @@ class SyntaxError(Exception):
             return repr(self.message)
 
 
+_identifier_re = re.compile('[{}]*'.format(identifier_valid_characters))
+
+
 class Tokenizer:
+    """Splits a template into tokens.
+
+    The lexer walks an index cursor over the corpus rather than repeatedly slicing off the
+    consumed prefix, so tokenizing is linear in the size of the template.
+    """
 
     def __init__(self, corpus: str):
         self.__corpus = corpus
-        self.__to_lex = corpus
+        self.__pos = 0
+        # Set to true once the EOF token is emitted.
+        self.__done = False
 
         self.__token_pos = 0
         self.tokens = []
@@ -50,14 +64,22 @@ class Tokenizer:
             try:
                 kind, value = self.__read_token()
             except SyntaxError as ex:
-                # TOOD(cmaloney): Calculate line and column information
-                context = "context: '{}'".format(self.__to_lex[:10])
+                line, column = self.__line_and_column(self.__pos)
+                context = "context: '{}'".format(corpus[self.__pos:self.__pos + 10])
                 raise SyntaxError(
-                    "ERROR parsing code near {}. {}".format(context, ex)) from ex
+                    "ERROR parsing code near line {} column {}, {}. {}".format(line, column, context, ex),
+                    line=line,
+                    column=column) from ex
             self.tokens.append((kind, value))
             if kind == "eof":
                 break
 
+    def __line_and_column(self, pos):
+        # Lines and columns are 1-indexed.
+        line = self.__corpus.count('\n', 0, pos) + 1
+        column = pos - (self.__corpus.rfind('\n', 0, pos) + 1) + 1
+        return line, column
+
     def peek(self):
         if self.__token_pos == len(self.tokens):
             raise RuntimeError("Walked past end of token list")
@@ -69,71 +91,74 @@ class Tokenizer:
         self.__token_pos += 1
         return self.tokens[self.__token_pos]
 
+    def __startswith(self, prefix):
+        return self.__corpus.startswith(prefix, self.__pos)
+
+    def __char(self, offset=0):
+        # Returns '' past the end of the corpus.
+        return self.__corpus[self.__pos + offset:self.__pos + offset + 1]
+
     def __read_token(self):
-        # __to_lex is set to none after the EOF token is emitted.
-        assert self.__to_lex is not None
+        assert not self.__done
+        corpus = self.__corpus
 
-        if len(self.__to_lex) == 0:
-            self.__to_lex = None
+        if self.__pos == len(corpus):
+            self.__done = True
             return "eof", None
 
         # If not starting with '{', consume text until we find '{' as a blob
         # token.
-        if self.__to_lex[0] != '{':
-            split = self.__to_lex.split('{', 1)
-            assert(len(split) == 1 or len(split) == 2)
-
-            if len(split) == 2:
-                self.__to_lex = '{' + split[1]
-            else:
+        if corpus[self.__pos] != '{':
+            start = self.__pos
+            end = corpus.find('{', start)
+            if end == -1:
                 # No remaining '{' in text. This is the end of the string.
-                self.__to_lex = ''
-            return 'blob', split[0]
+                end = len(corpus)
+            self.__pos = end
+            return 'blob', corpus[start:end]
 
         # Process '{' beginning control sequences.
 
         # Define some helper functions used by multiple methods below.
         def read_whitespace():
-            if self.__to_lex[0] != ' ':
+            if self.__char() != ' ':
                 raise SyntaxError("Expected exactly one space")
-            if self.__to_lex[1].isspace():
+            if self.__char(1).isspace():
                 raise SyntaxError(
                     "Found more spaces than expected. Only one space is allowed by coding convention.")
-            self.__to_lex = self.__to_lex[1:]
+            self.__pos += 1
 
         def read_identifier():
             # Before identifiers is always whitespace / we're in control where
             # whitespace is arbitrary.
             read_whitespace()
-            identifier = ""
-            while self.__to_lex[0] in identifier_valid_characters:
-                identifier += self.__to_lex[0]
-                self.__to_lex = self.__to_lex[1:]
+            identifier = _identifier_re.match(corpus, self.__pos).group()
+            self.__pos += len(identifier)
             return identifier
 
         def read_str():
             read_whitespace()
-            if not self.__to_lex.startswith('"'):
+            if not self.__startswith('"'):
                 raise SyntaxError(
                     "Expected string starting with '\"' as value for case but didn't find it.")
-            self.__to_lex = self.__to_lex[1:]
+            self.__pos += 1
 
-            value = ""
+            value = []
             has_backslash = False
             while True:
-                if len(self.__to_lex) == 0:
+                if self.__pos == len(corpus):
                     raise SyntaxError(
                         "Unexpected end of file when reading contents of string")
 
-                cur = self.__to_lex[0]
-                self.__to_lex = self.__to_lex[1:]
+                cur = corpus[self.__pos]
+                self.__pos += 1
 
                 if cur in ['\n', '\r']:
                     raise SyntaxError("Newlines aren't allowed in strings")
 
                 if has_backslash:
                     if cur in ['"', '\\']:
-                        value += cur
+                        value.append(cur)
                     else:
                         raise SyntaxError("Invalid escape sequence \\{} in quote".format(cur))
                     has_backslash = False
@@ -142,78 +167,72 @@ class Tokenizer:
                 if cur == '\\':
                     has_backslash = True
                 elif cur == '"':
-                    return value
+                    return ''.join(value)
                 else:
-                    value += cur
+                    value.append(cur)
+
+        def read_keyword(keyword):
+            if not self.__startswith(keyword):
+                return False
+            self.__pos += len(keyword)
+            return True
 
         def read_end_control_group():
             # Arbitrary whitespace is allowed before end of the control group
             read_whitespace()
-            if not self.__to_lex.startswith('%}'):
+            if not read_keyword('%}'):
                 raise SyntaxError(
                     "Expected end of control group '%}' after control statement but didn't find it.")
-            self.__to_lex = self.__to_lex[2:]
 
         # Note: We want the longest match to win. Since we are doing prefix
         # matching that means we must test the longest strings which have
         # prefixes which are also valid tokens first.
-        if self.__to_lex.startswith('{{{{'):
-            self.__to_lex = self.__to_lex[4:]
+        if read_keyword('{{{{'):
             return "blob", "{{"
-        if self.__to_lex.startswith('{{{'):
+        if self.__startswith('{{{'):
             raise SyntaxError(
                 "{{{ is illegal. To make an argument substitution use " +
                 "{{ <identifier> }}. To make '{{' use '{{{{'. To make '{{{' " +
                 "use '{{{{{' (the first for become two, then the last is left" +
                 " alone since it is all alone)")
-        elif self.__to_lex.startswith('{%'):
+        elif read_keyword('{%'):
             # TODO(cmaloney): There is fairly specific parsing happening in control and ident rather
             # than doing what they probably _should_ be doing for generic parsing. There is some
             # duplicated code. That should be removed / refactored at some point.
             # switch <identifier>
             # case <string>
             # endswitch
-            self.__to_lex = self.__to_lex[2:]
 
             # Clean leading whitespace
             read_whitespace()
 
-            if self.__to_lex.startswith("switch"):
-                self.__to_lex = self.__to_lex[6:]
+            if read_keyword("switch"):
                 identifier = read_identifier()
                 read_end_control_group()
                 return "switch", identifier
-            elif self.__to_lex.startswith("case"):
-                self.__to_lex = self.__to_lex[4:]
+            elif read_keyword("case"):
                 value = read_str()
                 read_end_control_group()
                 return "case", value
-            elif self.__to_lex.startswith("endswitch"):
-                self.__to_lex = self.__to_lex[9:]
+            elif read_keyword("endswitch"):
                 read_end_control_group()
                 return "endswitch", None
-            elif self.__to_lex.startswith("for"):
-                self.__to_lex = self.__to_lex[3:]
+            elif read_keyword("for"):
                 new_var = read_identifier()
                 read_whitespace()
-                if not self.__to_lex.startswith("in"):
+                if not read_keyword("in"):
                     raise SyntaxError("Expected {% for foo in bar %}, didn't find the ' in'.")
-                self.__to_lex = self.__to_lex[2:]
                 iterable = read_identifier()
                 read_end_control_group()
                 return "for", (new_var, iterable)
-            elif self.__to_lex.startswith("endfor"):
-                self.__to_lex = self.__to_lex[6:]
+            elif read_keyword("endfor"):
                 read_end_control_group()
                 return "endfor", None
             else:
                 raise SyntaxError(
                     "Unknown control group directive. Expected switch, case, or endswitch.")
-        elif self.__to_lex.startswith("{{"):
+        elif read_keyword("{{"):
             # whitespace ident whitespace close_curly
-            # Clean of leading whitespace
-            self.__to_lex = self.__to_lex[2:]
-
             try:
                 identifier = read_identifier()
             except SyntaxError as ex:
@@ -228,21 +247,19 @@ class Tokenizer:
 
             # Optionally a filter expresion
             filter_id = None
-            if self.__to_lex.startswith('|'):
-                self.__to_lex = self.__to_lex[1:]
+            if read_keyword('|'):
                 filter_id = read_identifier()
                 read_whitespace()
 
             # Close curly braces
-            if not self.__to_lex.startswith('}}'):
+            if not read_keyword('}}'):
                 raise SyntaxError(
                     "Expected '}}' after '{{ <identifier>' but didn't find it.")
 
-            self.__to_lex = self.__to_lex[2:]
             return "replacement", (identifier, filter_id)
         else:
             # Was just a single open curly, we're a single curly blob
-            self.__to_lex = self.__to_lex[1:]
+            self.__pos += 1
             return "blob", "{"
 
 # Language:
@@ -307,68 +324,131 @@ class UnsetMarker:
     pass
 
 
-class Template:
-
-    def __init__(self, ast: list):
-        self.ast = ast
+def _get_argument(arguments, name):
+    try:
+        return arguments[name]
+    except KeyError as ex:
+        raise UnsetParameter("Unset parameter {}".format(name), name) from ex
+
+
+# A template AST is lowered once into a flat list of "ops". Each op is a function
+# `op(out, arguments, filters)` which appends the text it renders to the list `out`.
+# Rendering is then a single walk over the ops followed by one ''.join(), rather than
+# an AST walk building the result with repeated string concatenation.
+def _compile_blob(blob):
+    def render_blob(out, arguments, filters):
+        out.append(blob)
+    return render_blob
+
+
+def _compile_replacement(chunk):
+    identifier = chunk.identifier
+    filter_name = chunk.filter
+
+    if filter_name is None:
+        def render_replacement(out, arguments, filters):
+            out.append(str(_get_argument(arguments, identifier)))
+        return render_replacement
+
+    def render_filtered_replacement(out, arguments, filters):
+        value = _get_argument(arguments, identifier)
+        try:
+            filter_func = filters[filter_name]
+        except KeyError:
+            raise UnsetParameter("Unset filter parameter {}".format(filter_name), filter_name)
+        out.append(str(filter_func(value)))
+    return render_filtered_replacement
+
+
+def _compile_switch(chunk):
+    identifier = chunk.identifier
+    cases = {value: _compile_ast(sub_ast) for value, sub_ast in chunk.cases.items()}
+
+    def render_switch(out, arguments, filters):
+        choice = _get_argument(arguments, identifier)
+        if choice not in cases:
+            raise ValueError("switch %s: value `%s` is not in the set of handled cases" % (
+                identifier, choice))
+        cases[choice](out, arguments, filters)
+    return render_switch
+
+
+def _compile_for(chunk):
+    new_var = chunk.new_var
+    iterable_name = chunk.iterable
+    render_body = _compile_ast(chunk.body)
+
+    def render_for(out, arguments, filters):
+        # If the argument is a string, it should be a json list.
+        iterable = _get_argument(arguments, iterable_name)
+        # TODO(cmaloney): for should only be used (for now) in code which doesn't contain
+        # arbitrary user parameters.
+        # Stash the original state of the argument.
+        original_value = UnsetMarker()
+        if new_var in arguments:
+            original_value = arguments[new_var]
+
+        assert isinstance(iterable, list)
+        for value in iterable:
+            arguments[new_var] = value
+            render_body(out, arguments, filters)
+
+        # Reset the argument to the original state.
+        if isinstance(original_value, UnsetMarker):
+            del arguments[new_var]
+        else:
+            arguments[new_var] = original_value
+    return render_for
+
+
+def _compile_ast(ast):
+    ops = []
+    pending_blobs = []
+
+    def flush_blobs():
+        if pending_blobs:
+            ops.append(_compile_blob(''.join(pending_blobs)))
+            pending_blobs.clear()
+
+    for chunk in ast:
+        if isinstance(chunk, str):
+            # Adjacent blobs (e.g. '{' followed by text) are merged into a single op.
+            pending_blobs.append(chunk)
+            continue
+        flush_blobs()
+        if isinstance(chunk, Switch):
+            ops.append(_compile_switch(chunk))
+        elif isinstance(chunk, Replacement):
+            ops.append(_compile_replacement(chunk))
+        elif isinstance(chunk, For):
+            ops.append(_compile_for(chunk))
+        else:
+            raise NotImplementedError(
+                "Unknown chunk type {}".format(type(chunk)))
+    flush_blobs()
 
-    def render(self, arguments: dict, filters: dict={}):
+    def render_ops(out, arguments, filters):
+        for op in ops:
+            op(out, arguments, filters)
+    return render_ops
 
-        def get_argument(name):
-            try:
-                return arguments[name]
-            except KeyError as ex:
-                raise UnsetParameter("Unset parameter {}".format(name), name) from ex
 
-        def render_ast(ast):
-            rendered = ""
-            for chunk in ast:
-                if isinstance(chunk, Switch):
-                    choice = get_argument(chunk.identifier)
-                    if choice not in chunk.cases:
-                        raise ValueError("switch %s: value `%s` is not in the set of handled cases" % (
-                            chunk.identifier, choice))
-                    rendered += render_ast(chunk.cases[choice])
-                elif isinstance(chunk, Replacement):
-                    value = get_argument(chunk.identifier)
-                    if chunk.filter is None:
-                        rendered += str(value)
-                    else:
-                        try:
-                            filter_func = filters[chunk.filter]
-                        except KeyError:
-                            raise UnsetParameter("Unset filter parameter {}".format(chunk.filter), chunk.filter)
-                        rendered += str(filter_func(value))
-                elif isinstance(chunk, For):
-                    # If the argument is a string, it should be a json list.
-                    iterable = get_argument(chunk.iterable)
-                    # TODO(cmaloney): for should only be used (for now) in code which doesn't contain
-                    # arbitrary user parameters.
-                    # Stash the original state of the argument.
-                    original_value = UnsetMarker()
-                    if chunk.new_var in arguments:
-                        original_value = arguments[chunk.new_var]
-
-                    assert isinstance(iterable, list)
-                    for value in iterable:
-                        arguments[chunk.new_var] = value
-                        rendered += render_ast(chunk.body)
-
-                    # Reset the argument to the original state.
-                    if isinstance(original_value, UnsetMarker):
-                        del arguments[chunk.new_var]
-                    else:
-                        arguments[chunk.new_var] = original_value
+class Template:
 
-                elif isinstance(chunk, str):
-                    rendered += chunk
-                else:
-                    raise NotImplementedError(
-                        "Unknown chunk type {}".format(type(chunk)))
+    def __init__(self, ast: list):
+        self.ast = ast
+        self._render_func = None
 
-            return rendered
+    def compile(self):
+        """Lower the AST into a render function. The result is memoized on the template."""
+        if self._render_func is None:
+            self._render_func = _compile_ast(self.ast)
+        return self._render_func
 
-        return render_ast(self.ast)
+    def render(self, arguments: dict, filters: dict={}):
+        out = []
+        self.compile()(out, arguments, filters)
+        return ''.join(out)
 
     def target_from_ast(self):
         def variables_from_ast(ast, blacklist):
@@ -502,11 +582,28 @@ def parse_str(text):
     return Template(ast)
 
 
+# Process-wide cache of parsed and compiled templates keyed by (name, sha1 of content).
+# Keying on the content as well as the name means a locally modified template (e.g. a
+# gen_extra override) is never served stale.
+_template_cache = dict()
+
+
+def parse_cached(name, text):
+    """Parse and compile `text`, reusing the result of a previous call with the same name and content."""
+    key = (name, hashlib.sha1(text.encode()).hexdigest())
+    template = _template_cache.get(key)
+    if template is None:
+        template = parse_str(text)
+        template.compile()
+        _template_cache[key] = template
+    return template
+
+
 def parse_resources(filename):
     try:
-        return parse_str(resource_string(__name__, filename).decode())
+        return parse_cached(filename, resource_string(__name__, filename).decode())
     except SyntaxError as ex:
         # Don't accidentally overwrite a previously set filename. Shouldn't
         # happen since no code this calls sets ex.filename.
         assert not ex.filename
-        raise SyntaxError(ex.message, filename) from ex
+        raise SyntaxError(ex.message, filename, ex.line, ex.column) from ex
@@ -0,0 +1,51 @@
+"""
+Micro-benchmark for ``gen.template`` over every template shipped in ``gen``.
+
+Run with ``python -m gen.tests.benchmark_template [repeat]``. Each template is tokenized,
+parsed and rendered-compiled ``repeat`` times and the best time of each step is reported,
+so regressions in the tokenizer (e.g. accidentally quadratic lexing) show up per template.
+"""
+
+import os
+import sys
+import timeit
+
+import gen.template
+
+template_extensions = ('.yaml', '.json', '.html')
+
+
+def get_template_filenames():
+    """Return the paths, relative to the gen package, of all template files in gen."""
+    gen_dir = os.path.dirname(gen.template.__file__)
+    filenames = []
+    for dirpath, dirnames, files in os.walk(gen_dir):
+        dirnames[:] = sorted(d for d in dirnames if d not in ('tests', 'test', '__pycache__'))
+        for filename in sorted(files):
+            if filename.endswith(template_extensions):
+                filenames.append(os.path.relpath(os.path.join(dirpath, filename), gen_dir))
+    return filenames
+
+
+def benchmark_templates(repeat=5):
+    """Return a list of (filename, size, tokenize seconds, parse seconds) for each template in gen."""
+    gen_dir = os.path.dirname(gen.template.__file__)
+    results = []
+    for filename in get_template_filenames():
+        with open(os.path.join(gen_dir, filename)) as f:
+            text = f.read()
+        tokenize_time = min(timeit.repeat(lambda: gen.template.Tokenizer(text), number=1, repeat=repeat))
+        parse_time = min(timeit.repeat(lambda: gen.template.parse_str(text).compile(), number=1, repeat=repeat))
+        results.append((filename, len(text), tokenize_time, parse_time))
+    return results
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    print('{:<55} {:>9} {:>12} {:>12}'.format('template', 'bytes', 'tokenize ms', 'parse ms'))
+    for filename, size, tokenize_time, parse_time in benchmark_templates(repeat):
+        print('{:<55} {:>9} {:>12.3f} {:>12.3f}'.format(filename, size, tokenize_time * 1000, parse_time * 1000))
+
+
+if __name__ == '__main__':
+    main()
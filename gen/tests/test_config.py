@@ -951,6 +951,40 @@ def test_edited_ip_detect_script_yields_new_packages():
         assert initial_cluster_packages != edited_cluster_packages
 
 
+@pytest.mark.skipif(pkgpanda.util.is_windows, reason='TODO: Needs porting on Windows')
+def test_resolve_concurrently():
+    arguments = make_arguments(new_arguments={'dns_search': 'example.com'})
+    sources, targets, _ = gen.get_dcosconfig_source_target_and_templates(arguments, [], [])
+    sequential = gen.internals.resolve_configuration(sources, targets)
+
+    sources, targets, _ = gen.get_dcosconfig_source_target_and_templates(arguments, [], [])
+    concurrent = gen.internals.resolve_configuration(sources, targets, max_workers=4)
+
+    assert concurrent.status_dict == sequential.status_dict
+    assert gen.get_final_arguments(concurrent) == gen.get_final_arguments(sequential)
+    assert gen.get_config_id(gen.get_final_arguments(concurrent)) == \
+        gen.get_config_id(gen.get_final_arguments(sequential))
+    assert concurrent.late == sequential.late
+
+
+@pytest.mark.skipif(pkgpanda.util.is_windows, reason='TODO: Needs porting on Windows')
+def test_generate_many():
+    arguments_list = [
+        make_arguments(new_arguments={}),
+        make_arguments(new_arguments={'bootstrap_variant': 'ee', 'dns_search': 'example.com'}),
+        make_arguments(new_arguments={'master_list': '["52.37.192.49"]'}),
+    ]
+
+    generated_many = gen.generate_many(arguments_list)
+
+    assert len(generated_many) == len(arguments_list)
+    for arguments, generated in zip(arguments_list, generated_many):
+        expected = gen.generate(arguments)
+        assert generated.arguments == expected.arguments
+        assert generated.cluster_packages == expected.cluster_packages
+        assert generated.templates == expected.templates
+
+
 @pytest.mark.skipif(pkgpanda.util.is_windows, reason="configuration not present on windows")
 def test_validate_mesos_default_container_shm_size():
     validate_success({'mesos_default_container_shm_size': '64MB'})
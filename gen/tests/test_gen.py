@@ -2,6 +2,7 @@ import os
 import stat
 import tarfile
 import tempfile
+import time
 
 import pytest
 
@@ -112,6 +113,106 @@ def test_do_gen_package():
         ]})
 
 
+def test_do_gen_package_reproducible():
+    config = {'package': [
+        {
+            'path': '/etc/foo',
+            'content': 'foo',
+        },
+        {
+            'path': 'etc/bar/baz',
+            'content': 'baz',
+            'permissions': '0600',
+        },
+    ]}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        first_filename = os.path.join(tmpdir, 'first.tar.xz')
+        second_filename = os.path.join(tmpdir, 'second.tar.xz')
+
+        gen.do_gen_package(config, first_filename)
+        gen.do_gen_package(config, second_filename)
+        assert pkgpanda.util.sha1(second_filename) == pkgpanda.util.sha1(first_filename)
+
+        with tarfile.open(first_filename) as package_tarball:
+            assert package_tarball.getnames() == ['.', './etc', './etc/bar', './etc/bar/baz', './etc/foo']
+
+
+# TODO: DCOS_OSS-3461 - muted Windows tests requiring investigation
+@pytest.mark.skipif(pkgpanda.util.is_windows, reason="test fails on Windows reason unknown")
+def test_do_gen_package_cache(monkeypatch):
+    config = {'package': [
+        {
+            'path': '/etc/foo',
+            'content': 'foo',
+        },
+    ]}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cache_dir = os.path.join(tmpdir, 'cache')
+        first_filename = os.path.join(tmpdir, 'first.tar.xz')
+        second_filename = os.path.join(tmpdir, 'second.tar.xz')
+
+        gen.do_gen_package(config, first_filename, cache_dir)
+        assert os.listdir(cache_dir) == [os.path.basename(gen.util.package_cache_filename(cache_dir, config))]
+
+        # A package with the same contents is taken from the cache rather than built.
+        def fail_make_package(files, package_filename):
+            raise AssertionError('Package should have been taken from the cache')
+        monkeypatch.setattr(gen.util, 'write_pkgpanda_package', fail_make_package)
+        gen.do_gen_package(config, second_filename, cache_dir)
+        assert pkgpanda.util.sha1(second_filename) == pkgpanda.util.sha1(first_filename)
+
+        # Packages with other contents are still built.
+        with pytest.raises(AssertionError):
+            gen.do_gen_package({'package': [{'path': '/etc/foo', 'content': 'bar'}]}, second_filename, cache_dir)
+
+
+@pytest.mark.skipif(pkgpanda.util.is_windows, reason="test fails on Windows reason unknown")
+def test_prune_package_cache(tmpdir):
+    cache_dir = str(tmpdir.join('cache'))
+    first_config = {'package': [{'path': '/etc/foo', 'content': 'foo'}]}
+    second_config = {'package': [{'path': '/etc/foo', 'content': 'bar'}]}
+    gen.do_gen_package(first_config, str(tmpdir.join('first.tar.xz')), cache_dir)
+    gen.do_gen_package(second_config, str(tmpdir.join('second.tar.xz')), cache_dir)
+    first_cached = gen.util.package_cache_filename(cache_dir, first_config)
+    second_cached = gen.util.package_cache_filename(cache_dir, second_config)
+
+    # Age both packages past the limit, then use the first one again.
+    old = time.time() - gen.util.PACKAGE_CACHE_MAX_AGE - 60
+    for filename in (first_cached, second_cached):
+        os.utime(filename, (old, old))
+    gen.do_gen_package(first_config, str(tmpdir.join('third.tar.xz')), cache_dir)
+
+    gen.util.prune_package_cache(cache_dir)
+    assert os.listdir(cache_dir) == [os.path.basename(first_cached)]
+
+
+def test_load_dependency_graph(tmpdir, monkeypatch):
+    class Resolver:
+        dependency_graph = {'version': 1, 'arguments': {}}
+
+    path = str(tmpdir.join('state', 'graph.json'))
+    try:
+        monkeypatch.setenv('DCOS_IMAGE_COMMIT', 'commit_1')
+        gen.get_code_build_id.cache_clear()
+        gen.write_dependency_graph(path, Resolver)
+        assert gen.load_dependency_graph(path)['arguments'] == {}
+        assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+
+        # The graph of another installer is dropped.
+        monkeypatch.setenv('DCOS_IMAGE_COMMIT', 'commit_2')
+        gen.get_code_build_id.cache_clear()
+        assert gen.load_dependency_graph(path) is None
+
+        # So is the graph of a checkout.
+        monkeypatch.delenv('DCOS_IMAGE_COMMIT')
+        gen.get_code_build_id.cache_clear()
+        assert gen.load_dependency_graph(path) is None
+        gen.write_dependency_graph(path, Resolver)
+        assert gen.load_dependency_graph(path)['arguments'] == {}
+    finally:
+        gen.get_code_build_id.cache_clear()
+
+
 def test_extract_files_containing_late_variables():
     regular_config_files = [
         {
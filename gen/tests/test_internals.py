@@ -1,3 +1,4 @@
+import json
 from copy import deepcopy
 
 import pytest
@@ -5,6 +6,7 @@ import pytest
 import gen.internals
 from gen.exceptions import ValidationError
 from gen.internals import Scope, Source, Target
+from pkgpanda.util import hash_checkout
 
 
 def sample_fn_small():
@@ -146,3 +148,198 @@ def test_source_secrets():
     extra_secret_entry['secret'].append('d')
     with pytest.raises(Exception):
         Source(extra_secret_entry)
+
+
+def test_resolve_incremental():
+    calls = []
+
+    def calculate_e(b, c):
+        calls.append('e')
+        return b + c
+
+    def calculate_f(a):
+        calls.append('f')
+        return a + '_f'
+
+    calc_source = Source({
+        'must': {
+            'e': calculate_e,
+            'f': calculate_f,
+        },
+    })
+
+    def resolve(c, previous_graph=None):
+        user_source = Source(is_user=True)
+        user_source.add_must('c', c)
+        user_source.add_must('d_1_a', 'd_1_a_str')
+        target = get_test_target()
+        target.add_variable('e')
+        target.add_variable('f')
+        return gen.internals.resolve_configuration([test_source, calc_source, user_source], [target], previous_graph)
+
+    first = resolve('c_str')
+    assert first.status_dict == {'status': 'ok'}
+    assert first.reused == set()
+    assert sorted(calls) == ['e', 'f']
+    graph = first.dependency_graph
+    assert sorted(graph['arguments']['e']['dependencies']) == [
+        ['b', 'resolved', hash_checkout('"b_str"')],
+        ['c', 'resolved', hash_checkout('"c_str"')],
+    ]
+
+    # Nothing changed, so nothing is calculated again.
+    calls.clear()
+    second = resolve('c_str', graph)
+    assert calls == []
+    assert 'e' in second.reused and 'f' in second.reused
+    assert gen.get_final_arguments(second) == gen.get_final_arguments(first)
+
+    # Only the arguments downstream of the changed user argument are calculated again.
+    calls.clear()
+    third = resolve('c_new', second.dependency_graph)
+    assert calls == ['e']
+    assert gen.get_final_arguments(third) == gen.get_final_arguments(resolve('c_new'))
+    assert third.arguments['e'].value == 'b_strc_new'
+
+
+def test_resolve_incremental_volatile():
+    values = ['first']
+    volatile_source = Source({
+        'must': {
+            'v': gen.internals.volatile(lambda: values[-1]),
+            'w': lambda v: v + '_w',
+        },
+    })
+
+    def resolve(previous_graph=None):
+        return gen.internals.resolve_configuration([volatile_source], [Target({'w'})], previous_graph)
+
+    graph = resolve().dependency_graph
+    values.append('second')
+    resolver = resolve(graph)
+    assert 'v' not in resolver.reused
+    assert resolver.arguments['w'].value == 'second_w'
+
+
+def test_dependency_graph_secrets():
+    secret_source = Source({
+        'must': {
+            'password': 'hunter2',
+            'password_hash': lambda password: password[::-1],
+        },
+        'secret': ['password'],
+    })
+
+    def resolve(previous_graph=None):
+        return gen.internals.resolve_configuration([secret_source], [Target({'password_hash'})], previous_graph)
+
+    graph = resolve().dependency_graph
+    assert 'password' not in graph['arguments']
+    assert 'hunter2' not in json.dumps(graph)
+
+    # Arguments depending on a secret are still reused.
+    resolver = resolve(graph)
+    assert resolver.reused == {'password_hash'}
+    assert resolver.arguments['password_hash'].value == '2retnuh'
+
+
+def test_setter_index():
+    setter_source = Source({
+        'default': {
+            'x': 'x_default',
+        },
+        'conditional': {
+            'd': {
+                'd_1': {
+                    'must': {
+                        'x': 'x_d_1',
+                    },
+                    'conditional': {
+                        'e': {
+                            'e_1': {
+                                'must': {
+                                    'y': 'y_e_1',
+                                },
+                            },
+                        },
+                    },
+                },
+                'd_2': {
+                    'must': {
+                        'x': 'x_d_2',
+                    },
+                },
+            },
+        },
+    })
+    index = gen.internals.SetterIndex(setter_source.setters)
+    assert [setter.conditions for setter in index.all('x')] == [[], [('d', 'd_1')], [('d', 'd_2')]]
+    assert index.feasible('z', {}.__getitem__) == []
+
+    def feasible(name, switches):
+        resolved = list()
+
+        def resolve_switch(switch):
+            resolved.append(switch)
+            return switches[switch]
+
+        return [setter.conditions for setter in index.feasible(name, resolve_switch)], resolved
+
+    # Setters are returned in the order they were added, and every switch is resolved once.
+    assert feasible('x', {'d': 'd_2'}) == ([[], [('d', 'd_2')]], ['d'])
+    assert feasible('y', {'d': 'd_1', 'e': 'e_1'}) == ([[('d', 'd_1'), ('e', 'e_1')]], ['d', 'e'])
+
+    # Nested switches aren't resolved unless the cases above them match.
+    assert feasible('y', {'d': 'd_2'}) == ([], ['d'])
+
+
+def test_resolve_timings():
+    timing_source = Source({
+        'must': {
+            'a': 'a_str',
+            'b': lambda a: a + '_b',
+        },
+    })
+    resolver = gen.internals.resolve_configuration([timing_source], [Target({'b'})])
+    assert resolver.status_dict == {'status': 'ok'}
+    assert resolver.timings.keys() == {'a', 'b'}
+    assert all(seconds >= 0 for seconds in resolver.timings.values())
+
+
+def test_setter_index_components():
+    component_source = Source({
+        'must': {
+            'a': lambda b: b,
+            'b': 'b_str',
+            'c': 'c_str',
+        },
+        'conditional': {
+            'c': {
+                'c_str': {
+                    'must': {
+                        'd': 'd_str',
+                    },
+                },
+            },
+        },
+    })
+    components = gen.internals.SetterIndex(component_source.setters).components()
+    assert components.keys() == {'a', 'b', 'c', 'd'}
+    assert components['a'] == components['b']
+    assert components['c'] == components['d']
+    assert components['a'] != components['c']
+
+
+def test_resolve_concurrently():
+    test_user_source = Source(is_user=True)
+    test_user_source.add_must('c', 'c_str')
+    test_user_source.add_must('d_1_a', 'd_1_a_str')
+
+    def resolve(max_workers):
+        return gen.internals.resolve_configuration(
+            [test_source, test_user_source], [get_test_target()], max_workers=max_workers)
+
+    sequential = resolve(None)
+    concurrent = resolve(4)
+    assert concurrent.status_dict == sequential.status_dict == {'status': 'ok'}
+    assert gen.get_final_arguments(concurrent) == gen.get_final_arguments(sequential)
@@ -3,6 +3,7 @@ import pytest
 import gen.template
 from gen.internals import Scope, Target
 from gen.template import For, parse_str, Replacement, Switch, Tokenizer, UnsetParameter
+from gen.tests.benchmark_template import benchmark_templates
 
 
 just_text = "foo"
@@ -150,3 +151,43 @@ def test_render():
             "btcelsefoo")
     with pytest.raises(UnsetParameter):
         parse_str("{% for a in b %}{{ a }}{% endfor %}else{{ a }}").render({"b": ['b', 't', 'c']})
+
+
+def test_render_compiled_matches_ast():
+    text = ('a{% switch foo %}{% case "x" %}{{ a | up }}{ b{% for i in l %}{{ i }},{% endfor %}'
+            '{% case "y" %}y{% endswitch %}c')
+    template = parse_str(text)
+    render = template.compile()
+    assert template.compile() is render
+    assert template.render({'foo': 'x', 'a': 'q', 'l': ['1', '2']}, {'up': str.upper}) == 'aQ{ b1,2,c'
+    assert template.render({'foo': 'y'}) == 'ayc'
+    with pytest.raises(ValueError):
+        template.render({'foo': 'z'})
+
+
+def test_parse_cached():
+    gen.template._template_cache.clear()
+    template = gen.template.parse_cached('a.yaml', '{{ a }}')
+    assert gen.template.parse_cached('a.yaml', '{{ a }}') is template
+    assert gen.template.parse_cached('b.yaml', '{{ a }}') is not template
+    assert gen.template.parse_cached('a.yaml', '{{ b }}') is not template
+    assert gen.template.parse_resources('dcos-config.yaml') is gen.template.parse_resources('dcos-config.yaml')
+
+
+def test_syntax_error_position():
+    with pytest.raises(gen.template.SyntaxError) as exinfo:
+        get_tokens("a\nbc {{ test}}\n")
+    assert exinfo.value.line == 2
+    assert exinfo.value.column == 11
+    assert 'line 2 column 11' in exinfo.value.message
+
+    # Errors at the very end of the text are syntax errors rather than index errors.
+    with pytest.raises(gen.template.SyntaxError):
+        get_tokens("{{")
+    with pytest.raises(gen.template.SyntaxError):
+        get_tokens("{{ a")
+
+
+def test_tokenize_all_templates():
+    results = benchmark_templates(repeat=1)
+    assert {filename for filename, _, _, _ in results} >= {'dcos-config.yaml', 'cloud-config.yaml'}
@@ -1,10 +1,29 @@
+import gzip
+import io
+import json
 import logging
 import os
 import os.path
+import shutil
+import tarfile
+import time
 
 from tempfile import TemporaryDirectory
+from typing import Dict, Tuple
 
-from pkgpanda.util import make_tar
+from pkgpanda.util import hash_checkout, is_windows, make_tar
+
+# Bump when the way packages are built from their config changes, so packages cached before
+# aren't reused.
+PACKAGE_CACHE_VERSION = '2'
+
+# Seconds after which cached packages which haven't been built or used since are removed by
+# prune_package_cache().
+PACKAGE_CACHE_MAX_AGE = 14 * 24 * 60 * 60
+
+# Modification time of every entry of packages written by write_pkgpanda_package(), so the same
+# files always give a byte-for-byte identical package.
+PACKAGE_MTIME = 0
 
 
 def pkgpanda_package_tmpdir():
@@ -24,3 +43,110 @@ def make_pkgpanda_package(contents_dir, package_filename):
 
     make_tar(package_filename, contents_dir)
     logging.info("Package filename: %s", package_filename)
+
+
+def _package_tarinfo(name, mode, type=tarfile.REGTYPE, size=0):
+    info = tarfile.TarInfo(name)
+    info.type = type
+    info.mode = mode
+    info.size = size
+    info.mtime = PACKAGE_MTIME
+    info.uid = info.gid = 0
+    info.uname = info.gname = 'root'
+    return info
+
+
+def write_pkgpanda_package(files: Dict[str, Tuple[bytes, int]], package_filename):
+    """Write a package containing files straight into the tarball package_filename.
+
+    files maps the path of every file relative to the package root to its content and mode. Files
+    and the directories containing them are written in sorted order, directories with mode 0755,
+    with the same owner and mtime, so the same files always give the same package. The package is
+    the same as pkgpanda.util.make_tar() would make of the files written out to a directory.
+    """
+    paths = dict()
+    for path, (content, mode) in files.items():
+        parts = tuple(part for part in path.split('/') if part)
+        assert parts, "Package files must have a name: {!r}".format(path)
+        assert paths.get(parts, ()) is not None, "{} is both a file and a directory".format(path)
+        paths[parts] = (content, mode)
+        for depth in range(1, len(parts)):
+            assert paths.get(parts[:depth]) is None, "{} is both a file and a directory".format('/'.join(parts[:depth]))
+            paths[parts[:depth]] = None
+
+    # Ensure the output directory exists
+    if os.path.dirname(package_filename):
+        os.makedirs(os.path.dirname(package_filename), exist_ok=True)
+
+    if is_windows:
+        # gzip records the current time in its header unless told otherwise.
+        fileobj = gzip.GzipFile(package_filename, mode='wb', mtime=PACKAGE_MTIME)
+        tar = tarfile.open(fileobj=fileobj, mode='w')
+    else:
+        fileobj = None
+        tar = tarfile.open(name=package_filename, mode='w:xz')
+
+    try:
+        tar.addfile(_package_tarinfo('.', 0o755, tarfile.DIRTYPE))
+        for parts in sorted(paths):
+            name = './' + '/'.join(parts)
+            if paths[parts] is None:
+                tar.addfile(_package_tarinfo(name, 0o755, tarfile.DIRTYPE))
+            else:
+                content, mode = paths[parts]
+                tar.addfile(_package_tarinfo(name, mode, size=len(content)), io.BytesIO(content))
+    finally:
+        tar.close()
+        if fileobj is not None:
+            fileobj.close()
+    logging.info("Package filename: %s", package_filename)
+
+
+def package_cache_filename(cache_dir, config):
+    """Return the filename a package built from config is cached as in cache_dir.
+
+    The name is a hash of the package contents, so packages with the same contents share it
+    regardless of their package id.
+    """
+    key = hash_checkout({
+        'version': PACKAGE_CACHE_VERSION,
+        'config': json.dumps(config, sort_keys=True),
+    })
+    return os.path.join(cache_dir, key + '.tar.xz')
+
+
+def link_or_copy(src, dest):
+    """Hard link src to dest, copying it if it can't be linked (e.g. it's on another filesystem)."""
+    if os.path.dirname(dest):
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+    if os.path.lexists(dest):
+        os.remove(dest)
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copyfile(src, dest)
+
+
+def add_to_package_cache(package_filename, cached_filename):
+    # Link into place atomically so a concurrent reader never sees a partial package.
+    tmp_filename = '{}.{}.tmp'.format(cached_filename, os.getpid())
+    link_or_copy(package_filename, tmp_filename)
+    os.replace(tmp_filename, cached_filename)
+
+
+def prune_package_cache(cache_dir, max_age=PACKAGE_CACHE_MAX_AGE):
+    """Remove the packages in cache_dir which haven't been built or used for max_age seconds.
+
+    do_gen_package() bumps the modification time of a cached package whenever it's used.
+    """
+    if not os.path.isdir(cache_dir):
+        return
+    cutoff = time.time() - max_age
+    for entry in os.scandir(cache_dir):
+        if entry.is_file() and entry.stat().st_mtime < cutoff:
+            logging.debug("Removing unused cached package %s", entry.path)
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                # Removed by a concurrent prune.
+                pass
@@ -9,24 +9,33 @@ Each package contains a pkginfo.json. That contains a list of requires as well a
 environment variables from the package.
 
 """
+import copy
 import json
 import os
 import os.path
+import random
 import re
 import shutil
+import tarfile
 import tempfile
+import threading
+import time
 from collections import Iterable
 from itertools import chain
 from subprocess import CalledProcessError, check_call, check_output
 from typing import Union
 
+import requests
+
 from pkgpanda.constants import (DCOS_SERVICE_CONFIGURATION_FILE,
                                 RESERVED_UNIT_NAMES,
                                 STATE_DIR_ROOT)
-from pkgpanda.exceptions import (InstallError, PackageError, PackageNotFound,
+from pkgpanda.exceptions import (FetchError, InstallError, PackageError, PackageNotFound,
                                  ValidationError)
-from pkgpanda.util import (download, extract_tarball, if_exists, is_windows,
-                           load_json, make_directory, remove_directory, write_json, write_string)
+from pkgpanda.util import (CONTENT_DIGEST_EXTENSION, download, DOWNLOAD_CHUNK_SIZE, extract_tarball,
+                           get_content_digest, get_requests_retry_session, get_tarball_content_digest, if_exists,
+                           is_windows, load_json, load_string, make_directory, remove_directory, write_json,
+                           write_string)
 
 if not is_windows:
     import grp
@@ -364,7 +373,7 @@ def validate_compatible(packages, roles):
 
 
 # TODO(cmaloney): Add a github fetcher, useful for grabbing config tarballs.
-def requests_fetcher(base_url, id_str, target, work_dir):
+def requests_fetcher(base_url, id_str, target, work_dir, session=None):
     assert base_url
     assert type(id_str) == str
     id = PackageId(id_str)
@@ -376,15 +385,119 @@ def requests_fetcher(base_url, id_str, target, work_dir):
     # TODO(cmaloney): Use a private tmp directory so there is no chance of a user
     # intercepting the tarball + other validation data locally.
     with tempfile.NamedTemporaryFile(suffix=".tar.xz") as file:
-        download(file.name, url, work_dir, rm_on_error=False)
-        extract_tarball(file.name, target)
+        download(file.name, url, work_dir, rm_on_error=False, session=session)
+        return extract_tarball(file.name, target)
+
+
+def requests_content_digest(base_url, id_str, work_dir, session=None):
+    """Return the content digest the build published for the package id_str at base_url.
+
+    Returns None if there's none, e.g. because the package was built before they were published.
+    See pkgpanda.util.write_content_digest().
+    """
+    id = PackageId(id_str)
+    url = base_url.rstrip('/') + "/packages/{0}/{1}{2}".format(id.name, id_str, CONTENT_DIGEST_EXTENSION)
+    with tempfile.NamedTemporaryFile(suffix=CONTENT_DIGEST_EXTENSION) as file:
+        try:
+            download(file.name, url, work_dir, rm_on_error=False, session=session)
+        except FetchError as ex:
+            print("No content digest for {}: {}".format(id_str, ex))
+            return None
+        return load_string(file.name).strip() or None
+
+
+# Header of the package tarballs the pkgpanda HTTP API serves to its peers. Holds the content digest
+# the package had when it was added to the peer's repository.
+PEER_DIGEST_HEADER = 'X-Pkgpanda-Content-Digest'
+
+# Seconds to wait for a peer to connect and between reads from it.
+PEER_TIMEOUT = (3, 30)
+
+
+def peer_fetcher(peer_urls, id_str, target, expected_digest, session=None, unreachable_peers=None):
+    """Fetch the package id_str into target from one of the pkgpanda HTTP APIs at peer_urls.
+
+    The peers are tried in random order so the nodes fetching from them spread the load. The first
+    one serving the package with expected_digest wins. It must come from a trusted source such as
+    requests_content_digest(), the digest peers advertise is only used to skip a peer early. A peer's
+    tarball is checked against it before anything is extracted.
+    Returns expected_digest, or None if no peer could provide the package. Peers which couldn't be
+    reached are added to unreachable_peers, and peers in it are skipped. The default session doesn't
+    retry requests, as there's another place to fetch the package from.
+    """
+    session = session or get_requests_retry_session(max_retries=0)
+    unreachable_peers = unreachable_peers if unreachable_peers is not None else set()
+    for peer_url in random.sample(peer_urls, len(peer_urls)):
+        if peer_url in unreachable_peers:
+            continue
+        url = '{}/repository/{}/tarball'.format(peer_url.rstrip('/'), id_str)
+        try:
+            with tempfile.NamedTemporaryFile(suffix=".tar.gz") as file:
+                r = session.get(url, stream=True, timeout=PEER_TIMEOUT)
+                try:
+                    r.raise_for_status()
+                    if r.headers.get(PEER_DIGEST_HEADER, expected_digest) != expected_digest:
+                        print("Peer {} has a different package {}".format(peer_url, id_str))
+                        continue
+                    for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                        file.write(chunk)
+                finally:
+                    r.close()
+                file.flush()
+                # The tarball is only extracted once it's known to hold the expected files.
+                if get_tarball_content_digest(file.name) != expected_digest:
+                    print("Package {} from peer {} doesn't match its content digest".format(id_str, peer_url))
+                    continue
+                digest = extract_tarball(file.name, target)
+        except requests.exceptions.ConnectionError as ex:
+            print("Unable to reach peer {}: {}".format(peer_url, ex))
+            unreachable_peers.add(peer_url)
+            continue
+        except (requests.exceptions.RequestException, tarfile.TarError, CalledProcessError, OSError,
+                ValidationError) as ex:
+            print("Unable to fetch {} from peer {}: {}".format(id_str, peer_url, ex))
+            continue
+
+        if digest == expected_digest:
+            return digest
+        print("Package {} from peer {} doesn't match its content digest".format(id_str, peer_url))
+        remove_directory(target)
+    return None
 
 
 class Repository:
+    """A local package repository, a folder with a folder per package id.
+
+    The package ids, their parsed PackageIds and pkginfos are indexed in memory and kept up to date by add() and
+    remove(). If index_file is given the index is also stored there, and reused by later Repository objects for as
+    long as the repository folder isn't modified. The stored pkginfos are trusted, so index_file must be somewhere only
+    the repository's owner can write, like INDEX_DIR in the repository itself.
+    """
 
-    def __init__(self, path):
+    INDEX_VERSION = 1
+
+    # Folder in the repository holding the content digest of each package, recorded by add().
+    DIGESTS_DIR = '.digests'
+
+    # Folder in the repository to keep an index_file in. Files in it don't change the repository folder's mtime.
+    INDEX_DIR = '.index'
+
+    # The repository folder's mtime doesn't change for a modification within the same tick, so an index of a folder
+    # modified this recently isn't stored.
+    RACY_WINDOW_NS = 2 * 10 ** 9
+
+    def __init__(self, path, index_file=None):
         self.__path = os.path.abspath(path)
+        self.__index_file = index_file
+        self.__lock = threading.RLock()
+        # Set of package ids, replaced rather than modified so list() callers can hold on to it.
         self.__packages = None
+        # Package id -> PackageId, or None if the id doesn't parse.
+        self.__ids = None
+        # Package name -> set of package ids.
+        self.__names = None
+        # Package id -> pkginfo
+        self.__pkginfos = None
 
     @property
     def path(self):
@@ -394,8 +507,9 @@ class Repository:
         return os.path.join(self.__path, id)
 
     def get_ids(self, name):
-        # TODO(cmaloney): There is a lot of excess re-parsing here...
-        return list(pkg_id for pkg_id in self.list() if PackageId(pkg_id).name == name)
+        with self.__lock:
+            self._load_index()
+            return list(self.__names.get(name, ()))
 
     def has_package(self, id):
         return id in self.list()
@@ -404,29 +518,139 @@ class Repository:
         """List the available packages in the repository.
 
         A package is a folder which contains a pkginfo.json"""
-        if self.__packages is not None:
+        with self.__lock:
+            self._load_index()
             return self.__packages
 
-        packages = set()
-        if not os.path.exists(self.__path):
-            return packages
+    def _get_mtime_ns(self):
+        try:
+            return os.stat(self.__path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _load_index(self):
+        if self.__packages is not None:
+            return
+
+        mtime_ns = self._get_mtime_ns()
+        pkginfos = dict()
+        packages = None
+        if self.__index_file and mtime_ns is not None:
+            try:
+                if not self._is_trusted_index_file():
+                    raise ValueError('Index file {} is writable by other users.'.format(self.__index_file))
+                index = load_json(self.__index_file)
+                if (index.get('version') == self.INDEX_VERSION and index['path'] == self.__path and
+                        index['mtime_ns'] == mtime_ns):
+                    packages = set(index['packages'])
+                    pkginfos = {id: pkginfo for id, pkginfo in index['pkginfos'].items() if id in packages}
+            except (OSError, ValueError, AttributeError, KeyError, TypeError):
+                # A missing or unreadable index just means the repository is listed again.
+                pass
+
+        if packages is None:
+            packages = set()
+            if mtime_ns is not None:
+                for id in os.listdir(self.__path):
+                    if PackageId.is_id(id):
+                        packages.add(id)
 
-        for id in os.listdir(self.__path):
-            if PackageId.is_id(id):
-                packages.add(id)
         self.__packages = packages
-        return self.__packages
+        self.__pkginfos = pkginfos
+        self.__ids = dict()
+        self.__names = dict()
+        for id in packages:
+            self._index_id(id)
+        self._save_index()
+
+    def _is_trusted_index_file(self):
+        if is_windows:
+            return True
+        stat = os.stat(self.__index_file)
+        return stat.st_uid == os.geteuid() and not stat.st_mode & 0o022
+
+    def _index_id(self, id):
+        try:
+            pkg_id = PackageId(id)
+        except ValidationError:
+            pkg_id = None
+        self.__ids[id] = pkg_id
+        if pkg_id is not None:
+            self.__names.setdefault(pkg_id.name, set()).add(id)
+        return pkg_id
+
+    def _update_index(self, id, added):
+        with self.__lock:
+            if self.__packages is None:
+                return
+            if added:
+                if id in self.__packages:
+                    return
+                self.__packages = self.__packages | {id}
+                self._index_id(id)
+            else:
+                self.__packages = self.__packages - {id}
+                pkg_id = self.__ids.pop(id, None)
+                if pkg_id is not None:
+                    self.__names[pkg_id.name].discard(id)
+                    if not self.__names[pkg_id.name]:
+                        del self.__names[pkg_id.name]
+                self.__pkginfos.pop(id, None)
+            self._save_index()
+
+    def _save_index(self):
+        if not self.__index_file:
+            return
+        mtime_ns = self._get_mtime_ns()
+        if mtime_ns is None or mtime_ns >= int(time.time() * 10 ** 9) - self.RACY_WINDOW_NS:
+            return
+        index_dir = os.path.dirname(os.path.abspath(self.__index_file))
+        if not os.path.exists(index_dir):
+            make_directory(index_dir)
+            # Creating INDEX_DIR modifies the repository folder, in which case the index is stored next time.
+            if self._get_mtime_ns() != mtime_ns:
+                return
+        tmp_filename = '{}.{}.tmp'.format(self.__index_file, os.getpid())
+        os.close(os.open(tmp_filename, os.O_WRONLY | os.O_CREAT, 0o600))
+        os.chmod(tmp_filename, 0o600)
+        write_json(tmp_filename, {
+            'version': self.INDEX_VERSION,
+            'path': self.__path,
+            'mtime_ns': mtime_ns,
+            'packages': sorted(self.__packages),
+            'pkginfos': self.__pkginfos})
+        os.replace(tmp_filename, self.__index_file)
+
+    def _get_package_id(self, id):
+        with self.__lock:
+            self._load_index()
+            pkg_id = self.__ids.get(id)
+        if pkg_id is None:
+            # Not indexed, or invalid. Raises for an invalid id.
+            pkg_id = PackageId(id)
+        return pkg_id
 
     # Load the given package
     def load(self, id: str):
+        package, indexed = self._load(id)
+        if indexed:
+            self._save_index()
+        return package
 
+    def _load(self, id):
+        # Returns the package and whether its pkginfo was newly added to the index.
         # Validate the package id.
-        PackageId(id)
+        pkg_id = self._get_package_id(id)
 
         path = self.package_path(id)
         if not os.path.exists(path):
             raise PackageNotFound(id)
 
+        with self.__lock:
+            pkginfo = self.__pkginfos.get(id)
+        if pkginfo is not None:
+            return Package(path, pkg_id, copy.deepcopy(pkginfo)), False
+
         filename = os.path.join(path, "pkginfo.json")
         try:
             pkginfo = load_json(filename)
@@ -436,22 +660,50 @@ class Repository:
         if not isinstance(pkginfo, dict):
             raise PackageError("Usage should be a dictionary, not a {0}".format(type(pkginfo).__name__))
 
-        return Package(path, id, pkginfo)
+        with self.__lock:
+            indexed = id in self.__ids
+            if indexed:
+                self.__pkginfos[id] = copy.deepcopy(pkginfo)
+        return Package(path, pkg_id, pkginfo), indexed
 
     def load_packages(self, ids: Iterable):
         packages = set()
+        indexed = False
         for id in ids:
-            packages.add(self.load(id))
+            package, package_indexed = self._load(id)
+            packages.add(package)
+            indexed = indexed or package_indexed
+        if indexed:
+            self._save_index()
         return packages
 
+    def _digest_path(self, id):
+        return os.path.join(self.__path, self.DIGESTS_DIR, id)
+
+    def get_digest(self, id):
+        """Return the content digest the package had when it was added, or None if it wasn't recorded."""
+        return if_exists(load_string, self._digest_path(id))
+
     def integrity_check(self):
-        # Check that all packages in the local repository have valid
-        # signatures, are up to date, all packages valid contents, etc.
-        raise NotImplementedError()
+        """Return the ids of the packages whose files changed since they were added.
+
+        Packages are checked against the content digest the fetcher returned when they were added,
+        see pkgpanda.util.get_content_digest(). Packages added without one aren't checked.
+        """
+        # TODO(cmaloney): Check that all packages in the local repository have valid
+        # signatures, are up to date, etc.
+        changed = []
+        for id in sorted(self.list()):
+            digest = self.get_digest(id)
+            if digest is not None and get_content_digest(self.package_path(id)) != digest:
+                changed.append(id)
+        return changed
 
     # Add the given package to the repository.
     # If the package is already in the repository does a no-op and returns false.
     # Returns true otherwise.
+    # If the fetcher returns the content digest of the package (extract_tarball() does) it's recorded
+    # for integrity_check().
     def add(self, fetcher, id, warn_added=True):
         # Validate the package id.
         PackageId(id)
@@ -461,6 +713,7 @@ class Repository:
         if os.path.exists(package_path):
             if warn_added:
                 print("Package already added.")
+            self._update_index(id, True)
             return False
 
         # TODO(cmaloney): Supply a temporary directory to extract to
@@ -478,15 +731,26 @@ class Repository:
         # package extractions.
         remove_directory(tmp_path)
 
-        fetcher(id, tmp_path)
+        digest = fetcher(id, tmp_path)
+        digest_path = self._digest_path(id)
+        if isinstance(digest, str):
+            make_directory(os.path.dirname(digest_path))
+            write_string(digest_path, digest)
+        elif os.path.exists(digest_path):
+            os.remove(digest_path)
         shutil.move(tmp_path, pkg_path)
+        self._update_index(id, True)
         return True
 
     def remove(self, id):
         path = self.package_path(id)
         if not os.path.exists(path):
+            self._update_index(id, False)
             raise PackageNotFound(id)
         remove_directory(path)
+        if os.path.exists(self._digest_path(id)):
+            os.remove(self._digest_path(id))
+        self._update_index(id, False)
 
 
 class ConflictingFile(ValidationError):
@@ -528,6 +792,69 @@ def symlink_tree(src, dest):
                 raise ConflictingFile(src_path, dest_path, ex) from ex
 
 
+class _StaleLinkFarm(Exception):
+    """Raised when an active link farm doesn't match the packages which built it."""
+
+
+def _get_link_source(target, sources, package_paths):
+    # Walk up from the link target to the source folder it was linked from.
+    path = target
+    while True:
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+        if path in sources:
+            return path
+        if path in package_paths:
+            # Linked from a folder of the package which isn't linked anymore (a role changed).
+            raise _StaleLinkFarm(target)
+
+
+def _copy_link_farm(src, dest, sources, package_paths):
+    """Copy the links into sources out of the folder src made by symlink_tree into dest.
+
+    sources are the folders which are still linked into dest, package_paths the packages they belong to. Links into
+    other folders of package_paths mean src wasn't made from the same folders and raise _StaleLinkFarm, links anywhere
+    else (such as into packages which aren't kept) are dropped. Links are copied as
+    hardlinks where possible, which only adds a directory entry rather than a new inode. Regular files aren't part of
+    the link farm and aren't copied. Folders left empty which none of sources has are removed.
+    """
+    for root, dirs, files in os.walk(src):
+        rel = os.path.relpath(root, src)
+        dest_root = os.path.normpath(os.path.join(dest, rel))
+        make_directory(dest_root)
+        for name in chain(dirs, files):
+            src_path = os.path.join(root, name)
+            if not os.path.islink(src_path):
+                continue
+            if _get_link_source(os.readlink(src_path), sources, package_paths) is None:
+                continue
+            dest_path = os.path.join(dest_root, name)
+            try:
+                os.link(src_path, dest_path, follow_symlinks=False)
+            except (NotImplementedError, OSError):
+                os.symlink(os.readlink(src_path), dest_path)
+
+    for root, dirs, files in os.walk(dest, topdown=False):
+        if root == dest or os.listdir(root):
+            continue
+        rel = os.path.relpath(root, dest)
+        if not any(os.path.isdir(os.path.join(source, rel)) for source in sources):
+            os.rmdir(root)
+
+    # Every source must have been linked into src.
+    for source in sources:
+        for name in os.listdir(source):
+            src_path = os.path.join(source, name)
+            dest_path = os.path.join(dest, name)
+            if os.path.isdir(src_path) and not os.path.islink(src_path):
+                if not os.path.isdir(dest_path):
+                    raise _StaleLinkFarm(src_path)
+            elif not os.path.islink(dest_path) or os.readlink(dest_path) != src_path:
+                raise _StaleLinkFarm(src_path)
+
+
 # Manages a systemd-sysusers user set.
 # Can have users
 class UserManagement:
@@ -758,7 +1085,54 @@ class Install:
             ]))
     # Builds new working directories for the new active set, then swaps it into place as atomically as possible.
 
-    def activate(self, packages):
+    def _get_link_sources(self, package, dir_name):
+        # The package folder and its folders for the machine roles, in the order they're linked.
+        sources = [os.path.join(package.path, dir_name)]
+        sources += [os.path.join(package.path, "{0}_{1}".format(dir_name, role)) for role in self.__roles]
+        return [source for source in sources if os.path.isdir(source)]
+
+    def _reuse_link_farms(self, packages, new_dirs):
+        """Copy the links of the packages staying active from the active folders into new_dirs.
+
+        Returns a dict from each new folder which was filled this way to the names of the packages already linked into
+        it. The systemd folder is always rebuilt since its links are rewritten to the staged unit files.
+        """
+        active_dir = self.get_active_dir()
+        if not os.path.isdir(active_dir):
+            return {}
+        active_paths = dict()
+        for name in os.listdir(active_dir):
+            path = os.path.join(active_dir, name)
+            if os.path.islink(path):
+                active_paths[name] = os.readlink(path)
+        kept = [package for package in packages if active_paths.get(package.name) == package.path]
+        # Links into the packages being replaced or removed are dropped, only the kept packages have to match the
+        # folders they're linked from.
+        package_paths = {package.path for package in kept}
+
+        reused = dict()
+        for new, dir_name in zip(new_dirs, self.__well_known_dirs):
+            active = self._make_abs(dir_name)
+            if dir_name == self.__systemd_dir or not os.path.isdir(active):
+                continue
+            dir_name = os.path.basename(dir_name)
+            sources = set(chain.from_iterable(self._get_link_sources(package, dir_name) for package in kept))
+            try:
+                _copy_link_farm(active, new, sources, package_paths)
+            except _StaleLinkFarm:
+                # Start over, linking every package.
+                remove_directory(new)
+                os.makedirs(new)
+                continue
+            reused[new] = {package.name for package in kept}
+        return reused
+
+    def activate(self, packages, incremental=False):
+        """Activate the package set packages.
+
+        With incremental the links of the packages which stay active are copied from the currently active folders
+        instead of being recreated, only the packages which changed are linked.
+        """
         # Ensure the new set is reasonable.
         validate_compatible(packages, self.__roles)
 
@@ -788,11 +1162,7 @@ class Install:
         for name in new_dirs:
             os.makedirs(name)
 
-        def symlink_all(src, dest):
-            if not os.path.isdir(src):
-                return
-
-            symlink_tree(src, dest)
+        reused_dirs = self._reuse_link_farms(packages, new_dirs) if incremental else {}
 
         # Set the new LD_LIBRARY_PATH, PATH.
         env_contents = env_header.format("/opt/mesosphere" if self.__fake_path else self.__root)
@@ -829,19 +1199,17 @@ class Install:
             # Do the basename since some well known dirs are full paths (dcos.target.wants)
             # while inside the packages they are always top level directories.
             for new, dir_name in zip(new_dirs, self.__well_known_dirs):
+                if package.name in reused_dirs.get(new, ()):
+                    continue
                 dir_name = os.path.basename(dir_name)
-                pkg_dir = os.path.join(package.path, dir_name)
 
                 assert os.path.isabs(new)
-                assert os.path.isabs(pkg_dir)
+                assert os.path.isabs(package.path)
 
                 try:
-                    symlink_all(pkg_dir, new)
-
-                    # Symlink all applicable role-based config
-                    for role in self.__roles:
-                        role_dir = os.path.join(package.path, "{0}_{1}".format(dir_name, role))
-                        symlink_all(role_dir, new)
+                    # Symlink the package folder and all applicable role-based config
+                    for source in self._get_link_sources(package, dir_name):
+                        symlink_tree(source, new)
 
                 except ConflictingFile as ex:
                     raise ValidationError("Two packages are trying to install the same file {0} or "
@@ -2,26 +2,32 @@ import logging
 import os
 import sys
 import tempfile
+from collections import OrderedDict
+from concurrent.futures import as_completed, ThreadPoolExecutor
 from subprocess import CalledProcessError, check_call
 from typing import List
 
 from gen import do_gen_package, resolve_late_package
-from pkgpanda import PackageId, requests_fetcher
+from pkgpanda import PackageId, peer_fetcher, requests_content_digest, requests_fetcher
 from pkgpanda.constants import (DCOS_SERVICE_CONFIGURATION_PATH,
                                 install_root,
                                 SYSCTL_SETTING_KEY)
 from pkgpanda.exceptions import FetchError, PackageConflict, ValidationError
-from pkgpanda.util import (download, extract_tarball, if_exists, load_json,
-                           load_string, load_yaml, write_string)
+from pkgpanda.util import (download, extract_tarball, get_requests_retry_session,
+                           if_exists, load_json, load_string, load_yaml, write_string)
 
 DCOS_TARGET_CONTENTS = """[Install]
 WantedBy=multi-user.target
 """
 
+# Number of packages downloaded and extracted at the same time while
+# bootstrapping a host.
+FETCH_WORKERS = 8
+
 log = logging.getLogger(__name__)
 
 
-def activate_packages(install, repository, package_ids, systemd, block_systemd):
+def activate_packages(install, repository, package_ids, systemd, block_systemd, incremental=False):
     """Replace the active package set with package_ids.
 
     install: pkgpanda.Install
@@ -29,14 +35,15 @@ def activate_packages(install, repository, package_ids, systemd, block_systemd):
     package_ids: sequence of package IDs to activate
     systemd: start/stop systemd services
     block_systemd: if systemd, block waiting for systemd services to come up
+    incremental: reuse the links of the packages which stay active
 
     """
-    install.activate(repository.load_packages(package_ids))
+    install.activate(repository.load_packages(package_ids), incremental)
     if systemd:
         _start_dcos_target(block_systemd)
 
 
-def swap_active_package(install, repository, package_id, systemd, block_systemd):
+def swap_active_package(install, repository, package_id, systemd, block_systemd, incremental=False):
     """Replace an active package with a package_id with the same name.
 
     swap(install, repository, 'foo--version') will replace the active 'foo'
@@ -47,6 +54,7 @@ def swap_active_package(install, repository, package_id, systemd, block_systemd)
     package_id: package ID to activate
     systemd: start/stop systemd services
     block_systemd: if systemd, block waiting for systemd services to come up
+    incremental: reuse the links of the packages which stay active
 
     """
     active = install.get_active()
@@ -64,7 +72,7 @@ def swap_active_package(install, repository, package_id, systemd, block_systemd)
     packages_by_name[new_id.name] = new_id
     new_active = list(map(str, packages_by_name.values()))
     # Activate with the new package name
-    activate_packages(install, repository, new_active, systemd, block_systemd)
+    activate_packages(install, repository, new_active, systemd, block_systemd, incremental)
 
 
 def fetch_package(repository, repository_url, package_id, work_dir):
@@ -116,7 +124,7 @@ def add_package_file(repository, package_filename):
     PackageId(pkg_id)
 
     def fetch(_, target):
-        extract_tarball(package_filename, target)
+        return extract_tarball(package_filename, target)
 
     repository.add(fetch, pkg_id)
 
@@ -207,15 +215,60 @@ def _get_package_list(package_list_id: str, repository_url: str) -> List[str]:
     return package_list
 
 
+def fetch_packages(repository, fetcher, package_ids, max_workers=FETCH_WORKERS):
+    """Add each of package_ids which isn't already in repository using fetcher.
+
+    Up to max_workers packages are fetched at once. Every package is
+    downloaded and extracted by a single worker so the extraction of one
+    package overlaps with the downloads of the others. Repository.add keeps
+    swapping each package into place from its own `_tmp` folder, so a failed
+    fetch never leaves a partially extracted package behind. The first failure
+    cancels the fetches which haven't started yet and is re-raised once the
+    running ones are done.
+    """
+    missing = [id for id in OrderedDict.fromkeys(package_ids) if not repository.has_package(id)]
+    if not missing:
+        return
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(missing)))) as executor:
+        futures = {executor.submit(repository.add, fetcher, id, warn_added=False): id for id in missing}
+        try:
+            for future in as_completed(futures):
+                future.result()
+                log.info("Fetched package %s", futures[future])
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+
 def _do_bootstrap(install, repository):
     # These files should be set by the environment which initially builds
     # the host (cloud-init).
     repository_url = if_exists(load_string, install.get_config_filename("setup-flags/repository-url"))
 
+    # pkgpanda HTTP APIs of other nodes to try fetching packages from before the repository url.
+    peer_urls = if_exists(load_json, install.get_config_filename("setup-flags/repository-peers")) or []
+    if not isinstance(peer_urls, list) or not all(isinstance(url, str) for url in peer_urls):
+        raise ValidationError("setup-flags/repository-peers must be a JSON list of urls. Got: {}".format(peer_urls))
+
+    # One connection pool shared by all the package fetches.
+    session = get_requests_retry_session(pool_maxsize=FETCH_WORKERS)
+    # Peers aren't retried, the repository url is there to fall back to.
+    peer_session = get_requests_retry_session(max_retries=0, pool_maxsize=FETCH_WORKERS)
+    unreachable_peers = set()
+
     def fetcher(id, target):
+        if peer_urls and repository_url is not None:
+            # Peers are only trusted to serve the package with the digest published next to it.
+            expected_digest = requests_content_digest(repository_url, id, os.getcwd(), session=session)
+            if expected_digest is not None:
+                digest = peer_fetcher(peer_urls, id, target, expected_digest, peer_session, unreachable_peers)
+                if digest is not None:
+                    return digest
         if repository_url is None:
             raise ValidationError("ERROR: Non-local package {} but no repository url given.".format(id))
-        return requests_fetcher(repository_url, id, target, os.getcwd())
+        return requests_fetcher(repository_url, id, target, os.getcwd(), session=session)
 
     setup_pkg_dir = install.get_config_filename("setup-packages")
     if os.path.exists(setup_pkg_dir):
@@ -270,8 +323,7 @@ def _do_bootstrap(install, repository):
 
         # Ensure all packages are local
         print("Ensuring all packages in active set {} are local".format(",".join(to_activate)))
-        for package in to_activate:
-            repository.add(fetcher, package)
+        fetch_packages(repository, fetcher, to_activate)
     else:
         print("Calculated active packages from bootstrap tarball")
         to_activate = list(install.get_active())
@@ -284,16 +336,15 @@ def _do_bootstrap(install, repository):
             cluster_packages = _get_package_list(package_list_id, repository_url)
             print("Loading cluster-packages: {}".format(cluster_packages))
 
+            # Validate the package ids
             for package_id_str in cluster_packages:
-                # Validate the package ids
-                pkg_id = PackageId(package_id_str)
+                PackageId(package_id_str)
 
-                # Fetch the packages if not local
-                if not repository.has_package(package_id_str):
-                    repository.add(fetcher, package_id_str)
+            # Fetch the packages which aren't local
+            fetch_packages(repository, fetcher, cluster_packages)
 
-                # Add the package to the set to activate
-                setup_packages_to_activate.append(package_id_str)
+            # Add the packages to the set to activate
+            setup_packages_to_activate += cluster_packages
         else:
             print("No cluster-packages specified")
 
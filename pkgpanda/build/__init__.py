@@ -1,16 +1,20 @@
+import collections
 import copy
+import io
 import json
 import multiprocessing
 import os
 import random
-import shutil
 import string
 import tempfile
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from contextlib import contextmanager
 from os import chdir, getcwd, mkdir
 from os.path import exists
 from subprocess import CalledProcessError, check_call, check_output
 
+import requests
+
 import pkgpanda.build.constants
 import pkgpanda.build.src_fetchers
 from pkgpanda import expand_require as expand_require_exceptions
@@ -18,10 +22,20 @@ from pkgpanda import Install, PackageId, Repository
 from pkgpanda.actions import add_package_file
 from pkgpanda.constants import install_root, PKG_DIR, RESERVED_UNIT_NAMES
 from pkgpanda.exceptions import FetchError, PackageError, ValidationError
-from pkgpanda.util import (check_forbidden_services, download_atomic,
-                           hash_checkout, is_windows, load_json, load_string, logger,
-                           make_directory, make_file, make_tar, remove_directory, rewrite_symlinks, write_json,
-                           write_string)
+from pkgpanda.util import (check_forbidden_services, content_digest_filename, download_atomic,
+                           get_requests_retry_session, hash_checkout, is_windows, load_json, load_string, logger,
+                           make_directory, make_file, make_tar, remove_directory, rewrite_symlinks, tracer,
+                           write_content_digest, write_json, write_string)
+
+
+# Environment variable with the default number of packages build_tree() builds at the same time.
+BUILD_JOBS_ENV_VAR = 'PKGPANDA_BUILD_JOBS'
+
+# Number of packages plan_tree() looks up in the repository at the same time.
+PLAN_REPOSITORY_WORKERS = 8
+
+# Number of files hash_files_in_folder() hashes at the same time.
+HASH_WORKERS = 4
 
 
 class BuildError(Exception):
@@ -264,9 +278,11 @@ class PackageStore:
         # Load an upstream if one exists
         # TODO(cmaloney): Allow upstreams to have upstreams
         self._package_cache_dir = self._packages_dir + "/cache/packages"
+        self._hash_cache = pkgpanda.util.FileHashCache(self._packages_dir + "/cache/file_hashes.json")
         self._upstream_dir = self._packages_dir + "/cache/upstream/checkout"
         self._upstream = None
         self._upstream_package_dir = self._upstream_dir + "/packages"
+        self._source_cache_dir = self._packages_dir + "/cache/sources"
         # TODO(cmaloney): Make it so the upstream directory can be kept around
         remove_directory(self._upstream_dir)
         upstream_config = self._packages_dir + '/upstream.json'
@@ -274,7 +290,7 @@ class PackageStore:
             try:
                 self._upstream = get_src_fetcher(
                     load_optional_json(upstream_config),
-                    self._packages_dir + '/cache/upstream',
+                    self._source_cache_dir,
                     packages_dir)
                 self._upstream.checkout_to(self._upstream_dir)
                 if os.path.exists(self._upstream_package_dir + "/upstream.json"):
@@ -325,6 +341,10 @@ class PackageStore:
     def get_package_folder(self, name):
         return self._package_folders[name]
 
+    def get_source_cache_dir(self):
+        """Directory of the source cache shared by all packages (see pkgpanda.build.src_fetchers)."""
+        return self._source_cache_dir
+
     def get_bootstrap_cache_dir(self):
         return self._packages_dir + "/cache/bootstrap"
 
@@ -378,6 +398,11 @@ class PackageStore:
     def packages(self):
         return self._packages
 
+    @property
+    def hash_cache(self):
+        """Cache of the hashes of the files in the packages' extra folders."""
+        return self._hash_cache
+
     @property
     def builders(self):
         return self._builders.copy()
@@ -390,18 +415,36 @@ class PackageStore:
     def packages_dir(self):
         return self._packages_dir
 
+    def _get_package_url(self, pkg_id: PackageId):
+        return self._repository_url + '/packages/{0}/{1}.tar.xz'.format(pkg_id.name, pkg_id)
+
+    def has_remote_package(self, pkg_id: PackageId, session=None):
+        """Return whether the package is available from repository_url, without downloading it."""
+        if self._repository_url is None:
+            return False
+
+        url = self._get_package_url(pkg_id)
+        if url.startswith('file://'):
+            return os.path.exists(url[len('file://'):])
+        try:
+            response = (session or get_requests_retry_session()).head(url, allow_redirects=True)
+        except requests.exceptions.RequestException:
+            return False
+        return response.status_code == 200
+
     def try_fetch_by_id(self, pkg_id: PackageId):
         if self._repository_url is None:
             return False
 
         # TODO(cmaloney): Use storage providers to download instead of open coding.
         pkg_path = "{}.tar.xz".format(pkg_id)
-        url = self._repository_url + '/packages/{0}/{1}'.format(pkg_id.name, pkg_path)
+        url = self._get_package_url(pkg_id)
         try:
             directory = self.get_package_cache_folder(pkg_id.name)
             # TODO(cmaloney): Move to some sort of logging mechanism?
             print("Attempting to download", pkg_id, "from", url, "to", directory)
-            download_atomic(directory + '/' + pkg_path, url, directory)
+            with tracer.span('Fetch package {}'.format(pkg_id), 'fetch'):
+                download_atomic(directory + '/' + pkg_path, url, directory)
             assert os.path.exists(directory + '/' + pkg_path)
             return directory + '/' + pkg_path
         except FetchError:
@@ -419,10 +462,11 @@ class PackageStore:
             active_url = self._repository_url + '/bootstrap/' + active_name
             print("Attempting to download", bootstrap_name, "from", bootstrap_url)
             dest_dir = self.get_bootstrap_cache_dir()
-            # Normalize to no trailing slash for repository_url
-            download_atomic(dest_dir + '/' + bootstrap_name, bootstrap_url, self._packages_dir)
-            print("Attempting to download", active_name, "from", active_url)
-            download_atomic(dest_dir + '/' + active_name, active_url, self._packages_dir)
+            with tracer.span('Fetch bootstrap {}'.format(bootstrap_id), 'fetch'):
+                # Normalize to no trailing slash for repository_url
+                download_atomic(dest_dir + '/' + bootstrap_name, bootstrap_url, self._packages_dir)
+                print("Attempting to download", active_name, "from", active_url)
+                download_atomic(dest_dir + '/' + active_name, active_url, self._packages_dir)
             return True
         except FetchError:
             return False
@@ -439,9 +483,12 @@ def get_docker_id(docker_name):
     return check_output(["docker", "inspect", "-f", "{{ .Id }}", docker_name]).decode('utf-8').strip()
 
 
-def hash_files_in_folder(directory):
+def hash_files_in_folder(directory, work_dir=None, hash_cache=None):
     """Given a relative path, hashes all files inside that folder and subfolders
 
+    The path is relative to work_dir, or the current working directory if work_dir is None. Files
+    are hashed on HASH_WORKERS threads, through hash_cache (a pkgpanda.util.FileHashCache) if given.
+
     Returns a dictionary from filename to the hash of that file. If that whole
     dictionary is hashed, you get a hash of all the contents of the folder.
 
@@ -452,15 +499,20 @@ def hash_files_in_folder(directory):
         "For the hash to be reproducible on other machines relative paths must always be used. " \
         "Got path: {}".format(directory)
     directory = directory.rstrip('/')
+    # Walk work_dir/directory rather than changing the working directory so hashing is safe to do
+    # from multiple threads at once. The hashed names are relative to directory either way.
+    if work_dir is not None:
+        directory = work_dir + '/' + directory
     file_hash_dict = {}
+    file_paths = {}
     # TODO(cmaloney): Disallow symlinks as they're hard to hash, people can symlink / copy in their
     # build steps if needed.
     for root, dirs, filenames in os.walk(directory):
-        assert not root.startswith('/')
+        assert work_dir is not None or not root.startswith('/')
         for name in filenames:
             path = root + '/' + name
             base = path[len(directory) + 1:]
-            file_hash_dict[base] = pkgpanda.util.sha1(path)
+            file_paths[base] = path
 
         # If the directory has files inside of it, then it'll be picked up implicitly. by the files
         # or folders inside of it. If it contains nothing, it wouldn't be picked up but the existence
@@ -472,6 +524,10 @@ def hash_files_in_folder(directory):
             if path:
                 file_hash_dict[root[len(directory) + 1:]] = ""
 
+    sha1 = hash_cache.sha1 if hash_cache is not None else pkgpanda.util.sha1
+    with ThreadPoolExecutor(max_workers=HASH_WORKERS) as executor:
+        file_hash_dict.update(zip(file_paths.keys(), executor.map(sha1, file_paths.values())))
+
     return file_hash_dict
 
 
@@ -483,16 +539,15 @@ def as_cwd(path):
     chdir(start_dir)
 
 
-def hash_folder_abs(directory, work_dir):
+def hash_folder_abs(directory, work_dir, hash_cache=None):
     assert directory.startswith(work_dir), "directory must be inside work_dir: {} {}".format(directory, work_dir)
     assert not work_dir[-1] == '/', "This code assumes no trailing slash on the work_dir"
 
-    with as_cwd(work_dir):
-        return hash_folder(directory[len(work_dir) + 1:])
+    return hash_folder(directory[len(work_dir) + 1:], work_dir, hash_cache)
 
 
-def hash_folder(directory):
-    return hash_checkout(hash_files_in_folder(directory))
+def hash_folder(directory, work_dir=None, hash_cache=None):
+    return hash_checkout(hash_files_in_folder(directory, work_dir, hash_cache))
 
 
 # Try to read json from the given file. If it is an empty file, then return an
@@ -531,6 +586,59 @@ def load_buildinfo(path, variant):
     return buildinfo
 
 
+def _tar_name(path):
+    # Names in the bootstrap tarball are relative to /opt/mesosphere, the same as make_tar() makes.
+    return './' if path == '.' else './' + path
+
+
+def _bootstrap_tarinfo(tarinfo):
+    # Everything in the bootstrap tarball is owned by root.
+    tarinfo.uid = tarinfo.gid = 0
+    tarinfo.uname = tarinfo.gname = 'root'
+    return tarinfo
+
+
+# Files activating a package reads the contents of. Every other file of a package is only
+# symlinked to by the activation.
+_ACTIVATION_METADATA_FILES = {'pkginfo.json', 'buildinfo.full.json'}
+
+
+def _add_bootstrap_package(tar, pkg_path, pkg_id, skeleton_dir):
+    """Copy the members of the package tarball pkg_path into tar under packages/<pkg_id>.
+
+    Alongside, the package's skeleton is made at skeleton_dir: its directories, symlinks and
+    metadata files, with empty files in place of all other files.
+
+    """
+    prefix = 'packages/' + pkg_id
+    with pkgpanda.util.open_tar_stream(pkg_path) as package_tar:
+        for member in package_tar:
+            path = os.path.normpath(member.name)
+            if os.path.isabs(path) or path == '..' or path.startswith('../'):
+                raise BuildError("Package {} has a file outside of the package: {}".format(pkg_path, member.name))
+            skeleton_path = skeleton_dir if path == '.' else os.path.join(skeleton_dir, path)
+            fileobj = None
+
+            if member.isdir():
+                make_directory(skeleton_path)
+            elif member.issym():
+                os.symlink(member.linkname, skeleton_path)
+            elif member.isfile() and path in _ACTIVATION_METADATA_FILES:
+                data = package_tar.extractfile(member).read()
+                with open(skeleton_path, 'wb') as f:
+                    f.write(data)
+                fileobj = io.BytesIO(data)
+            else:
+                make_file(skeleton_path)
+                if member.isfile():
+                    fileobj = package_tar.extractfile(member)
+
+            if member.islnk():
+                member.linkname = _tar_name(prefix + '/' + os.path.normpath(member.linkname))
+            member.name = _tar_name(prefix if path == '.' else prefix + '/' + path)
+            tar.addfile(_bootstrap_tarinfo(member), fileobj)
+
+
 def make_bootstrap_tarball(package_store, packages, variant):
     # Convert filenames to package ids
     pkg_ids = list()
@@ -578,60 +686,145 @@ def make_bootstrap_tarball(package_store, packages, variant):
 
     print("Creating bootstrap tarball for variant {}".format(variant))
 
+    # The packages are copied straight from their tarballs into the bootstrap tarball. Only a
+    # skeleton of each package (its directories, symlinks, metadata and empty placeholders for
+    # all other files) is extracted, which is all activating the packages needs. The activation
+    # is then added to the bootstrap tarball with its symlinks pointing into /opt/mesosphere.
     work_dir = tempfile.mkdtemp(prefix='mkpanda_bootstrap_tmp')
+    try:
+        pkgpanda_root = os.path.join(work_dir, "opt/mesosphere")
+        make_directory(os.path.join(pkgpanda_root, "packages"))
+
+        tmp_name = bootstrap_name + '.tmp'
+        with pkgpanda.util.open_tar_writer(tmp_name) as tar:
+            def add_skeleton_dir(path):
+                tarinfo = tar.gettarinfo(os.path.join(pkgpanda_root, path), _tar_name(path))
+                tar.addfile(_bootstrap_tarinfo(tarinfo))
+
+            add_skeleton_dir('.')
+            add_skeleton_dir('packages')
+            for pkg_path, pkg_id in zip(packages, pkg_ids):
+                _add_bootstrap_package(tar, pkg_path, pkg_id, os.path.join(pkgpanda_root, 'packages', pkg_id))
+
+            # Activate the packages inside the repository.
+            # Do generate dcos.target.wants inside the root so that we don't
+            # try messing with /etc/systemd/system.
+            install = Install(
+                root=pkgpanda_root,
+                config_dir=None,
+                rooted_systemd=True,
+                manage_systemd=False,
+                block_systemd=True,
+                fake_path=True,
+                skip_systemd_dirs=True,
+                manage_users=False,
+                manage_state_dir=False)
+            install.activate(Repository(os.path.join(pkgpanda_root, "packages")).load_packages(pkg_ids))
+
+            # Mark the tarball as a bootstrap tarball/filesystem so that
+            # dcos-setup.service will fire.
+            make_file(os.path.join(pkgpanda_root, "bootstrap"))
+
+            # Add the activation, with all the symlinks rewritten to point to /opt/mesosphere
+            def rewrite_symlink(tarinfo):
+                if tarinfo.issym() and tarinfo.linkname.startswith(pkgpanda_root + '/'):
+                    tarinfo.linkname = install_root + tarinfo.linkname[len(pkgpanda_root):]
+                return _bootstrap_tarinfo(tarinfo)
+
+            for name in sorted(os.listdir(pkgpanda_root)):
+                if name != 'packages':
+                    tar.add(os.path.join(pkgpanda_root, name), _tar_name(name), filter=rewrite_symlink)
+        os.replace(tmp_name, bootstrap_name)
+    finally:
+        remove_directory(work_dir)
 
-    def make_abs(path):
-        return os.path.join(work_dir, path)
+    # Write out an active.json for the bootstrap tarball
+    write_json(active_name, pkg_ids)
 
-    pkgpanda_root = make_abs("opt/mesosphere")
-    repository = Repository(os.path.join(pkgpanda_root, "packages"))
+    # Update latest last so that we don't ever use partially-built things.
+    write_string(latest_name, bootstrap_id)
 
-    # Fetch all the packages to the root
-    for pkg_path in packages:
-        filename = os.path.basename(pkg_path)
-        pkg_id = filename[:-len(".tar.xz")]
+    print("Built bootstrap")
+    return mark_latest()
 
-        def local_fetcher(id, target):
-            shutil.unpack_archive(pkg_path, target, "gztar")
-        repository.add(local_fetcher, pkg_id, False)
 
-    # Activate the packages inside the repository.
-    # Do generate dcos.target.wants inside the root so that we don't
-    # try messing with /etc/systemd/system.
-    install = Install(
-        root=pkgpanda_root,
-        config_dir=None,
-        rooted_systemd=True,
-        manage_systemd=False,
-        block_systemd=True,
-        fake_path=True,
-        skip_systemd_dirs=True,
-        manage_users=False,
-        manage_state_dir=False)
-    install.activate(repository.load_packages(pkg_ids))
+def get_build_jobs(jobs=None):
+    """Return how many packages build_tree() builds at the same time.
 
-    # Mark the tarball as a bootstrap tarball/filesystem so that
-    # dcos-setup.service will fire.
-    make_file(make_abs("opt/mesosphere/bootstrap"))
+    If jobs is None it's taken from the PKGPANDA_BUILD_JOBS environment variable, and defaults to 1.
+    """
+    if jobs is None:
+        jobs = os.environ.get(BUILD_JOBS_ENV_VAR) or 1
+    try:
+        if int(jobs) >= 1:
+            return int(jobs)
+    except ValueError:
+        pass
+    raise BuildError("The number of build jobs must be a positive integer. Got {}".format(jobs))
 
-    # Write out an active.json for the bootstrap tarball
-    write_json(active_name, pkg_ids)
 
-    # Rewrite all the symlinks to point to /opt/mesosphere
-    rewrite_symlinks(work_dir, work_dir, "/")
+def build_packages(package_store, build_order, jobs=1):
+    """Build the (name, variant) package tuples in build_order.
 
-    make_tar(bootstrap_name, pkgpanda_root)
+    build_order must list every package after its requires. A package is built as soon as all its
+    requires are, with up to jobs packages building at the same time. Variants of the same package
+    share a cache folder so they're never built at the same time. Ready packages are started in
+    build_order order, so with one job the packages are built exactly in build_order.
 
-    remove_directory(work_dir)
+    The first build which fails stops any new builds from starting. Its error is raised once the
+    builds already running are done.
 
-    # Update latest last so that we don't ever use partially-built things.
-    write_string(latest_name, bootstrap_id)
+    Returns a dict mapping package names to a dict of variants to the built package paths.
+    """
+    requires = {
+        pkg_tuple: set(expand_require(r) for r in package_store.packages[pkg_tuple]['requires'])
+        for pkg_tuple in build_order}
+    pending = list(build_order)
+    running = dict()
+    built = set()
+    built_packages = dict()
+    error = None
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        while pending or running:
+            if error is None:
+                building_names = set(name for name, _ in running.values())
+                for pkg_tuple in list(pending):
+                    if len(running) >= jobs:
+                        break
+                    if pkg_tuple[0] in building_names or not requires[pkg_tuple] <= built:
+                        continue
+                    pending.remove(pkg_tuple)
+                    building_names.add(pkg_tuple[0])
+                    # TODO(cmaloney): Only build the requested variants, rather than all variants.
+                    running[executor.submit(
+                        tracer.propagate(build), package_store, pkg_tuple[0], pkg_tuple[1], True)] = pkg_tuple
+
+            if not running:
+                # Only reachable after a failure, as build_order always has a buildable package.
+                assert error is not None
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name, variant = running.pop(future)
+                try:
+                    pkg_path = future.result()
+                except Exception as ex:
+                    print("Building package {} variant {} failed".format(name, pkgpanda.util.variant_name(variant)))
+                    if error is None:
+                        error = ex
+                    continue
+                built.add((name, variant))
+                built_packages.setdefault(name, dict())[variant] = pkg_path
 
-    print("Built bootstrap")
-    return mark_latest()
+    if error is not None:
+        raise error
+
+    return built_packages
 
 
-def build_tree_variants(package_store, mkbootstrap):
+def build_tree_variants(package_store, mkbootstrap, jobs=None):
     """ Builds all possible tree variants in a given package store
     """
     result = dict()
@@ -639,23 +832,18 @@ def build_tree_variants(package_store, mkbootstrap):
     if len(tree_variants) == 0:
         raise Exception('No treeinfo.json can be found in {}'.format(package_store.packages_dir))
     for variant in tree_variants:
-        result[variant] = pkgpanda.build.build_tree(package_store, mkbootstrap, variant)
+        result[variant] = pkgpanda.build.build_tree(package_store, mkbootstrap, variant, jobs)
     return result
 
 
-def build_tree(package_store, mkbootstrap, tree_variants):
-    """Build packages and bootstrap tarballs for one or all tree variants.
-
-    Returns a dict mapping tree variants to bootstrap IDs.
+def get_build_order(package_store, package_sets):
+    """Return the (name, variant) of the packages in package_sets and all they require.
 
-    If tree_variant is None, builds all available tree variants.
+    Every package comes after the packages it requires.
 
     """
     # TODO(cmaloney): Add support for circular dependencies. They are doable
     # long as there is a pre-built version of enough of the packages.
-
-    # TODO(cmaloney): Make it so when we're building a treeinfo which has a
-    # explicit package list we don't build all the other packages.
     build_order = list()
     visited = set()
     built = set()
@@ -710,27 +898,122 @@ def build_tree(package_store, mkbootstrap, tree_variants):
                 continue
             visit(pkg_tuple)
 
-    if tree_variants:
-        package_sets = [package_store.get_package_set(v) for v in tree_variants]
-    else:
-        package_sets = package_store.get_all_package_sets()
-
     with logger.scope("resolve package graph"):
         # Build all required packages for all tree variants.
         for package_set in package_sets:
             visit_packages(package_set.all_packages)
 
-    built_packages = dict()
-    for (name, variant) in build_order:
-        built_packages.setdefault(name, dict())
+    return build_order
 
-        # Run the build, store the built package path for later use.
-        # TODO(cmaloney): Only build the requested variants, rather than all variants.
-        built_packages[name][variant] = build(
-            package_store,
+
+def plan_tree(package_store, tree_variants, docker_ids=None, check_repository=True):
+    """Compute the id of every package build_tree() would build, without building anything.
+
+    The ids are computed from the same inputs _build() uses: the source ids from the buildinfo, the
+    build script, the extra folder, the docker image id and the ids of the required packages (which
+    are planned first rather than read from their last build). docker_ids maps docker image names
+    to ids, images not in it are looked up with `docker inspect` but never pulled.
+
+    Returns a list of dicts in build order with:
+    - name, variant: the package.
+    - id: the package id. None if the docker image of the package, or of a package it requires,
+      isn't available locally.
+    - cached: whether the package is in the local package cache.
+    - in_repository: whether the package is available from repository_url (always False without a
+      repository_url). None if not checked because the package is cached or check_repository is
+      False.
+
+    """
+    build_order = get_build_order(package_store, get_package_sets(package_store, tree_variants))
+    docker_ids = dict() if docker_ids is None else dict(docker_ids)
+
+    def get_package_id(name, variant):
+        buildinfo = package_store.get_buildinfo(name, variant)
+        package_dir = package_store.get_package_folder(name)
+
+        fetchers = get_src_fetchers(package_store, name, get_sources(name, buildinfo))
+        checkout_ids = {src_name: fetcher.get_id() for src_name, fetcher in fetchers.items()}
+
+        docker_name = buildinfo['docker']
+        if docker_name not in docker_ids:
+            try:
+                docker_ids[docker_name] = get_docker_id(docker_name)
+            except (CalledProcessError, OSError):
+                print("Docker image {} isn't available locally, can't compute the ids of the packages "
+                      "built with it".format(docker_name))
+                docker_ids[docker_name] = None
+
+        requires_ids = set(
+            package_ids[pkg_tuple] for pkg_tuple in get_transitive_requires(package_store, buildinfo['requires']))
+        if docker_ids[docker_name] is None or None in requires_ids:
+            return None
+
+        extra_dir = package_dir + '/extra'
+        extra_id = None
+        if os.path.exists(extra_dir):
+            extra_id = hash_folder_abs(extra_dir, package_dir, package_store.hash_cache)
+
+        _, version = get_build_ids(
+            buildinfo,
             name,
             variant,
-            True)
+            checkout_ids,
+            pkgpanda.util.sha1(package_dir + '/' + buildinfo['build_script']),
+            extra_id,
+            docker_ids[docker_name],
+            requires_ids)
+        return str(PackageId.from_parts(name, version))
+
+    package_ids = dict()
+    plan = list()
+    for name, variant in build_order:
+        pkg_id = get_package_id(name, variant)
+        package_ids[(name, variant)] = pkg_id
+        plan.append({
+            'name': name,
+            'variant': variant,
+            'id': pkg_id,
+            'cached': pkg_id is not None and os.path.exists(package_store.get_package_path(PackageId(pkg_id))),
+            'in_repository': None})
+    package_store.hash_cache.save()
+
+    # Look up the packages which aren't cached locally concurrently, they are independent requests.
+    if check_repository:
+        to_check = [entry for entry in plan if entry['id'] is not None and not entry['cached']]
+        with get_requests_retry_session(pool_maxsize=PLAN_REPOSITORY_WORKERS) as session, \
+                ThreadPoolExecutor(max_workers=PLAN_REPOSITORY_WORKERS) as executor:
+            found = executor.map(
+                lambda entry: package_store.has_remote_package(PackageId(entry['id']), session),
+                to_check)
+            for entry, in_repository in zip(to_check, found):
+                entry['in_repository'] = in_repository
+
+    return plan
+
+
+def get_package_sets(package_store, tree_variants):
+    if tree_variants:
+        return [package_store.get_package_set(v) for v in tree_variants]
+    return package_store.get_all_package_sets()
+
+
+def build_tree(package_store, mkbootstrap, tree_variants, jobs=None):
+    """Build packages and bootstrap tarballs for one or all tree variants.
+
+    Returns a dict mapping tree variants to bootstrap IDs.
+
+    If tree_variant is None, builds all available tree variants.
+
+    Independent packages are built at the same time, up to jobs (see get_build_jobs()) at once.
+
+    """
+    # TODO(cmaloney): Make it so when we're building a treeinfo which has a
+    # explicit package list we don't build all the other packages.
+    package_sets = get_package_sets(package_store, tree_variants)
+    build_order = get_build_order(package_store, package_sets)
+
+    # Run the builds, store the built package paths for later use.
+    built_packages = build_packages(package_store, build_order, get_build_jobs(jobs))
 
     # Build bootstrap tarballs for all tree variants.
     def make_bootstrap(package_set):
@@ -827,13 +1110,144 @@ class IdBuilder():
         return self._buildinfo
 
 
+def get_sources(name, buildinfo):
+    """Return the sources of a package, converting a single_source to sources."""
+    if 'sources' in buildinfo:
+        if 'single_source' in buildinfo:
+            raise BuildError('Both sources and single_source cannot be specified at the same time')
+        return copy.deepcopy(buildinfo['sources'])
+    elif 'single_source' in buildinfo:
+        return {name: copy.deepcopy(buildinfo['single_source'])}
+    return dict()
+
+
+def get_src_fetchers(package_store, name, sources):
+    """Return the source fetchers of the sources of package name by source name."""
+    fetchers = dict()
+    try:
+        for src_name, src_info in sorted(sources.items()):
+            fetchers[src_name] = get_src_fetcher(
+                src_info,
+                package_store.get_source_cache_dir(),
+                package_store.get_package_folder(name))
+    except ValidationError as ex:
+        raise BuildError("Validation error when fetching sources for package: {}".format(ex))
+    return fetchers
+
+
+def get_transitive_requires(package_store, requires):
+    """Return the (name, variant) of the packages in requires and all the packages they require.
+
+    Raises BuildError if two variants of the same package are required.
+
+    """
+    if type(requires) != list:
+        raise BuildError("`requires` in buildinfo.json must be an array of dependencies.")
+    to_check = copy.deepcopy(requires)
+    requires_variants = collections.OrderedDict()
+    while to_check:
+        requires_name, requires_variant = expand_require(to_check.pop(0))
+
+        if requires_name in requires_variants:
+            # TODO(cmaloney): If one package depends on the <default>
+            # variant of a package and 1+ others depends on a non-<default>
+            # variant then update the dependency to the non-default variant
+            # rather than erroring.
+            if requires_variant != requires_variants[requires_name]:
+                # TODO(cmaloney): Make this contain the chains of
+                # dependencies which contain the conflicting packages.
+                # a -> b -> c -> d {foo}
+                # e {bar} -> d {baz}
+                raise BuildError(
+                    "Dependncy on multiple variants of the same package {}. variants: {} {}".format(
+                        requires_name,
+                        requires_variant,
+                        requires_variants[requires_name]))
+
+            # The variant has package {requires_name, variant} already is a
+            # dependency, don't process it again / move on to the next.
+            continue
+
+        requires_variants[requires_name] = requires_variant
+
+        # Add the dependencies of the package to the set which will be
+        # activated.
+        # TODO(cmaloney): All these 'transitive' dependencies shouldn't
+        # be available to the package being built, only what depends on
+        # them directly.
+        to_check += package_store.get_buildinfo(requires_name, requires_variant)['requires']
+
+    return list(requires_variants.items())
+
+
+def get_build_ids(buildinfo, name, variant, checkout_ids, build_script_sha1, extra_id, docker_id, requires_ids):
+    """Return the build ids and the version of a package.
+
+    The build ids are the buildinfo with the sources, build script, docker image and requires
+    replaced by the ids of what they resolved to. The version is the hash of the build ids.
+
+    """
+    builder = IdBuilder(buildinfo)
+    builder.add('name', name)
+    builder.add('variant', pkgpanda.util.variant_str(variant))
+
+    # Convert single_source -> sources
+    if builder.has('sources'):
+        builder.take('sources')
+    elif builder.has('single_source'):
+        builder.replace('single_source', 'sources', {name: builder.take('single_source')})
+    else:
+        builder.add('sources', {})
+
+    # Add the sha1 of the buildinfo.json + build file to the build ids
+    builder.update('sources', checkout_ids)
+    builder.take('build_script')
+    # TODO(cmaloney): Change dest name to build_script_sha1
+    builder.replace('build_script', 'build', build_script_sha1)
+    builder.add('pkgpanda_version', pkgpanda.build.constants.version)
+
+    if extra_id is not None:
+        builder.add('extra_source', extra_id)
+
+    # Add the id of the docker build environment to the build_ids.
+    builder.take('docker')
+    builder.update('docker', docker_id)
+
+    # Fields which only go into the pkginfo.
+    builder.take('environment')
+    builder.take('state_directory')
+    for field in ['username', 'group', 'sysctl']:
+        if builder.has(field):
+            builder.take(field)
+
+    # Add requires to the package id.
+    builder.take('requires')
+    builder.update('requires', list(requires_ids))
+
+    version_extra = None
+    if builder.has('version_extra'):
+        version_extra = builder.take('version_extra')
+
+    # Everything must have been taken by now. If it wasn't, then it is a hard
+    # error that it was set but not used, as well as didn't include it in the
+    # caluclation of the PackageId.
+    build_ids = builder.get_build_ids()
+    version = hash_checkout(build_ids)
+    if version_extra is not None:
+        version = "{0}-{1}".format(version_extra, version)
+    return build_ids, version
+
+
 def build(package_store: PackageStore, name: str, variant, clean_after_build, recursive=False):
     msg = "Building package {} variant {}".format(name, pkgpanda.util.variant_name(variant))
-    with logger.scope(msg):
-        return _build(package_store, name, variant, clean_after_build, recursive)
+    # Packages may be built concurrently (see build_packages()), the flow id keeps the messages of
+    # each build apart.
+    flow_id = "{}:{}".format(name, pkgpanda.util.variant_name(variant))
+    with logger.scope(msg, flow_id):
+        return _build(package_store, name, variant, clean_after_build, recursive, flow_id)
 
 
-def _build(package_store, name, variant, clean_after_build, recursive):
+def _build(package_store, name, variant, clean_after_build, recursive, flow_id=None):
     assert isinstance(package_store, PackageStore)
     tmpdir = tempfile.TemporaryDirectory(prefix="pkgpanda_repo")
     repository = Repository(tmpdir.name)
@@ -855,40 +1269,18 @@ def _build(package_store, name, variant, clean_after_build, recursive):
     assert (name, variant) in package_store.packages, \
         "Programming error: name, variant should have been validated to be valid before calling build()."
 
-    builder = IdBuilder(package_store.get_buildinfo(name, variant))
+    buildinfo = package_store.get_buildinfo(name, variant)
     final_buildinfo = dict()
 
-    builder.add('name', name)
-    builder.add('variant', pkgpanda.util.variant_str(variant))
-
-    # Convert single_source -> sources
-    if builder.has('sources'):
-        if builder.has('single_source'):
-            raise BuildError('Both sources and single_source cannot be specified at the same time')
-        sources = builder.take('sources')
-    elif builder.has('single_source'):
-        sources = {name: builder.take('single_source')}
-        builder.replace('single_source', 'sources', sources)
-    else:
-        builder.add('sources', {})
-        sources = dict()
+    sources = get_sources(name, buildinfo)
+    if 'sources' not in buildinfo and 'single_source' not in buildinfo:
         print("NOTICE: No sources specified")
 
     final_buildinfo['sources'] = sources
 
     # Construct the source fetchers, gather the checkout ids from them
-    checkout_ids = dict()
-    fetchers = dict()
-    try:
-        for src_name, src_info in sorted(sources.items()):
-            # TODO(cmaloney): Switch to a unified top level cache directory shared by all packages
-            cache_dir = package_store.get_package_cache_folder(name) + '/' + src_name
-            make_directory(cache_dir)
-            fetcher = get_src_fetcher(src_info, cache_dir, package_dir)
-            fetchers[src_name] = fetcher
-            checkout_ids[src_name] = fetcher.get_id()
-    except ValidationError as ex:
-        raise BuildError("Validation error when fetching sources for package: {}".format(ex))
+    fetchers = get_src_fetchers(package_store, name, sources)
+    checkout_ids = {src_name: fetcher.get_id() for src_name, fetcher in fetchers.items()}
 
     for src_name, checkout_id in checkout_ids.items():
         # NOTE: single_source buildinfo was expanded above so the src_name is
@@ -899,23 +1291,19 @@ def _build(package_store, name, variant, clean_after_build, recursive):
         assert_no_duplicate_keys(checkout_id, final_buildinfo['sources'][src_name])
         final_buildinfo['sources'][src_name].update(checkout_id)
 
-    # Add the sha1 of the buildinfo.json + build file to the build ids
-    builder.update('sources', checkout_ids)
-    build_script_file = builder.take('build_script')
-    # TODO(cmaloney): Change dest name to build_script_sha1
-    builder.replace('build_script', 'build', pkgpanda.util.sha1(src_abs(build_script_file)))
-    builder.add('pkgpanda_version', pkgpanda.build.constants.version)
+    build_script_file = buildinfo['build_script']
 
     extra_dir = src_abs("extra")
     # Add the "extra" folder inside the package as an additional source if it
     # exists
+    extra_id = None
     if os.path.exists(extra_dir):
-        extra_id = hash_folder_abs(extra_dir, package_dir)
-        builder.add('extra_source', extra_id)
+        extra_id = hash_folder_abs(extra_dir, package_dir, package_store.hash_cache)
+        package_store.hash_cache.save()
         final_buildinfo['extra_source'] = extra_id
 
     # Figure out the docker name.
-    docker_name = builder.take('docker')
+    docker_name = buildinfo['docker']
     cmd.container = docker_name
 
     # Add the id of the docker build environment to the build_ids.
@@ -926,20 +1314,18 @@ def _build(package_store, name, variant, clean_after_build, recursive):
         check_call(['docker', 'pull', docker_name])
         docker_id = get_docker_id(docker_name)
 
-    builder.update('docker', docker_id)
-
     # TODO(cmaloney): The environment variables should be generated during build
     # not live in buildinfo.json.
-    pkginfo['environment'] = builder.take('environment')
+    pkginfo['environment'] = buildinfo['environment']
 
     # Whether pkgpanda should on the host make sure a `/var/lib` state directory is available
-    pkginfo['state_directory'] = builder.take('state_directory')
+    pkginfo['state_directory'] = buildinfo['state_directory']
     if pkginfo['state_directory'] not in [True, False]:
         raise BuildError("state_directory in buildinfo.json must be a boolean `true` or `false`")
 
     username = None
-    if builder.has('username'):
-        username = builder.take('username')
+    if 'username' in buildinfo:
+        username = buildinfo['username']
         if not isinstance(username, str):
             raise BuildError("username in buildinfo.json must be either not set (no user for this"
                              " package), or a user name string")
@@ -950,8 +1336,8 @@ def _build(package_store, name, variant, clean_after_build, recursive):
         pkginfo['username'] = username
 
     group = None
-    if builder.has('group'):
-        group = builder.take('group')
+    if 'group' in buildinfo:
+        group = buildinfo['group']
         if not isinstance(group, str):
             raise BuildError("group in buildinfo.json must be either not set (use default group for this user)"
                              ", or group must be a string")
@@ -968,46 +1354,16 @@ def _build(package_store, name, variant, clean_after_build, recursive):
 
     active_packages = list()
     active_package_ids = set()
-    active_package_variants = dict()
     auto_deps = set()
 
     # Final package has the same requires as the build.
-    requires = builder.take('requires')
+    requires = buildinfo['requires']
     pkginfo['requires'] = requires
 
-    if builder.has("sysctl"):
-        pkginfo["sysctl"] = builder.take("sysctl")
-
-    # TODO(cmaloney): Pull generating the full set of requires a function.
-    to_check = copy.deepcopy(requires)
-    if type(to_check) != list:
-        raise BuildError("`requires` in buildinfo.json must be an array of dependencies.")
-    while to_check:
-        requires_info = to_check.pop(0)
-        requires_name, requires_variant = expand_require(requires_info)
-
-        if requires_name in active_package_variants:
-            # TODO(cmaloney): If one package depends on the <default>
-            # variant of a package and 1+ others depends on a non-<default>
-            # variant then update the dependency to the non-default variant
-            # rather than erroring.
-            if requires_variant != active_package_variants[requires_name]:
-                # TODO(cmaloney): Make this contain the chains of
-                # dependencies which contain the conflicting packages.
-                # a -> b -> c -> d {foo}
-                # e {bar} -> d {baz}
-                raise BuildError(
-                    "Dependncy on multiple variants of the same package {}. variants: {} {}".format(
-                        requires_name,
-                        requires_variant,
-                        active_package_variants[requires_name]))
-
-            # The variant has package {requires_name, variant} already is a
-            # dependency, don't process it again / move on to the next.
-            continue
-
-        active_package_variants[requires_name] = requires_variant
+    if "sysctl" in buildinfo:
+        pkginfo["sysctl"] = buildinfo["sysctl"]
 
+    for requires_name, requires_variant in get_transitive_requires(package_store, requires):
         # Figure out the last build of the dependency, add that as the
         # fully expanded dependency.
         requires_last_build = package_store.get_last_build_filename(requires_name, requires_variant)
@@ -1022,8 +1378,6 @@ def _build(package_store, name, variant, clean_after_build, recursive):
         try:
             pkg_id_str = load_string(requires_last_build)
             auto_deps.add(pkg_id_str)
-            pkg_buildinfo = package_store.get_buildinfo(requires_name, requires_variant)
-            pkg_requires = pkg_buildinfo['requires']
             pkg_path = repository.package_path(pkg_id_str)
             pkg_tar = pkg_id_str + '.tar.xz'
             if not os.path.exists(package_store.get_package_cache_folder(requires_name) + '/' + pkg_tar):
@@ -1039,40 +1393,25 @@ def _build(package_store, name, variant, clean_after_build, recursive):
             # Mount the package into the docker container.
             cmd.volumes[pkg_path] = install_root + "/packages/{}:ro".format(pkg_id_str)
             os.makedirs(os.path.join(install_dir, "packages/{}".format(pkg_id_str)))
-
-            # Add the dependencies of the package to the set which will be
-            # activated.
-            # TODO(cmaloney): All these 'transitive' dependencies shouldn't
-            # be available to the package being built, only what depends on
-            # them directly.
-            to_check += pkg_requires
         except ValidationError as ex:
             raise BuildError("validating package needed as dependency {0}: {1}".format(requires_name, ex)) from ex
         except PackageError as ex:
             raise BuildError("loading package needed as dependency {0}: {1}".format(requires_name, ex)) from ex
 
-    # Add requires to the package id, calculate the final package id.
+    # Calculate the final package id.
     # NOTE: active_packages isn't fully constructed here since we lazily load
     # packages not already in the repository.
-    builder.update('requires', list(active_package_ids))
-    version_extra = None
-    if builder.has('version_extra'):
-        version_extra = builder.take('version_extra')
-
-    build_ids = builder.get_build_ids()
-    version_base = hash_checkout(build_ids)
-    version = None
-    if builder.has('version_extra'):
-        version = "{0}-{1}".format(version_extra, version_base)
-    else:
-        version = version_base
+    build_ids, version = get_build_ids(
+        buildinfo,
+        name,
+        variant,
+        checkout_ids,
+        pkgpanda.util.sha1(src_abs(build_script_file)),
+        extra_id,
+        docker_id,
+        active_package_ids)
     pkg_id = PackageId.from_parts(name, version)
 
-    # Everything must have been extracted by now. If it wasn't, then we just
-    # had a hard error that it was set but not used, as well as didn't include
-    # it in the caluclation of the PackageId.
-    builder = None
-
     # Save the build_ids. Useful for verify exactly what went into the
     # package build hash.
     final_buildinfo['build_ids'] = build_ids
@@ -1094,6 +1433,9 @@ def _build(package_store, name, variant, clean_after_build, recursive):
         # the build function.
         write_string(package_store.get_last_build_filename(name, variant), str(pkg_id))
 
+        # Packages built before content digests were published don't have one yet.
+        if not exists(content_digest_filename(pkg_path)):
+            write_content_digest(pkg_path)
         return pkg_path
 
     # Try downloading.
@@ -1105,6 +1447,7 @@ def _build(package_store, name, variant, clean_after_build, recursive):
         write_string(package_store.get_last_build_filename(name, variant), str(pkg_id))
         print(dl_path, pkg_path)
         assert dl_path == pkg_path
+        write_content_digest(pkg_path)
         return pkg_path
 
     # Fall out and do the build since it couldn't be downloaded
@@ -1254,7 +1597,7 @@ def _build(package_store, name, variant, clean_after_build, recursive):
     # TODO(cmaloney): Move to an RAII wrapper.
     remove_directory(install_dir)
 
-    with logger.scope("Build package tarball"):
+    with logger.scope("Build package tarball", flow_id):
         # Check for forbidden services before packaging the tarball:
         try:
             check_forbidden_services(cache_abs("result"), RESERVED_UNIT_NAMES)
@@ -1269,6 +1612,7 @@ def _build(package_store, name, variant, clean_after_build, recursive):
     tmp_name = pkg_path + "-tmp.tar.xz"
     make_tar(tmp_name, cache_abs("result"))
     os.replace(tmp_name, pkg_path)
+    write_content_digest(pkg_path)
     print("Package built.")
     if clean_after_build:
         clean()
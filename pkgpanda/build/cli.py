@@ -4,11 +4,20 @@ Reads a buildinfo file, uses it to assemble the sources and determine the
 package version, then builds the package in an isolated environment along with
 the necessary dependencies.
 
+`mkpanda plan` prints the ids of the packages `mkpanda tree` would build as JSON,
+along with whether each is already cached locally or at the repository url.
+
 Usage:
   mkpanda [--repository-url=<repository_url>] [--dont-clean-after-build] [--recursive] [--variant=<variant>]
-  mkpanda tree [--mkbootstrap] [--repository-url=<repository_url>] [--variant=<variant>]
+  mkpanda tree [--mkbootstrap] [--repository-url=<repository_url>] [--variant=<variant>] [--jobs=<jobs>]
+  mkpanda plan [--repository-url=<repository_url>] [--variant=<variant>]
+
+Options:
+  --jobs=<jobs>  Number of packages to build at the same time. Defaults to
+                 $PKGPANDA_BUILD_JOBS, or 1.
 """
 
+import json
 import sys
 from os import getcwd, umask
 from os.path import basename, normpath
@@ -31,9 +40,16 @@ def main():
         if arguments['tree']:
             package_store = pkgpanda.build.PackageStore(getcwd(), arguments['--repository-url'])
             if variant_arg is None:
-                pkgpanda.build.build_tree_variants(package_store, arguments['--mkbootstrap'])
+                pkgpanda.build.build_tree_variants(package_store, arguments['--mkbootstrap'], arguments['--jobs'])
             else:
-                pkgpanda.build.build_tree(package_store, arguments['--mkbootstrap'], [target_variant])
+                pkgpanda.build.build_tree(
+                    package_store, arguments['--mkbootstrap'], [target_variant], arguments['--jobs'])
+            sys.exit(0)
+
+        if arguments['plan']:
+            package_store = pkgpanda.build.PackageStore(getcwd(), arguments['--repository-url'])
+            tree_variants = None if variant_arg is None else [target_variant]
+            print(json.dumps(pkgpanda.build.plan_tree(package_store, tree_variants), indent=2, sort_keys=True))
             sys.exit(0)
 
         # Package name is the folder name.
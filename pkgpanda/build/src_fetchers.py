@@ -1,10 +1,24 @@
+"""Source fetchers for pkgpanda builds.
+
+Fetched sources are kept in a source cache directory shared by all packages:
+- git/<sha1 of the remote url>.git: a bare mirror of each git remote.
+- url/<sha1 of the file>/<filename>: each downloaded file, by the sha1 given in the buildinfo.
+Both are locked while being updated or read so concurrent builds can share them.
+"""
 import abc
+import hashlib
 import os.path
 import shutil
+import threading
 from subprocess import CalledProcessError, check_call, check_output
 
 from pkgpanda.exceptions import ValidationError
-from pkgpanda.util import download_atomic, is_windows, logger, sha1
+from pkgpanda.util import download_atomic, file_lock, is_windows, logger, make_directory, sha1
+
+# Bare repositories updated by this process. Each remote is only fetched once per process rather
+# than once per package using it.
+_fetched_git_folders = set()
+_fetched_git_folders_lock = threading.Lock()
 
 
 # Ref must be a git sha-1. We then pass it through get_sha1 to make
@@ -70,6 +84,10 @@ def get_git_sha1(bare_folder, ref):
                 "Unable to find ref '{}' in '{}': {}".format(ref, bare_folder, ex)) from ex
 
 
+def get_git_cache_folder(cache_dir, git_uri):
+    return cache_dir + '/git/' + hashlib.sha1(git_uri.encode()).hexdigest() + '.git'
+
+
 class GitSrcFetcher(SourceFetcher):
     def __init__(self, src_info, cache_dir):
         super().__init__(src_info)
@@ -87,15 +105,24 @@ class GitSrcFetcher(SourceFetcher):
         self.url = src_info['git']
         self.ref = src_info['ref']
         self.ref_origin = src_info['ref_origin']
-        self.bare_folder = cache_dir + "/cache.git".format()
+        self.bare_folder = get_git_cache_folder(cache_dir, self.url)
 
     def get_id(self):
         return {"commit": self.ref}
 
     def checkout_to(self, directory):
+        with file_lock(self.bare_folder + '.lock'):
+            self._checkout_to(directory)
+
+    def _checkout_to(self, directory):
         # fetch into a bare repository so if we're on a host which has a cache we can
         # only get the new commits.
-        fetch_git(self.bare_folder, self.url)
+        with _fetched_git_folders_lock:
+            fetched = self.bare_folder in _fetched_git_folders
+        if not fetched:
+            fetch_git(self.bare_folder, self.url)
+            with _fetched_git_folders_lock:
+                _fetched_git_folders.add(self.bare_folder)
 
         # Warn if the ref_origin is set and gives a different sha1 than the
         # current ref.
@@ -295,10 +322,10 @@ class UrlSrcFetcher(SourceFetcher):
 
         self.url = src_info['url']
         self.extract = (self.kind == 'url_extract')
-        self.cache_dir = cache_dir
-        self.cache_filename = self._get_filename(cache_dir)
-        self.working_directory = working_directory
         self.sha = src_info['sha1']
+        self.cache_dir = cache_dir + '/url/' + self.sha
+        self.cache_filename = self._get_filename(self.cache_dir)
+        self.working_directory = working_directory
 
     def _get_filename(self, out_dir):
         assert '://' in self.url, "Scheme separator not found in url {}".format(self.url)
@@ -310,13 +337,19 @@ class UrlSrcFetcher(SourceFetcher):
         }
 
     def checkout_to(self, directory):
-        # Download file to cache if it isn't already there
+        with file_lock(self.cache_dir + '.lock'):
+            self._checkout_to(directory)
+
+    def _checkout_to(self, directory):
+        # Download file to cache if it isn't already there. The download is hashed as it's written.
         if not os.path.exists(self.cache_filename):
+            make_directory(self.cache_dir)
             print("Downloading source tarball {}".format(self.url))
-            download_atomic(self.cache_filename, self.url, self.working_directory)
+            file_sha = download_atomic(self.cache_filename, self.url, self.working_directory)
+        else:
+            file_sha = sha1(self.cache_filename)
 
         # Validate the sha1 of the source is given and matches the sha1
-        file_sha = sha1(self.cache_filename)
 
         if self.sha != file_sha:
             corrupt_filename = self.cache_filename + '.corrupt'
@@ -0,0 +1,79 @@
+import threading
+from subprocess import check_call, check_output
+
+import pytest
+
+import pkgpanda.build.src_fetchers
+from pkgpanda.util import is_windows, sha1
+
+
+def test_url_source_cache(tmpdir, monkeypatch):
+    source = tmpdir.join('upstream', 'source.txt')
+    source.write('source', ensure=True)
+    src_info = {'kind': 'url', 'url': 'file://' + str(source), 'sha1': sha1(str(source))}
+    cache_dir = str(tmpdir.join('cache'))
+
+    downloads = []
+    download_atomic = pkgpanda.build.src_fetchers.download_atomic
+
+    def counting_download_atomic(out_filename, url, work_dir):
+        downloads.append(url)
+        return download_atomic(out_filename, url, work_dir)
+
+    monkeypatch.setattr(pkgpanda.build.src_fetchers, 'download_atomic', counting_download_atomic)
+
+    # Packages fetching the same file concurrently share a single download.
+    def checkout(name):
+        fetcher = pkgpanda.build.src_fetchers.UrlSrcFetcher(src_info, cache_dir, str(tmpdir))
+        tmpdir.join(name).ensure(dir=True)
+        fetcher.checkout_to(str(tmpdir.join(name)))
+
+    threads = [threading.Thread(target=checkout, args=('package{}'.format(i),)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(downloads) == 1
+    assert tmpdir.join('cache', 'url', src_info['sha1'], 'source.txt').read() == 'source'
+    for i in range(4):
+        assert tmpdir.join('package{}'.format(i), 'source.txt').read() == 'source'
+
+
+# TODO: DCOS_OSS-3470 - muted Windows tests requiring investigation
+@pytest.mark.skipif(is_windows, reason="Fails on windows, cause unknown")
+def test_git_source_cache(tmpdir, monkeypatch):
+    remote = tmpdir.join('remote')
+    remote.join('file').write('content', ensure=True)
+
+    def git(*args):
+        return check_output(['git', '-C', str(remote), '-c', 'user.name=test', '-c', 'user.email=test@example.com'] +
+                            list(args)).decode().strip()
+
+    git('init', '-q')
+    git('add', 'file')
+    git('commit', '-q', '-m', 'commit')
+    ref = git('rev-parse', 'HEAD')
+    src_info = {'kind': 'git', 'git': str(remote), 'ref': ref, 'ref_origin': git('rev-parse', '--abbrev-ref', 'HEAD')}
+    cache_dir = str(tmpdir.join('cache'))
+
+    fetches = []
+    fetch_git = pkgpanda.build.src_fetchers.fetch_git
+
+    def counting_fetch_git(bare_folder, git_uri):
+        fetches.append(git_uri)
+        return fetch_git(bare_folder, git_uri)
+
+    monkeypatch.setattr(pkgpanda.build.src_fetchers, 'fetch_git', counting_fetch_git)
+    monkeypatch.setattr(pkgpanda.build.src_fetchers, '_fetched_git_folders', set())
+
+    # Both packages check out from the same mirror of the remote, which is only fetched once.
+    for name in ['package1', 'package2']:
+        fetcher = pkgpanda.build.src_fetchers.GitSrcFetcher(src_info, cache_dir)
+        assert fetcher.bare_folder == pkgpanda.build.src_fetchers.get_git_cache_folder(cache_dir, str(remote))
+        fetcher.checkout_to(str(tmpdir.join(name)))
+        assert tmpdir.join(name, 'file').read() == 'content'
+
+    assert fetches == [str(remote)]
+    check_call(['git', '--git-dir', pkgpanda.build.src_fetchers.get_git_cache_folder(cache_dir, str(remote)),
+                'cat-file', '-e', ref])
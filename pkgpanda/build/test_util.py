@@ -1,4 +1,14 @@
+import json
+import os
+import shutil
+import threading
+import time
+
+import pytest
+
 import pkgpanda.build
+import pkgpanda.util
+from pkgpanda import PackageId
 
 
 def test_hash_files_in_folder(tmpdir):
@@ -84,3 +94,207 @@ def test_hash_files_in_folder(tmpdir):
             'baz/bang/new': '15bc116ce980d703d62a16531b0ef5bb42fef91c',
             'baz/bang/swish/swipe': 'e855a8aca0e15c14144901428df7042798a622d6'
         }
+
+        # Hashing relative to a work_dir matches hashing from inside it.
+        assert hash_files_in_folder("test_simple", str(tmpdir)) == hash_files_in_folder("test_simple")
+
+        # As does hashing through a hash cache, whether the hashes are cached or not.
+        hash_cache = pkgpanda.util.FileHashCache(str(tmpdir.join('file_hashes.json')))
+        for _ in range(2):
+            assert hash_files_in_folder("test_simple", hash_cache=hash_cache) == hash_files_in_folder("test_simple")
+            for path in simple.visit():
+                os.utime(str(path), (0, 0))
+        assert pkgpanda.build.hash_folder_abs(str(simple), str(tmpdir)) == pkgpanda.build.hash_folder("test_simple")
+
+
+class FakePackageStore:
+
+    def __init__(self, requires):
+        self.packages = {pkg_tuple: {'requires': reqs} for pkg_tuple, reqs in requires.items()}
+
+
+def test_build_packages(monkeypatch):
+    package_store = FakePackageStore({
+        ('a', None): [],
+        ('b', None): ['a'],
+        ('b', 'x'): [{'name': 'a', 'variant': None}],
+        ('c', None): [],
+        ('d', None): ['b', 'c'],
+    })
+    build_order = [('a', None), ('b', None), ('b', 'x'), ('c', None), ('d', None)]
+    lock = threading.Lock()
+    started = []
+    running = set()
+
+    def build(package_store, name, variant, clean_after_build):
+        with lock:
+            # Variants of one package are never built concurrently and requires are always built first.
+            assert name not in {running_name for running_name, _ in running}
+            for require in package_store.packages[(name, variant)]['requires']:
+                assert pkgpanda.build.expand_require(require) in started
+                assert pkgpanda.build.expand_require(require) not in running
+            started.append((name, variant))
+            running.add((name, variant))
+        time.sleep(0.01)
+        with lock:
+            running.remove((name, variant))
+        return '{}-{}.tar.xz'.format(name, variant)
+
+    monkeypatch.setattr(pkgpanda.build, 'build', build)
+
+    expected = {
+        'a': {None: 'a-None.tar.xz'},
+        'b': {None: 'b-None.tar.xz', 'x': 'b-x.tar.xz'},
+        'c': {None: 'c-None.tar.xz'},
+        'd': {None: 'd-None.tar.xz'},
+    }
+    assert pkgpanda.build.build_packages(package_store, build_order, 1) == expected
+    assert started == build_order
+
+    started.clear()
+    assert pkgpanda.build.build_packages(package_store, build_order, 4) == expected
+    assert sorted(started, key=str) == sorted(build_order, key=str)
+
+
+def test_build_packages_error(monkeypatch):
+    package_store = FakePackageStore({
+        ('a', None): [],
+        ('b', None): [],
+        ('c', None): ['a'],
+    })
+    built = []
+
+    def build(package_store, name, variant, clean_after_build):
+        if name == 'a':
+            raise pkgpanda.build.BuildError('a is broken')
+        built.append(name)
+
+    monkeypatch.setattr(pkgpanda.build, 'build', build)
+
+    with pytest.raises(pkgpanda.build.BuildError):
+        pkgpanda.build.build_packages(package_store, [('a', None), ('b', None), ('c', None)], 1)
+    # Nothing is started after the first failure.
+    assert built == []
+
+
+def test_get_build_jobs(monkeypatch):
+    monkeypatch.delenv(pkgpanda.build.BUILD_JOBS_ENV_VAR, raising=False)
+    assert pkgpanda.build.get_build_jobs() == 1
+    assert pkgpanda.build.get_build_jobs('3') == 3
+    monkeypatch.setenv(pkgpanda.build.BUILD_JOBS_ENV_VAR, '8')
+    assert pkgpanda.build.get_build_jobs() == 8
+    for jobs in ['0', 'many']:
+        with pytest.raises(pkgpanda.build.BuildError):
+            pkgpanda.build.get_build_jobs(jobs)
+
+
+def make_package(packages_dir, name, buildinfo):
+    packages_dir.join(name, 'buildinfo.json').write(json.dumps(buildinfo), ensure=True)
+    packages_dir.join(name, 'build').write('#!/bin/bash\n')
+
+
+def test_plan_tree(tmpdir):
+    packages_dir = tmpdir.join('packages')
+    packages_dir.join('treeinfo.json').write('{}', ensure=True)
+    make_package(packages_dir, 'a', {'docker': 'builder'})
+    make_package(packages_dir, 'b', {'docker': 'builder', 'requires': ['a']})
+    make_package(packages_dir, 'c', {'docker': 'missing'})
+    make_package(packages_dir, 'd', {'docker': 'builder', 'requires': ['c']})
+    packages_dir.join('b', 'extra', 'file').write('extra', ensure=True)
+    repository_dir = tmpdir.join('repository')
+    package_store = pkgpanda.build.PackageStore(str(packages_dir), 'file://' + str(repository_dir))
+
+    def plan_tree(docker_ids):
+        return {
+            entry['name']: entry
+            for entry in pkgpanda.build.plan_tree(package_store, None, docker_ids)}
+
+    plan = plan_tree({'builder': 'sha256:builder', 'missing': None})
+    assert plan['a']['id'].startswith('a--')
+    assert plan['b']['id'].startswith('b--')
+    # Packages whose docker image, or whose requires' docker image, is unavailable can't be planned.
+    assert plan['c']['id'] is None
+    assert plan['d']['id'] is None
+    assert not any(entry['cached'] or entry['in_repository'] for entry in plan.values())
+
+    # The id is the hash of the build ids, which include the ids of the required packages.
+    build_ids, version = pkgpanda.build.get_build_ids(
+        package_store.get_buildinfo('b', None),
+        'b',
+        None,
+        {},
+        pkgpanda.util.sha1(str(packages_dir.join('b', 'build'))),
+        pkgpanda.build.hash_folder_abs(str(packages_dir.join('b', 'extra')), str(packages_dir.join('b'))),
+        'sha256:builder',
+        {plan['a']['id']})
+    assert plan['b']['id'] == 'b--' + version
+    assert build_ids['requires'] == [plan['a']['id']]
+
+    # A new docker image changes the ids of everything built with it.
+    replanned = plan_tree({'builder': 'sha256:builder2', 'missing': None})
+    assert replanned['a']['id'] != plan['a']['id']
+    assert replanned['b']['id'] != plan['b']['id']
+
+    a_id = PackageId(plan['a']['id'])
+    tmpdir.join('packages', 'cache', 'packages', 'a', str(a_id) + '.tar.xz').write('', ensure=True)
+    repository_dir.join('packages', 'b', plan['b']['id'] + '.tar.xz').write('', ensure=True)
+    plan = plan_tree({'builder': 'sha256:builder', 'missing': None})
+    assert plan['a']['cached'] and plan['a']['in_repository'] is None
+    assert not plan['b']['cached'] and plan['b']['in_repository']
+
+
+def test_get_transitive_requires(tmpdir):
+    packages_dir = tmpdir.join('packages')
+    make_package(packages_dir, 'a', {'requires': [{'name': 'c', 'variant': 'x'}]})
+    make_package(packages_dir, 'b', {'requires': ['c']})
+    make_package(packages_dir, 'c', {})
+    packages_dir.join('c', 'x.buildinfo.json').write('{}')
+    package_store = pkgpanda.build.PackageStore(str(packages_dir), None)
+
+    assert pkgpanda.build.get_transitive_requires(package_store, ['a']) == [('a', None), ('c', 'x')]
+    with pytest.raises(pkgpanda.build.BuildError):
+        pkgpanda.build.get_transitive_requires(package_store, ['a', 'b'])
+
+
+# TODO: DCOS_OSS-3470 - muted Windows tests requiring investigation
+@pytest.mark.skipif(pkgpanda.util.is_windows, reason="Fails on windows, cause unknown")
+@pytest.mark.parametrize('compression', ['xz', 'zstd'])
+def test_make_bootstrap_tarball(tmpdir, monkeypatch, compression):
+    if compression == 'zstd' and shutil.which('zstd') is None:
+        pytest.skip('zstd is not installed')
+
+    package_paths = []
+    for pkg_id in ['mesos--0.22.0', 'mesos-config--ffddcfb53168d42f92e4771c6f8a8a9a818fd6b8']:
+        package_paths.append(str(tmpdir.join(pkg_id + '.tar.xz')))
+        pkgpanda.util.make_tar(
+            package_paths[-1], pkgpanda.util.resources_test_dir('packages/' + pkg_id), compression)
+
+    class FakePackageStore:
+        def get_bootstrap_cache_dir(self):
+            return str(tmpdir.join('bootstrap'))
+
+        def try_fetch_bootstrap_and_active(self, bootstrap_id):
+            return False
+
+    monkeypatch.delenv(pkgpanda.util.COMPRESSION_ENV_VAR, raising=False)
+    bootstrap_id = pkgpanda.build.make_bootstrap_tarball(FakePackageStore(), package_paths, None)
+    assert not tmpdir.join('bootstrap', bootstrap_id + '.bootstrap.tar.xz.tmp').exists()
+
+    root = tmpdir.join('root')
+    pkgpanda.util.extract_tarball(str(tmpdir.join('bootstrap', bootstrap_id + '.bootstrap.tar.xz')), str(root))
+    assert pkgpanda.util.load_json(str(tmpdir.join('bootstrap', bootstrap_id + '.active.json'))) == [
+        'mesos--0.22.0', 'mesos-config--ffddcfb53168d42f92e4771c6f8a8a9a818fd6b8']
+
+    # The packages are copied as is.
+    for dirpath, dirnames, filenames in os.walk(pkgpanda.util.resources_test_dir('packages/mesos--0.22.0')):
+        relpath = os.path.relpath(dirpath, pkgpanda.util.resources_test_dir('packages/mesos--0.22.0'))
+        for name in filenames:
+            assert root.join('packages', 'mesos--0.22.0', relpath, name).read() == open(dirpath + '/' + name).read()
+
+    # The activation points into /opt/mesosphere.
+    assert set(os.listdir(str(root))) == {
+        'active', 'active.buildinfo.full.json', 'bin', 'bootstrap', 'environment', 'environment.export', 'etc',
+        'include', 'lib', 'packages'}
+    assert os.readlink(str(root.join('active', 'mesos'))) == '/opt/mesosphere/packages/mesos--0.22.0'
+    assert os.readlink(str(root.join('bin', 'mesos'))) == '/opt/mesosphere/packages/mesos--0.22.0/bin/mesos'
+    assert 'export LD_LIBRARY_PATH=/opt/mesosphere/lib' in root.join('environment.export').read()
@@ -24,6 +24,8 @@ Options:
                                 repository directory [default: {default_repository}]
     --rooted-systemd            Use $ROOT/dcos.target.wants for systemd management
                                 rather than /etc/systemd/system/dcos.target.wants
+    --incremental               Copy the links of the packages staying active
+                                rather than recreating them all
 """
 
 import os
@@ -185,7 +187,8 @@ def main():
                 repository,
                 arguments['<id>'],
                 not arguments['--no-systemd'],
-                not arguments['--no-block-systemd'])
+                not arguments['--no-block-systemd'],
+                arguments['--incremental'])
             sys.exit(0)
 
         if arguments['swap']:
@@ -194,7 +197,8 @@ def main():
                 repository,
                 arguments['<package-id>'],
                 not arguments['--no-systemd'],
-                not arguments['--no-block-systemd'])
+                not arguments['--no-block-systemd'],
+                arguments['--incremental'])
             sys.exit(0)
 
         if arguments['remove']:
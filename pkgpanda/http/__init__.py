@@ -5,11 +5,12 @@ import logging
 import os
 import sys
 
-from flask import current_app, Flask, jsonify, make_response, request
+from flask import current_app, Flask, jsonify, make_response, request, Response
 
-from pkgpanda import actions, Install, Repository
+from pkgpanda import actions, Install, PEER_DIGEST_HEADER, Repository
 from pkgpanda.exceptions import (PackageConflict, PackageError,
                                  PackageNotFound, ValidationError)
+from pkgpanda.util import stream_tarball
 
 
 empty_response = ('', http.client.NO_CONTENT)
@@ -96,8 +97,12 @@ def set_app_attrs_from_config():
         block_systemd=False,
         manage_state_dir=True,
         state_dir_root=current_app.config['DCOS_STATE_DIR_ROOT'])
-    current_app.repository = Repository(
-        current_app.config['DCOS_REPO_DIR'])
+    repo_dir = current_app.config['DCOS_REPO_DIR']
+    index_file = None
+    if current_app.config['DCOS_REPO_INDEX']:
+        # Kept in the repository, so that only the repository's owner can write it.
+        index_file = os.path.join(repo_dir, Repository.INDEX_DIR, 'index.json')
+    current_app.repository = Repository(repo_dir, index_file)
 
 
 @app.before_request
@@ -115,6 +120,33 @@ def get_package(package_id):
     return package_response(package_id, current_app.repository)
 
 
+@app.route('/repository/<package_id>/tarball', methods=['GET'])
+def get_package_tarball(package_id):
+    """Serve a tarball of a package in the repository to a node fetching it from its peers.
+
+    The tarball is re-packed from the package's files, and the content digest the package had when
+    it was added is sent along so the fetching node can tell whether it got the same files.
+    """
+    if not current_app.config['PEER_CACHE']:
+        return error_response('Serving package tarballs is disabled.'), http.client.NOT_FOUND
+
+    response = package_response(package_id, current_app.repository)
+    if response[1] != http.client.OK:
+        return response
+
+    digest = current_app.repository.get_digest(package_id)
+    if digest is None:
+        return (
+            error_response('Package {} has no recorded content digest.'.format(package_id)),
+            http.client.NOT_FOUND,
+        )
+
+    return Response(
+        stream_tarball(current_app.repository.package_path(package_id)),
+        mimetype='application/gzip',
+        headers={PEER_DIGEST_HEADER: digest})
+
+
 @app.route('/repository/<package_id>', methods=['POST'])
 def fetch_package(package_id):
     try:
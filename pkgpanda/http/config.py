@@ -11,3 +11,10 @@ DCOS_ROOTED_SYSTEMD = False
 DCOS_STATE_DIR_ROOT = constants.STATE_DIR_ROOT
 
 WORK_DIR = os.path.join(tempfile.gettempdir(), 'pkgpanda_api')
+
+# Keep an index of the package repository in Repository.INDEX_DIR, reused between requests while the repository
+# doesn't change.
+DCOS_REPO_INDEX = True
+
+# Serve the packages in the repository to other nodes fetching them, see pkgpanda.peer_fetcher().
+PEER_CACHE = False
@@ -1,6 +1,13 @@
+import os
+import shutil
+
 import pytest
 
-from pkgpanda.util import expect_fs, is_windows, resources_test_dir, run
+from pkgpanda import Repository, requests_content_digest, requests_fetcher
+from pkgpanda.actions import fetch_packages
+from pkgpanda.exceptions import FetchError
+from pkgpanda.util import (expect_fs, get_requests_retry_session, is_windows, resources_test_dir, run,
+                           write_content_digest)
 
 fetch_output = """\rFetching: mesos--0.22.0\rFetched: mesos--0.22.0\n"""
 
@@ -24,6 +31,7 @@ def test_fetch(tmpdir):
     expect_fs(
         "{0}".format(tmpdir),
         {
+            ".digests": ["mesos--0.22.0"],
             "mesos--0.22.0": ["lib", "bin_master", "bin_slave", "pkginfo.json", "bin"]
         })
     # TODO(cmaloney): Test multiple fetches on one line.
@@ -44,6 +52,77 @@ def test_add(tmpdir):
     expect_fs(
         "{0}".format(tmpdir),
         {
+            ".digests": ["mesos--0.22.0"],
             "mesos--0.22.0": ["lib", "bin_master", "bin_slave", "pkginfo.json", "bin"]
         })
     # TODO(branden): Test unable to add case.
+
+
+def test_fetch_packages(tmpdir):
+    repository = Repository(str(tmpdir.join('repository')))
+    repository.add(lambda id, target: os.makedirs(target), 'local--0')
+    fetched = []
+
+    def fetcher(id, target):
+        # Packages are swapped into place from a temporary folder.
+        assert target == repository.package_path(id) + '_tmp'
+        fetched.append(id)
+        os.makedirs(target)
+
+    package_ids = ['local--0'] + ['pkg{}--0'.format(i) for i in range(20)] + ['pkg0--0']
+    fetch_packages(repository, fetcher, package_ids, max_workers=4)
+
+    assert sorted(fetched) == sorted('pkg{}--0'.format(i) for i in range(20))
+    assert set(os.listdir(repository.path)) == set(package_ids)
+
+
+def test_fetch_packages_error(tmpdir):
+    repository = Repository(str(tmpdir.join('repository')))
+
+    def fetcher(id, target):
+        os.makedirs(target)
+        if id == 'broken--0':
+            raise FetchError('file:///broken', target, Exception('broken'), True)
+
+    with pytest.raises(FetchError):
+        fetch_packages(repository, fetcher, ['a--0', 'broken--0', 'b--0'], max_workers=1)
+
+    # The failed package is never swapped into place.
+    assert not os.path.exists(repository.package_path('broken--0'))
+
+
+# TODO: DCOS_OSS-3467 - muted Windows tests requiring investigation
+@pytest.mark.skipif(is_windows, reason="test fails on Windows reason unknown")
+def test_fetch_packages_requests_fetcher(tmpdir):
+    repository = Repository(str(tmpdir))
+    repository_url = 'file://{}/'.format(resources_test_dir('remote_repo'))
+    with get_requests_retry_session() as session:
+        fetch_packages(
+            repository,
+            lambda id, target: requests_fetcher(repository_url, id, target, os.getcwd(), session=session),
+            ['mesos--0.22.0'])
+
+    expect_fs(
+        "{0}".format(tmpdir),
+        {
+            ".digests": ["mesos--0.22.0"],
+            "mesos--0.22.0": ["lib", "bin_master", "bin_slave", "pkginfo.json", "bin"]
+        })
+
+
+# TODO: DCOS_OSS-3467 - muted Windows tests requiring investigation
+@pytest.mark.skipif(is_windows, reason="test fails on Windows reason unknown")
+def test_requests_content_digest(tmpdir):
+    tarball = tmpdir.join('packages', 'mesos', 'mesos--0.22.0.tar.xz')
+    tarball.dirpath().ensure(dir=True)
+    shutil.copyfile(resources_test_dir('remote_repo/packages/mesos/mesos--0.22.0.tar.xz'), str(tarball))
+    write_content_digest(str(tarball))
+    repository_url = 'file://{}'.format(tmpdir)
+
+    repository = Repository(str(tmpdir.join('repository')))
+    repository.add(lambda id, target: requests_fetcher(repository_url, id, target, os.getcwd()), 'mesos--0.22.0')
+    assert requests_content_digest(repository_url, 'mesos--0.22.0', os.getcwd()) == \
+        repository.get_digest('mesos--0.22.0')
+
+    # Packages built before the digests were published have none.
+    assert requests_content_digest(repository_url, 'mesos--0.23.0', os.getcwd()) is None
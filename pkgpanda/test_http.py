@@ -2,11 +2,15 @@ import json
 import operator
 import os
 from shutil import copytree
+from threading import Thread
 
 import pytest
+from werkzeug.serving import make_server
 
+import pkgpanda
+from pkgpanda import PEER_DIGEST_HEADER, peer_fetcher, Repository
 from pkgpanda.http import app
-from pkgpanda.util import is_windows, resources_test_dir
+from pkgpanda.util import extract_tarball, get_content_digest, is_windows, resources_test_dir
 
 
 def assert_response(response, status_code, body, headers=None, body_cmp=operator.eq):
@@ -84,6 +88,8 @@ def _set_test_config(app):
     app.config['DCOS_ROOT'] = resources_test_dir('install')
     app.config['DCOS_STATE_DIR_ROOT'] = resources_test_dir('install/package_state')
     app.config['DCOS_REPO_DIR'] = resources_test_dir('packages')
+    # Don't write an index into the test resources.
+    app.config['DCOS_REPO_INDEX'] = False
 
 
 # TODO: DCOS_OSS-3468 - muted Windows tests requiring investigation
@@ -249,7 +255,9 @@ def test_remove_package(tmpdir):
     _set_test_config(app)
     repo_dir = str(tmpdir.join('repo'))
     copytree(resources_test_dir('packages'), repo_dir)
+    os.utime(repo_dir, ns=(0, 0))
     app.config['DCOS_REPO_DIR'] = repo_dir
+    app.config['DCOS_REPO_INDEX'] = True
     client = app.test_client()
 
     # Successful deletion.
@@ -287,3 +295,93 @@ def test_remove_package(tmpdir):
     # Attempted deletion of nonexistent package.
     assert_error(client.delete('/repository/nonexistent-package--fakeversion'), 404)
     assert_error(client.delete('/repository/invalid---package'), 404)
+
+
+def _make_peer_repository(tmpdir):
+    repository = Repository(str(tmpdir.join('peer')))
+    tarball = resources_test_dir('remote_repo/packages/mesos/mesos--0.22.0.tar.xz')
+    repository.add(lambda _, target: extract_tarball(tarball, target), 'mesos--0.22.0')
+    return repository
+
+
+# TODO: DCOS_OSS-3468 - muted Windows tests requiring investigation
+@pytest.mark.skipif(is_windows, reason="test fails on Windows reason unknown")
+def test_get_package_tarball(tmpdir, monkeypatch):
+    _set_test_config(app)
+    repository = _make_peer_repository(tmpdir)
+    app.config['DCOS_REPO_DIR'] = repository.path
+    client = app.test_client()
+
+    # Disabled by default.
+    assert_error(client.get('/repository/mesos--0.22.0/tarball'), 404)
+
+    monkeypatch.setitem(app.config, 'PEER_CACHE', True)
+    response = client.get('/repository/mesos--0.22.0/tarball')
+    assert response.status_code == 200
+    digest = response.headers[PEER_DIGEST_HEADER]
+    assert digest == repository.get_digest('mesos--0.22.0')
+    tarball = tmpdir.join('mesos.tar.gz')
+    tarball.write(response.data, mode='wb')
+    assert extract_tarball(str(tarball), str(tmpdir.join('extracted'))) == digest
+
+    assert_error(client.get('/repository/mesos--0.23.0/tarball'), 404)
+    assert_error(client.get('/repository/package---version/tarball'), 404)
+
+    # Packages without a recorded digest can't be verified by the fetching node.
+    copytree(resources_test_dir('packages/mesos--0.23.0'), repository.package_path('mesos--0.23.0'))
+    assert_error(client.get('/repository/mesos--0.23.0/tarball'), 404)
+
+
+# TODO: DCOS_OSS-3468 - muted Windows tests requiring investigation
+@pytest.mark.skipif(is_windows, reason="test fails on Windows reason unknown")
+def test_peer_fetcher(tmpdir, monkeypatch):
+    _set_test_config(app)
+    repository = _make_peer_repository(tmpdir)
+    app.config['DCOS_REPO_DIR'] = repository.path
+    monkeypatch.setitem(app.config, 'PEER_CACHE', True)
+    server = make_server('localhost', 0, app, threaded=True)
+    Thread(target=server.serve_forever, daemon=True).start()
+    peer_url = 'http://localhost:{}'.format(server.server_port)
+    # Nothing listens on port 1.
+    unreachable_url = 'http://localhost:1'
+    expected_digest = repository.get_digest('mesos--0.22.0')
+
+    try:
+        unreachable = set()
+        assert peer_fetcher(
+            [unreachable_url], 'mesos--0.22.0', str(tmpdir.join('unreachable')), expected_digest,
+            unreachable_peers=unreachable) is None
+        assert unreachable == {unreachable_url}
+
+        # The peer found unreachable is skipped from then on.
+        target = str(tmpdir.join('fetched'))
+        digest = peer_fetcher(
+            [unreachable_url, peer_url], 'mesos--0.22.0', target, expected_digest, unreachable_peers=unreachable)
+        assert digest == expected_digest
+        assert get_content_digest(target) == digest
+
+        # A package the peer doesn't have.
+        assert peer_fetcher([peer_url], 'mesos--0.23.0', str(tmpdir.join('missing')), expected_digest) is None
+
+        # A peer advertising a different package than the trusted digest.
+        target = str(tmpdir.join('other'))
+        assert peer_fetcher([peer_url], 'mesos--0.22.0', target, '0' * 64) is None
+        assert not os.path.exists(target)
+
+        # A package whose files changed on the peer since it was added is never extracted.
+        def fail_extract_tarball(path, target):
+            raise AssertionError('A tarball not matching the expected digest was extracted')
+        monkeypatch.setattr(pkgpanda, 'extract_tarball', fail_extract_tarball)
+        tmpdir.join('peer', 'mesos--0.22.0', 'pkginfo.json').write('{}')
+        target = str(tmpdir.join('changed'))
+        assert peer_fetcher([peer_url], 'mesos--0.22.0', target, expected_digest) is None
+        assert not os.path.exists(target)
+
+        # Neither can the peer vouch for the changed files with its own digest.
+        tmpdir.join('peer', Repository.DIGESTS_DIR, 'mesos--0.22.0').write(
+            get_content_digest(repository.package_path('mesos--0.22.0')))
+        target = str(tmpdir.join('changed'))
+        assert peer_fetcher([peer_url], 'mesos--0.22.0', target, expected_digest) is None
+        assert not os.path.exists(target)
+    finally:
+        server.shutdown()
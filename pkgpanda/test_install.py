@@ -1,5 +1,6 @@
 """ Test reading and changing the active set of available packages"""
 
+import os
 import shutil
 
 import pytest
@@ -96,3 +97,74 @@ def test_recovery_move_new(tmpdir):
             "include": [".gitignore"],
             "lib": ["libmesos.so"]
         })
+
+
+def _link_farm(root):
+    # Every folder and symlink target under the well known folders of an install root.
+    farm = {}
+    for name in ["bin", "etc", "include", "lib"]:
+        for dir_path, dirs, files in os.walk(os.path.join(root, name)):
+            for entry in dirs + files:
+                path = os.path.join(dir_path, entry)
+                rel = os.path.relpath(path, root)
+                farm[rel] = os.readlink(path) if os.path.islink(path) else os.path.isdir(path)
+    return farm
+
+
+def _make_install(root, config_dir):
+    os.makedirs(root, exist_ok=True)
+    return Install(root, config_dir, True, False, True, skip_systemd_dirs=True)
+
+
+# TODO: DCOS_OSS-3471 - muted Windows tests requiring investigation
+@pytest.mark.skipif(is_windows, reason="test fails on Windows reason unknown")
+def test_activate_incremental(tmpdir):
+    shutil.copytree(resources_test_dir("packages"), str(tmpdir.join("repository")), symlinks=True)
+    # A package which stays active and shares the bin and lib folders with the replaced mesos.
+    tools = tmpdir.join("repository", "tools--1.0")
+    tools.join("bin", "tool").write("", ensure=True)
+    tools.join("lib", "libtool.so").write("", ensure=True)
+    tools.join("pkginfo.json").write("{}")
+    tools.join("buildinfo.full.json").write("{}")
+    repository = Repository(str(tmpdir.join("repository")))
+    old_ids = ["mesos--0.22.0", "mesos-config--ffddcfb53168d42f92e4771c6f8a8a9a818fd6b8", "tools--1.0"]
+    new_ids = ["mesos--0.23.0", "mesos-config--ffddcfb53168d42f92e4771c6f8a8a9a818fd6b8", "tools--1.0"]
+
+    def reused_mesos_links(root):
+        # Links still pointing into the replaced mesos package.
+        return {path for path, target in _link_farm(str(root)).items()
+                if isinstance(target, str) and "mesos--0.22.0" in target}
+
+    # The configuration has the master role, so the bin_master folders get linked as well.
+    config_dir = resources_test_dir("etc-active")
+    install = _make_install(str(tmpdir.join("install")), config_dir)
+    install.activate(repository.load_packages(old_ids))
+    config_link = tmpdir.join("install", "etc", "foobar")
+    config_inode = os.lstat(str(config_link)).st_ino
+    tools_inodes = {path: os.lstat(str(tmpdir.join("install", path))).st_ino for path in ["bin/tool", "lib/libtool.so"]}
+    install.activate(repository.load_packages(new_ids), incremental=True)
+
+    full = _make_install(str(tmpdir.join("full")), config_dir)
+    full.activate(repository.load_packages(new_ids))
+
+    assert _link_farm(str(tmpdir.join("install"))) == _link_farm(str(tmpdir.join("full")))
+    assert "bin/mesos-master" in _link_farm(str(tmpdir.join("install")))
+    assert install.get_active() == set(new_ids)
+    # The link of the unchanged package was reused.
+    assert os.lstat(str(config_link)).st_ino == config_inode
+
+    # The bin and lib links of the unchanged package were reused too, even though the replaced package has bin and
+    # lib folders as well.
+    for path, inode in tools_inodes.items():
+        assert os.lstat(str(tmpdir.join("install", path))).st_ino == inode
+    assert "bin/mesos-master" not in reused_mesos_links(tmpdir.join("install"))
+
+    # Dropping the master role drops the links of the role folders of the unchanged packages too.
+    no_roles = tmpdir.join("no_roles")
+    no_roles.mkdir()
+    install = _make_install(str(tmpdir.join("install")), str(no_roles))
+    install.activate(repository.load_packages(new_ids), incremental=True)
+    full = _make_install(str(tmpdir.join("full")), str(no_roles))
+    full.activate(repository.load_packages(new_ids))
+    assert _link_farm(str(tmpdir.join("install"))) == _link_farm(str(tmpdir.join("full")))
+    assert "bin/mesos-master" not in _link_farm(str(tmpdir.join("install")))
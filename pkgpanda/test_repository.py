@@ -1,11 +1,17 @@
 """Test functionality of the local package repository"""
 
+import os
+import shutil
+import stat
+
 import pytest
 
+import pkgpanda
 import pkgpanda.exceptions
 from pkgpanda import Repository
 
-from pkgpanda.util import is_windows, resources_test_dir
+from pkgpanda.util import (extract_tarball, get_content_digest, is_windows, load_json, resources_test_dir,
+                           write_json)
 
 
 @pytest.fixture
@@ -32,3 +38,113 @@ def test_load_bad(repository):
 def test_load_nonexistant(repository):
     with pytest.raises(pkgpanda.exceptions.PackageError):
         repository.load_packages(["missing-package--42"])
+
+
+def test_get_ids(repository):
+    assert sorted(repository.get_ids('mesos')) == ['mesos--0.22.0', 'mesos--0.23.0']
+    assert repository.get_ids('missing') == []
+
+
+def _copy_repository(tmpdir):
+    shutil.copytree(resources_test_dir("packages"), str(tmpdir.join("packages")))
+    shutil.rmtree(str(tmpdir.join("packages", "invalid-package")))
+    return str(tmpdir.join("packages"))
+
+
+# TODO: DCOS_OSS-3464 - muted Windows tests requiring investigation
+@pytest.mark.skipif(is_windows, reason="test fails on Windows reason unknown")
+def test_add_remove_updates_index(tmpdir):
+    repository = Repository(_copy_repository(tmpdir))
+    assert not repository.has_package('mesos--0.24.0')
+
+    def fetcher(id, target):
+        shutil.copytree(repository.package_path('mesos--0.23.0'), target)
+
+    assert repository.add(fetcher, 'mesos--0.24.0')
+    assert repository.has_package('mesos--0.24.0')
+    assert sorted(repository.get_ids('mesos')) == ['mesos--0.22.0', 'mesos--0.23.0', 'mesos--0.24.0']
+    assert str(repository.load('mesos--0.24.0').id) == 'mesos--0.24.0'
+
+    repository.remove('mesos--0.22.0')
+    assert not repository.has_package('mesos--0.22.0')
+    assert sorted(repository.get_ids('mesos')) == ['mesos--0.23.0', 'mesos--0.24.0']
+    with pytest.raises(pkgpanda.exceptions.PackageNotFound):
+        repository.load('mesos--0.22.0')
+
+
+# TODO: DCOS_OSS-3464 - muted Windows tests requiring investigation
+@pytest.mark.skipif(is_windows, reason="test fails on Windows reason unknown")
+def test_index_file(tmpdir, monkeypatch):
+    path = _copy_repository(tmpdir)
+    index_file = str(tmpdir.join("index.json"))
+    # Make the repository folder old enough for its index to be stored.
+    os.utime(path, ns=(0, 0))
+
+    repository = Repository(path, index_file)
+    assert repository.load('mesos--0.22.0').requires == []
+    assert load_json(index_file)['pkginfos'].keys() == {'mesos--0.22.0'}
+
+    # A later repository object uses the stored index rather than listing the folder or reading pkginfo.json.
+    def listdir(path):
+        raise AssertionError('The repository was listed.')
+
+    def load_index_only(filename):
+        assert filename == index_file
+        return load_json(filename)
+
+    with monkeypatch.context() as m:
+        m.setattr(os, 'listdir', listdir)
+        m.setattr(pkgpanda, 'load_json', load_index_only)
+        repository = Repository(path, index_file)
+        assert repository.list() == {'mesos-config--ffddcfb53168d42f92e4771c6f8a8a9a818fd6b8',
+                                     'mesos--0.22.0',
+                                     'mesos--0.23.0',
+                                     'mesos-config--justmesos'}
+        assert repository.load('mesos--0.22.0').requires == []
+
+    # Modifying the repository folder invalidates the stored index.
+    shutil.rmtree(os.path.join(path, 'mesos--0.23.0'))
+    repository = Repository(path, index_file)
+    assert repository.get_ids('mesos') == ['mesos--0.22.0']
+
+
+# TODO: DCOS_OSS-3464 - muted Windows tests requiring investigation
+@pytest.mark.skipif(is_windows, reason="test fails on Windows reason unknown")
+def test_index_file_in_repository(tmpdir):
+    path = _copy_repository(tmpdir)
+    index_file = os.path.join(path, Repository.INDEX_DIR, 'index.json')
+    os.utime(path, ns=(0, 0))
+
+    # Creating INDEX_DIR modifies the repository folder, so the index is only stored once that's old enough again.
+    Repository(path, index_file).list()
+    assert not os.path.exists(index_file)
+    os.utime(path, ns=(0, 0))
+    assert len(Repository(path, index_file).list()) == 4
+    assert stat.S_IMODE(os.stat(index_file).st_mode) == 0o600
+    assert os.stat(path).st_mtime_ns == 0
+
+    # An index other users could have written isn't used.
+    index = load_json(index_file)
+    index['packages'].append('evil--1')
+    index['pkginfos']['evil--1'] = {'requires': [], 'username': 'root'}
+    write_json(index_file, index)
+    os.chmod(index_file, 0o666)
+    repository = Repository(path, index_file)
+    assert not repository.has_package('evil--1')
+    assert len(repository.list()) == 4
+
+
+# TODO: DCOS_OSS-3464 - muted Windows tests requiring investigation
+@pytest.mark.skipif(is_windows, reason="test fails on Windows reason unknown")
+def test_integrity_check(tmpdir):
+    repository = Repository(str(tmpdir.join("packages")))
+    tarball = resources_test_dir("remote_repo/packages/mesos/mesos--0.22.0.tar.xz")
+    assert repository.add(lambda _, target: extract_tarball(tarball, target), 'mesos--0.22.0')
+    assert repository.get_digest('mesos--0.22.0') == get_content_digest(repository.package_path('mesos--0.22.0'))
+    assert repository.integrity_check() == []
+
+    tmpdir.join("packages", "mesos--0.22.0", "pkginfo.json").write('{}')
+    assert repository.integrity_check() == ['mesos--0.22.0']
+
+    repository.remove('mesos--0.22.0')
+    assert repository.get_digest('mesos--0.22.0') is None
@@ -264,6 +264,78 @@ def test_activate(tmpdir):
     # TODO(cmaloney): Test a full OS setup using http://0pointer.de/blog/projects/changing-roots.html
 
 
+# TODO: DCOS_OSS-3465 - muted Windows tests requiring investigation
+@pytest.mark.skipif(is_windows, reason="test fails on Windows reason unknown")
+def test_activate_incremental(tmpdir):
+    repo_path = tmp_repository(tmpdir)
+    tmpdir.join("root", "bootstrap").write("", ensure=True)
+
+    check_call(["pkgpanda",
+                "setup",
+                "--root={0}/root".format(tmpdir),
+                "--rooted-systemd",
+                "--repository={}".format(repo_path),
+                "--config-dir={}".format(resources_test_dir("etc-active")),
+                "--no-systemd"
+                ])
+
+    assert run(["pkgpanda",
+                "activate",
+                "mesos--0.22.0",
+                "mesos-config--ffddcfb53168d42f92e4771c6f8a8a9a818fd6b8",
+                "--root={0}/root".format(tmpdir),
+                "--rooted-systemd",
+                "--repository={}".format(repo_path),
+                "--config-dir=../resources/etc-active",
+                "--no-systemd"]) == ""
+
+    mesos_bin = tmpdir.join("root", "bin", "mesos")
+    mesos_bin_inode = os.lstat(str(mesos_bin)).st_ino
+
+    # Swap out one package, the links of the unchanged mesos package are carried over.
+    assert run(["pkgpanda",
+                "swap",
+                "mesos-config--justmesos",
+                "--root={0}/root".format(tmpdir),
+                "--rooted-systemd",
+                "--repository={}".format(repo_path),
+                "--config-dir=../resources/etc-active",
+                "--no-systemd",
+                "--incremental"]) == ""
+
+    active = set(check_output([
+        "pkgpanda",
+        "active",
+        "--root={0}/root".format(tmpdir),
+        "--rooted-systemd",
+        "--repository={}".format(repo_path),
+        "--config-dir=../resources/etc-active"]).decode().split())
+
+    assert active == {"mesos--0.22.0", "mesos-config--justmesos"}
+    assert os.lstat(str(mesos_bin)).st_ino == mesos_bin_inode
+
+    assert run(["pkgpanda",
+                "activate",
+                "mesos--0.23.0",
+                "--root={0}/root".format(tmpdir),
+                "--rooted-systemd",
+                "--repository={}".format(repo_path),
+                "--config-dir=../resources/etc-active",
+                "--no-systemd",
+                "--incremental"]) == ""
+
+    active = set(check_output([
+        "pkgpanda",
+        "active",
+        "--root={0}/root".format(tmpdir),
+        "--rooted-systemd",
+        "--repository={}".format(repo_path),
+        "--config-dir=../resources/etc-active"]).decode().split())
+
+    assert active == {"mesos--0.23.0"}
+    assert "mesos--0.23.0" in os.readlink(str(mesos_bin))
+
+
 # TODO: DCOS_OSS-3465 - muted Windows tests requiring investigation
 @pytest.mark.skipif(is_windows, reason="test fails on Windows reason unknown")
 def test_systemd_unit_files(tmpdir):
@@ -1,5 +1,13 @@
+import errno
+import io
 import os
+import re
+import shutil
+import stat
+import tarfile
 import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 from http.server import BaseHTTPRequestHandler, HTTPServer
 from subprocess import CalledProcessError
 from threading import Thread
@@ -462,7 +470,7 @@ def test_download_remote_file(tmpdir, mock_download_server):
     url = 'http://localhost:{port}/foobar.txt'.format(port=mock_download_server.server_port)
 
     out_file = os.path.join(str(tmpdir), 'foobar.txt')
-    response = pkgpanda.util._download_remote_file(out_file, url)
+    response, digest = pkgpanda.util._download_remote_file(out_file, url)
 
     response_is_ok = response.ok
     assert response_is_ok
@@ -471,6 +479,98 @@ def test_download_remote_file(tmpdir, mock_download_server):
 
     with open(out_file, 'rb') as f:
         assert f.read() == b'foobar'
+    assert digest == pkgpanda.util.sha1(out_file)
+
+
+class MockRangeDownloadServerRequestHandler(BaseHTTPRequestHandler):
+    body = b'0123456789' * 1000
+
+    def do_GET(self):  # noqa: N802
+        self.server.requests.append(dict(self.headers))
+        start = 0
+        match = re.match(r'bytes=(\d+)-$', self.headers.get('Range', ''))
+        if match and self.headers.get('If-Range') == '"v1"':
+            start = int(match.group(1))
+            self.send_response(requests.codes.partial_content)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, len(self.body) - 1, len(self.body)))
+        else:
+            self.send_response(requests.codes.ok)
+        self.send_header('ETag', '"v1"')
+        self.send_header('Content-Length', str(len(self.body) - start))
+        self.end_headers()
+
+        if len(self.server.requests) == 1:
+            # Cut the first response short.
+            self.wfile.write(self.body[:3000])
+        else:
+            self.wfile.write(self.body[start:])
+
+
+def test_download_remote_file_resumes(tmpdir):
+    server = HTTPServer(('localhost', 0), MockRangeDownloadServerRequestHandler)
+    server.requests = []
+    Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        url = 'http://localhost:{port}/foobar.txt'.format(port=server.server_port)
+        out_file = os.path.join(str(tmpdir), 'foobar.txt')
+        digest = pkgpanda.util.download(out_file, url, str(tmpdir))
+    finally:
+        server.shutdown()
+
+    # The retry only asked for the part missing from the first attempt.
+    assert len(server.requests) == 2
+    assert 'Range' not in server.requests[0]
+    assert server.requests[1]['Range'] == 'bytes=3000-'
+    assert server.requests[1]['If-Range'] == '"v1"'
+
+    with open(out_file, 'rb') as f:
+        assert f.read() == MockRangeDownloadServerRequestHandler.body
+    assert digest == pkgpanda.util.sha1(out_file)
+
+
+class MockRangeIgnoringDownloadServerRequestHandler(BaseHTTPRequestHandler):
+    body = b'0123456789' * 1000
+
+    def do_GET(self):  # noqa: N802
+        self.server.requests.append(dict(self.headers))
+        start = 0
+        if 'Range' in self.headers:
+            # Answer from a fixed offset rather than the one asked for.
+            start = 1000
+            self.send_response(requests.codes.partial_content)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, len(self.body) - 1, len(self.body)))
+        else:
+            self.send_response(requests.codes.ok)
+        self.send_header('ETag', '"v1"')
+        self.send_header('Content-Length', str(len(self.body) - start))
+        self.end_headers()
+
+        if len(self.server.requests) == 1:
+            # Cut the first response short.
+            self.wfile.write(self.body[:3000])
+        else:
+            self.wfile.write(self.body[start:])
+
+
+def test_download_remote_file_restarts_on_wrong_range(tmpdir):
+    server = HTTPServer(('localhost', 0), MockRangeIgnoringDownloadServerRequestHandler)
+    server.requests = []
+    Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        url = 'http://localhost:{port}/foobar.txt'.format(port=server.server_port)
+        out_file = os.path.join(str(tmpdir), 'foobar.txt')
+        digest = pkgpanda.util.download(out_file, url, str(tmpdir))
+    finally:
+        server.shutdown()
+
+    # The range starting at the wrong offset was dropped and the whole file requested again.
+    assert len(server.requests) == 3
+    assert server.requests[1]['Range'] == 'bytes=3000-'
+    assert 'Range' not in server.requests[2]
+
+    with open(out_file, 'rb') as f:
+        assert f.read() == MockRangeIgnoringDownloadServerRequestHandler.body
+    assert digest == pkgpanda.util.sha1(out_file)
 
 
 def test_download_remote_file_without_content_length(tmpdir, mock_download_server):
@@ -480,7 +580,7 @@ def test_download_remote_file_without_content_length(tmpdir, mock_download_serve
         port=mock_download_server.server_port)
 
     out_file = os.path.join(str(tmpdir), 'foobar.txt')
-    response = pkgpanda.util._download_remote_file(out_file, url)
+    response, digest = pkgpanda.util._download_remote_file(out_file, url)
 
     response_is_ok = response.ok
     assert response_is_ok
@@ -489,3 +589,312 @@ def test_download_remote_file_without_content_length(tmpdir, mock_download_serve
 
     with open(out_file, 'rb') as f:
         assert f.read() == b'fooba'
+
+
+@pytest.mark.skipif(pkgpanda.util.is_windows, reason="Windows always uses gzip")
+@pytest.mark.parametrize('compression', ['xz', 'xz:1', 'xz-parallel', 'gz', 'zstd:1'])
+def test_make_tar_compression(tmpdir, monkeypatch, compression):
+    if compression.startswith('zstd') and shutil.which('zstd') is None:
+        pytest.skip('zstd is not installed')
+
+    # Use small blocks so xz-parallel compresses more than one.
+    monkeypatch.setattr(pkgpanda.util, 'XZ_PARALLEL_BLOCK_SIZE', 4096)
+
+    source = tmpdir.mkdir('source')
+    source.join('foo').write('foo')
+    source.mkdir('bar').join('baz').write(os.urandom(64 * 1024), mode='wb')
+
+    tarball = str(tmpdir.join('result.tar.xz'))
+    pkgpanda.util.make_tar(tarball, str(source), compression)
+    if compression == 'xz-parallel':
+        with open(tarball, 'rb') as f:
+            assert f.read().count(b'\xfd7zXZ\x00') > 1
+
+    target = tmpdir.join('target')
+    pkgpanda.util.extract_tarball(tarball, str(target))
+    assert target.join('foo').read() == 'foo'
+    assert target.join('bar', 'baz').read(mode='rb') == source.join('bar', 'baz').read(mode='rb')
+
+    with pkgpanda.util.open_tar_stream(tarball) as tar:
+        contents = {member.name: tar.extractfile(member).read() for member in tar if member.isfile()}
+    assert contents == {'./foo': b'foo', './bar/baz': source.join('bar', 'baz').read(mode='rb')}
+
+
+@pytest.mark.skipif(pkgpanda.util.is_windows, reason="Windows extracts with bsdtar")
+@pytest.mark.parametrize('native_xz', [True, False])
+@pytest.mark.parametrize('read_ahead', [True, False])
+def test_extract_tarball_digest(tmpdir, monkeypatch, native_xz, read_ahead):
+    monkeypatch.setattr(pkgpanda.util, '_NATIVE_XZ_DECOMPRESSION', native_xz)
+    monkeypatch.setattr(pkgpanda.util, 'READ_AHEAD_CHUNK_SIZE', 1024)
+
+    source = tmpdir.mkdir('source')
+    source.join('foo').write('foo')
+    source.join('foo').chmod(0o755)
+    source.mkdir('bar').join('baz').write(os.urandom(64 * 1024), mode='wb')
+    os.link(str(source.join('foo')), str(source.join('bar', 'foo')))
+    os.symlink('../foo', str(source.join('bar', 'link')))
+    tarball = str(tmpdir.join('result.tar.xz'))
+    pkgpanda.util.make_tar(tarball, str(source), 'xz')
+
+    target = tmpdir.join('target')
+    digest = pkgpanda.util.extract_tarball(tarball, str(target), read_ahead)
+    assert target.join('bar', 'baz').read(mode='rb') == source.join('bar', 'baz').read(mode='rb')
+    assert target.join('bar', 'foo').read() == 'foo'
+    assert os.stat(str(target.join('foo'))).st_mode & 0o777 == 0o755
+    assert os.readlink(str(target.join('bar', 'link'))) == '../foo'
+
+    assert digest == pkgpanda.util.get_content_digest(str(target))
+    assert digest == pkgpanda.util.get_content_digest(str(source))
+    assert digest == pkgpanda.util.get_tarball_content_digest(tarball)
+    target.join('bar', 'baz').write('changed')
+    assert digest != pkgpanda.util.get_content_digest(str(target))
+
+
+def _make_bad_tarball(filename, members):
+    with tarfile.open(filename, 'w:gz') as tar:
+        for name, linkname in members:
+            info = tarfile.TarInfo(name)
+            if linkname is not None:
+                info.type = tarfile.SYMTYPE
+                info.linkname = linkname
+                tar.addfile(info)
+            else:
+                info.size = 3
+                tar.addfile(info, io.BytesIO(b'bad'))
+
+
+@pytest.mark.skipif(pkgpanda.util.is_windows, reason="Windows extracts with bsdtar")
+@pytest.mark.parametrize('members', [
+    [('../evil', None)],
+    [('/evil', None)],
+    [('./link', '..'), ('./link/evil', None)],
+])
+def test_extract_tarball_outside(tmpdir, members):
+    tarball = str(tmpdir.join('bad.tar.gz'))
+    _make_bad_tarball(tarball, members)
+    target = tmpdir.join('target')
+    with pytest.raises(ValidationError):
+        pkgpanda.util.extract_tarball(tarball, str(target))
+    assert not target.check()
+    assert not tmpdir.join('evil').check()
+
+
+@pytest.mark.skipif(pkgpanda.util.is_windows, reason="Windows extracts with bsdtar")
+def test_extract_tarball_hardlink_to_replaced_file(tmpdir):
+    outside = tmpdir.join('outside')
+    outside.write('outside')
+    outside.chmod(0o600)
+
+    tarball = str(tmpdir.join('bad.tar.gz'))
+    with tarfile.open(tarball, 'w:gz') as tar:
+        info = tarfile.TarInfo('x')
+        info.size = 3
+        info.mode = 0o666
+        tar.addfile(info, io.BytesIO(b'bad'))
+        info = tarfile.TarInfo('x')
+        info.type = tarfile.SYMTYPE
+        info.linkname = str(outside)
+        tar.addfile(info)
+        info = tarfile.TarInfo('y')
+        info.type = tarfile.LNKTYPE
+        info.linkname = 'x'
+        info.mode = 0o666
+        tar.addfile(info)
+
+    with pytest.raises(ValidationError):
+        pkgpanda.util.extract_tarball(tarball, str(tmpdir.join('target')))
+    with pytest.raises(ValidationError):
+        pkgpanda.util.get_tarball_content_digest(tarball)
+    assert stat.S_IMODE(os.stat(str(outside)).st_mode) == 0o600
+    assert outside.read() == 'outside'
+
+
+def test_get_compression(monkeypatch):
+    monkeypatch.delenv(pkgpanda.util.COMPRESSION_ENV_VAR, raising=False)
+    monkeypatch.setattr(pkgpanda.util, 'is_windows', False)
+    assert pkgpanda.util.get_compression() == 'xz'
+    assert pkgpanda.util.get_compression('zstd:19') == 'zstd:19'
+
+    monkeypatch.setenv(pkgpanda.util.COMPRESSION_ENV_VAR, 'xz-parallel:9')
+    assert pkgpanda.util.get_compression() == 'xz-parallel:9'
+    assert pkgpanda.util.parse_compression('xz-parallel:9') == ('xz-parallel', 9)
+
+    # Published tarballs can't be made with zstd.
+    monkeypatch.setenv(pkgpanda.util.COMPRESSION_ENV_VAR, 'zstd')
+    with pytest.raises(ValidationError):
+        pkgpanda.util.get_compression()
+
+    with pytest.raises(ValidationError):
+        pkgpanda.util.get_compression('bz2')
+    with pytest.raises(ValidationError):
+        pkgpanda.util.get_compression('xz:high')
+
+
+def test_file_hash_cache(tmpdir, monkeypatch):
+    cache_filename = str(tmpdir.join('cache', 'file_hashes.json'))
+    path = tmpdir.join('file')
+    path.write('foo')
+    # Old enough to be cached.
+    os.utime(str(path), (0, 0))
+    expected = pkgpanda.util.sha1(str(path))
+
+    hashed = []
+    sha1 = pkgpanda.util.sha1
+
+    def counting_sha1(filename):
+        hashed.append(filename)
+        return sha1(filename)
+
+    monkeypatch.setattr(pkgpanda.util, 'sha1', counting_sha1)
+
+    cache = pkgpanda.util.FileHashCache(cache_filename)
+    assert cache.sha1(str(path)) == expected
+    assert cache.sha1(str(path)) == expected
+    assert len(hashed) == 1
+    cache.save()
+
+    # The cache persists.
+    cache = pkgpanda.util.FileHashCache(cache_filename)
+    assert cache.sha1(str(path)) == expected
+    assert len(hashed) == 1
+
+    # Changing the file changes its size / mtime, so it's hashed again.
+    path.write('foobar')
+    assert cache.sha1(str(path)) == sha1(str(path))
+    assert len(hashed) == 2
+
+    # Recently modified files aren't cached as a change in the same mtime tick wouldn't be noticed.
+    assert cache.sha1(str(path)) == sha1(str(path))
+    assert len(hashed) == 3
+
+
+def test_file_hash_cache_corrupt(tmpdir):
+    cache_filename = tmpdir.join('file_hashes.json')
+    cache_filename.write('{not json')
+    path = tmpdir.join('file')
+    path.write('foo')
+    assert pkgpanda.util.FileHashCache(str(cache_filename)).sha1(str(path)) == pkgpanda.util.sha1(str(path))
+
+
+def test_file_lock(tmpdir):
+    lock_filename = str(tmpdir.join('locks', 'lock'))
+    holders = []
+    overlaps = []
+
+    def hold_lock():
+        for _ in range(20):
+            with pkgpanda.util.file_lock(lock_filename):
+                holders.append(None)
+                if len(holders) > 1:
+                    overlaps.append(None)
+                holders.pop()
+
+    threads = [Thread(target=hold_lock) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not overlaps
+
+
+def test_file_lock_windows(tmpdir, monkeypatch):
+    class FakeMsvcrt:
+        LK_LOCK = 1
+        LK_UNLCK = 0
+
+        def __init__(self, errors):
+            self.errors = list(errors)
+            self.calls = []
+
+        def locking(self, fd, mode, nbytes):
+            self.calls.append(mode)
+            if mode == self.LK_LOCK and self.errors:
+                raise OSError(self.errors.pop(0), 'locking failed')
+
+    lock_filename = str(tmpdir.join('lock'))
+    monkeypatch.setattr(pkgpanda.util, 'is_windows', True)
+
+    # LK_LOCK timing out is retried.
+    msvcrt = FakeMsvcrt([errno.EDEADLOCK, errno.EDEADLOCK])
+    monkeypatch.setattr(pkgpanda.util, 'msvcrt', msvcrt, raising=False)
+    with pkgpanda.util.file_lock(lock_filename):
+        pass
+    assert msvcrt.calls == [1, 1, 1, 0]
+
+    # Other errors aren't.
+    msvcrt = FakeMsvcrt([errno.EBADF])
+    monkeypatch.setattr(pkgpanda.util, 'msvcrt', msvcrt, raising=False)
+    with pytest.raises(OSError):
+        with pkgpanda.util.file_lock(lock_filename):
+            pass
+    assert msvcrt.calls == [1]
+
+    # Nor is LK_LOCK timing out forever.
+    monkeypatch.setattr(pkgpanda.util, 'FILE_LOCK_WINDOWS_ATTEMPTS', 3)
+    msvcrt = FakeMsvcrt([errno.EDEADLOCK] * 10)
+    monkeypatch.setattr(pkgpanda.util, 'msvcrt', msvcrt, raising=False)
+    with pytest.raises(OSError):
+        with pkgpanda.util.file_lock(lock_filename):
+            pass
+    assert msvcrt.calls == [1, 1, 1]
+
+
+def test_tracer(tmpdir):
+    tracer = pkgpanda.util.Tracer()
+
+    # Nothing is recorded until enabled.
+    with tracer.span('ignored'):
+        pass
+    assert tracer.spans() == []
+
+    tracer.enable()
+    with tracer.span('run', 'test'):
+        with tracer.span('setup'):
+            time.sleep(0.01)
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            def work(name, seconds):
+                with tracer.span(name, 'work', seconds=seconds):
+                    time.sleep(seconds)
+
+            work = tracer.propagate(work)
+            executor.submit(work, 'short', 0.01)
+            executor.submit(work, 'long', 0.2)
+    with pytest.raises(ValueError):
+        with tracer.span('failed'):
+            raise ValueError()
+
+    spans = {span.name: span for span in tracer.spans()}
+    assert spans['long'].parent is spans['run']
+    assert spans['failed'].args == {'error': 'ValueError'}
+
+    # The short work ran alongside the long one, so it isn't on the critical path.
+    assert [(depth, span.name) for depth, span in tracer.critical_path()] == [
+        (0, 'run'), (1, 'setup'), (1, 'long'), (0, 'failed')]
+    assert 'long' in tracer.format_critical_path()
+
+    trace_filename = str(tmpdir.join('trace.json'))
+    tracer.write_chrome_trace(trace_filename)
+    events = pkgpanda.util.load_json(trace_filename)['traceEvents']
+    complete = {event['name']: event for event in events if event['ph'] == 'X'}
+    assert complete.keys() == spans.keys()
+    assert complete['long']['cat'] == 'work'
+    assert complete['long']['args'] == {'seconds': 0.2}
+    assert complete['long']['dur'] >= 200000
+    assert complete['long']['tid'] != complete['run']['tid']
+    assert {event['tid'] for event in events if event['ph'] == 'M'} == {event['tid'] for event in complete.values()}
+
+
+def test_tracer_zero_length_spans(monkeypatch):
+    tracer = pkgpanda.util.Tracer()
+    tracer.enable()
+    # A clock too coarse to tell the start and end of the spans apart.
+    monkeypatch.setattr(pkgpanda.util.time, 'monotonic', lambda: 1.0)
+    with tracer.span('a'):
+        with tracer.span('b'):
+            pass
+        with tracer.span('c'):
+            pass
+
+    assert [(depth, span.name) for depth, span in tracer.critical_path()] == [(0, 'a'), (1, 'b'), (1, 'c')]
+    assert 'a' in tracer.format_critical_path()
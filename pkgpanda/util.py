@@ -1,16 +1,26 @@
+import collections
+import errno
+import gzip
 import hashlib
 import http.server
 import json
 import logging
+import lzma
 import os
 import platform
+import queue
 import re
 import shutil
+import signal
 import socketserver
 import stat
 import subprocess
+import sys
 import tarfile
 import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager, ExitStack
 from itertools import chain
 from multiprocessing import Process
@@ -30,6 +40,11 @@ from pkgpanda.exceptions import FetchError, IncompleteDownloadError, ValidationE
 
 is_windows = platform.system() == "Windows"
 
+if is_windows:
+    import msvcrt
+else:
+    import fcntl
+
 
 def is_absolute_path(path):
     if is_windows:
@@ -136,14 +151,16 @@ def variant_suffix(variant, delim='.'):
     return delim + variant
 
 
-def get_requests_retry_session(max_retries=4, backoff_factor=1, status_forcelist=None):
+def get_requests_retry_session(max_retries=4, backoff_factor=1, status_forcelist=None, pool_maxsize=10):
     status_forcelist = status_forcelist or [500, 502, 504]
     # Default max retries 4 with sleeping between retries 1s, 2s, 4s, 8s
     session = requests.Session()
     custom_retry = Retry(total=max_retries,
                          backoff_factor=backoff_factor,
                          status_forcelist=status_forcelist)
-    custom_adapter = HTTPAdapter(max_retries=custom_retry)
+    # pool_maxsize bounds the connections kept alive per host, so a session
+    # shared between download threads should be sized to the number of threads.
+    custom_adapter = HTTPAdapter(max_retries=custom_retry, pool_maxsize=pool_maxsize)
     # Any request through this session that starts with 'http://' or 'https://'
     # will use the custom Transport Adapter created which include retries
     session.mount('http://', custom_adapter)
@@ -151,34 +168,130 @@ def get_requests_retry_session(max_retries=4, backoff_factor=1, status_forcelist
     return session
 
 
+# Size of the chunks downloads are read and written in.
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+_shared_session = None
+_shared_session_lock = threading.Lock()
+
+
+def get_shared_requests_session():
+    """Return the requests session download() uses by default.
+
+    It's created once per process so connections to the same host are kept alive and reused between downloads.
+    """
+    global _shared_session
+    with _shared_session_lock:
+        if _shared_session is None:
+            _shared_session = get_requests_retry_session()
+        return _shared_session
+
+
 def _is_incomplete_download_error(exception):
     return isinstance(exception, IncompleteDownloadError)
 
 
+class _RemoteDownload:
+    """The state of a download kept between attempts, so a retry resumes where the last attempt stopped."""
+
+    def __init__(self, out_filename, url):
+        self.out_filename = out_filename
+        self.url = url
+        self.restart()
+
+    def restart(self):
+        self.size = 0
+        self.hasher = hashlib.sha1()
+        # ETag or Last-Modified of the full response, sent in If-Range so the server only sends the rest of the
+        # file if it hasn't changed since.
+        self.validator = None
+
+    def get_range_headers(self):
+        if not self.size:
+            return {}
+        headers = {'Range': 'bytes={}-'.format(self.size)}
+        if self.validator:
+            headers['If-Range'] = self.validator
+        return headers
+
+    def is_resumed_by(self, response):
+        if response.status_code != requests.codes.partial_content:
+            return False
+        match = re.match(r'bytes (\d+)-', response.headers.get('content-range', ''))
+        return match is not None and int(match.group(1)) == self.size
+
+    def set_validator(self, response):
+        etag = response.headers.get('etag')
+        if etag and not etag.startswith('W/'):
+            # Weak ETags can't be used in If-Range.
+            self.validator = etag
+        else:
+            self.validator = response.headers.get('last-modified')
+
+
 @retrying.retry(
     stop_max_attempt_number=3,
     wait_random_min=1000,
     wait_random_max=2000,
     retry_on_exception=_is_incomplete_download_error)
-def _download_remote_file(out_filename, url):
-    with open(out_filename, "wb") as f:
-        r = get_requests_retry_session().get(url, stream=True)
-        r.raise_for_status()
+def _continue_download(download, session):
+    r = session.get(download.url, stream=True, headers=download.get_range_headers())
+    if r.status_code == requests.codes.requested_range_not_satisfiable or (
+            r.status_code == requests.codes.partial_content and not download.is_resumed_by(r)):
+        # The server can't resume from where the last attempt stopped, or sent a range starting elsewhere.
+        # Start over and ask for the whole file.
+        r.close()
+        download.restart()
+        r = session.get(download.url, stream=True)
+    r.raise_for_status()
+
+    if download.size and download.is_resumed_by(r):
+        mode = 'ab'
+    elif r.status_code == requests.codes.ok:
+        # Either a fresh download or the server sent the whole file.
+        download.restart()
+        download.set_validator(r)
+        mode = 'wb'
+    else:
+        r.close()
+        raise requests.exceptions.HTTPError(
+            'Unexpected {} response downloading {}'.format(r.status_code, download.url),
+            response=r)
+
+    content_length = int(r.headers['content-length']) if 'content-length' in r.headers else None
+    total_bytes_read = 0
+    with open(download.out_filename, mode) as f:
+        try:
+            for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                f.write(chunk)
+                download.hasher.update(chunk)
+                download.size += len(chunk)
+                total_bytes_read += len(chunk)
+        except (requests.exceptions.ChunkedEncodingError, requests.exceptions.ConnectionError) as ex:
+            # The connection broke, retry from what was received.
+            raise IncompleteDownloadError(download.url, total_bytes_read, content_length) from ex
+
+    if content_length is not None and total_bytes_read != content_length:
+        raise IncompleteDownloadError(download.url, total_bytes_read, content_length)
 
-        total_bytes_read = 0
-        for chunk in r.iter_content(chunk_size=4096):
-            f.write(chunk)
-            total_bytes_read += len(chunk)
+    return r
 
-        if 'content-length' in r.headers:
-            content_length = int(r.headers['content-length'])
-            if total_bytes_read != content_length:
-                raise IncompleteDownloadError(url, total_bytes_read, content_length)
 
-        return r
+def _download_remote_file(out_filename, url, session=None):
+    """Download url to out_filename, resuming with a Range request if an attempt is cut short.
+
+    Returns the response of the last attempt and the sha1 of the downloaded file.
+    """
+    download = _RemoteDownload(out_filename, url)
+    r = _continue_download(download, session or get_shared_requests_session())
+    return r, download.hasher.hexdigest()
 
 
-def download(out_filename, url, work_dir, rm_on_error=True):
+def download(out_filename, url, work_dir, rm_on_error=True, session=None):
+    """Download url to out_filename and return the sha1 of the downloaded file.
+
+    file:// urls relative to work_dir are copied.
+    """
     assert os.path.isabs(out_filename)
     assert os.path.isabs(work_dir)
     work_dir = work_dir.rstrip('/')
@@ -194,8 +307,9 @@ def download(out_filename, url, work_dir, rm_on_error=True):
             if not os.path.isabs(src_filename):
                 src_filename = work_dir + '/' + src_filename
             shutil.copyfile(src_filename, out_filename)
+            return sha1(out_filename)
         else:
-            _download_remote_file(out_filename, url)
+            return _download_remote_file(out_filename, url, session)[1]
     except Exception as fetch_exception:
         if rm_on_error:
             rm_passed = False
@@ -215,11 +329,13 @@ def download(out_filename, url, work_dir, rm_on_error=True):
 
 
 def download_atomic(out_filename, url, work_dir):
+    """Download url to out_filename through a temporary file and return the sha1 of the downloaded file."""
     assert os.path.isabs(out_filename)
     tmp_filename = out_filename + '.tmp'
     try:
-        download(tmp_filename, url, work_dir)
+        digest = download(tmp_filename, url, work_dir)
         shutil.move(tmp_filename, out_filename)
+        return digest
     except FetchError:
         try:
             os.remove(tmp_filename)
@@ -228,8 +344,12 @@ def download_atomic(out_filename, url, work_dir):
         raise
 
 
-def extract_tarball(path, target):
-    """Extract the tarball into target.
+def extract_tarball(path, target, read_ahead=True):
+    """Extract the tarball into target and return the content digest of its files.
+
+    The digest is computed while extracting, get_content_digest() computes the same from the
+    extracted files. Members which would end up outside of target raise a ValidationError. With
+    read_ahead the tarball is decompressed on a separate thread from writing out its files.
 
     If there are any errors, delete the folder being extracted to.
     """
@@ -245,8 +365,9 @@ def extract_tarball(path, target):
         # https://bugs.python.org/issue21872 is fixed.
         if is_windows:
             check_call(['bsdtar', '-xf', path, '-C', target])
+            return get_content_digest(target)
         else:
-            check_call(['tar', '-xf', path, '-C', target])
+            return _extract_tar_stream(path, target, read_ahead)
 
     except:
         # If there are errors, we can't really cope since we are already in an error state.
@@ -347,12 +468,15 @@ def if_exists(fn, *args, **kwargs):
         return None
 
 
-def sha1(filename):
-    hasher = hashlib.sha1()
+# Size of the reads when hashing files. Large reads keep the per-read overhead low and let
+# hashlib release the GIL while hashing.
+HASH_BUFFER_SIZE = 1024 * 1024
+
 
+def _hash_file(hasher, filename):
     with open(filename, 'rb') as fh:
         while 1:
-            buf = fh.read(4096)
+            buf = fh.read(HASH_BUFFER_SIZE)
             if not buf:
                 break
             hasher.update(buf)
@@ -360,6 +484,106 @@ def sha1(filename):
     return hasher.hexdigest()
 
 
+def sha1(filename):
+    return _hash_file(hashlib.sha1(), filename)
+
+
+def sha256(filename):
+    return _hash_file(hashlib.sha256(), filename)
+
+
+# msvcrt.locking() with LK_LOCK gives up after trying for 10 seconds, so file_lock() tries it this many times,
+# 30 minutes in all, before raising.
+FILE_LOCK_WINDOWS_ATTEMPTS = 180
+
+
+@contextmanager
+def file_lock(filename):
+    """Hold an exclusive lock on filename, created if missing, for the duration of a with block.
+
+    The lock is advisory and is taken on a newly opened file, so it excludes other threads of this
+    process as well as other processes.
+    """
+    make_directory(os.path.dirname(filename))
+    with open(filename, 'a+b') as f:
+        if is_windows:
+            f.seek(0)
+            for attempt in range(FILE_LOCK_WINDOWS_ATTEMPTS):
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError as ex:
+                    # Anything but LK_LOCK giving up after 10 seconds is an actual error.
+                    if ex.errno != errno.EDEADLOCK or attempt == FILE_LOCK_WINDOWS_ATTEMPTS - 1:
+                        raise
+            try:
+                yield
+            finally:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+class FileHashCache:
+    """Persistent cache of file sha1s, keyed by path, size, mtime and inode.
+
+    Files are only read again if one of those changed since they were last hashed. The cache is
+    stored as JSON in filename by save(), and is safe to use from multiple threads.
+    """
+
+    VERSION = 1
+
+    # Files modified this recently aren't cached. A change within the same mtime tick as the
+    # hashing wouldn't change the mtime, so it would go unnoticed.
+    RACY_WINDOW_NS = 2 * 10 ** 9
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._changed = False
+        self._entries = dict()
+        try:
+            cache = load_json(filename)
+            if cache.get('version') == self.VERSION:
+                self._entries = cache['files']
+        except (OSError, ValueError, AttributeError, KeyError):
+            # A missing or unreadable cache just means everything is hashed again.
+            pass
+
+    def sha1(self, path):
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        key = [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+        with self._lock:
+            entry = self._entries.get(path)
+        if entry is not None and entry[:3] == key:
+            return entry[3]
+
+        digest = sha1(path)
+        if stat.st_mtime_ns < int(time.time() * 10 ** 9) - self.RACY_WINDOW_NS:
+            with self._lock:
+                self._entries[path] = key + [digest]
+                self._changed = True
+        return digest
+
+    def save(self):
+        """Write the cache out if anything was added, dropping entries for files which no longer exist."""
+        with self._lock:
+            if not self._changed:
+                return
+            self._entries = {path: entry for path, entry in self._entries.items() if os.path.exists(path)}
+            make_directory(os.path.dirname(self.filename))
+            tmp_filename = '{}.{}.tmp'.format(self.filename, os.getpid())
+            write_json(tmp_filename, {'version': self.VERSION, 'files': self._entries})
+            os.replace(tmp_filename, self.filename)
+            self._changed = False
+
+
 def expect_folder(path, files):
     path_contents = os.listdir(path)
     assert set(path_contents) == set(files)
@@ -384,17 +608,474 @@ def _tar_filter(tar_info: tarfile.TarInfo) -> tarfile.TarInfo:
     return tar_info
 
 
-def make_tar(result_filename, change_folder):
-    tar_mode = ''
+# Environment variable setting the compression make_tar() uses by default. See make_tar().
+COMPRESSION_ENV_VAR = 'PKGPANDA_COMPRESSION'
+COMPRESSION_CODECS = ('gz', 'xz', 'xz-parallel', 'zstd')
+# Codecs every node can decompress. Only these may be chosen with PKGPANDA_COMPRESSION, as it applies to the
+# package and bootstrap tarballs which are published.
+PUBLISHED_COMPRESSION_CODECS = ('gz', 'xz', 'xz-parallel')
+
+# Size of the blocks xz-parallel compresses independently. Three times the dictionary size of the
+# default preset, the same as `xz -T0` uses.
+XZ_PARALLEL_BLOCK_SIZE = 24 * 1024 * 1024
+
+_ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+_XZ_MAGIC = b'\xfd7zXZ\x00'
+_GZIP_MAGIC = b'\x1f\x8b'
+
+# The lzma module of Python before 3.7.4 can fail to decompress some valid xz files
+# (https://bugs.python.org/issue21872), so they're decompressed with the `xz` command instead.
+_NATIVE_XZ_DECOMPRESSION = sys.version_info >= (3, 7, 4)
+
+# Decompressed data read ahead by extract_tarball(), in chunks.
+READ_AHEAD_CHUNK_SIZE = 1024 * 1024
+READ_AHEAD_CHUNKS = 4
+
+
+def get_compression(compression=None):
+    """Return the compression make_tar() uses given compression, as '<codec>[:<level>]'.
+
+    If compression is None it's taken from the PKGPANDA_COMPRESSION environment variable, and
+    defaults to 'xz'. The environment variable may only choose one of PUBLISHED_COMPRESSION_CODECS.
+    Windows always uses 'gz'.
+    """
     if is_windows:
-        tar_mode = 'w:gz'
+        return 'gz'
+    from_env = compression is None
+    if from_env:
+        compression = os.environ.get(COMPRESSION_ENV_VAR) or 'xz'
+    codec, _ = parse_compression(compression)
+    if from_env and codec not in PUBLISHED_COMPRESSION_CODECS:
+        raise ValidationError("{} must be one of {} as the tarballs it applies to are published. Got {}".format(
+            COMPRESSION_ENV_VAR, ', '.join(PUBLISHED_COMPRESSION_CODECS), compression))
+    return compression
+
+
+def parse_compression(compression):
+    """Return the (codec, level) of a '<codec>[:<level>]' compression, level is None if not given."""
+    codec, _, level = compression.partition(':')
+    if codec not in COMPRESSION_CODECS:
+        raise ValidationError("Unknown compression {}. Must be one of {}".format(
+            compression, ', '.join(COMPRESSION_CODECS)))
+    if not level:
+        return codec, None
+    try:
+        return codec, int(level)
+    except ValueError:
+        raise ValidationError("Compression level must be an integer. Got {}".format(compression))
+
+
+def _get_tar_compression(path):
+    # The codec a tarball is compressed with, from its magic bytes.
+    with open(path, 'rb') as f:
+        magic = f.read(len(_XZ_MAGIC))
+    if magic.startswith(_ZSTD_MAGIC):
+        return 'zstd'
+    if magic.startswith(_XZ_MAGIC):
+        return 'xz'
+    if magic.startswith(_GZIP_MAGIC):
+        return 'gz'
+    return None
+
+
+class _ParallelXzWriter:
+    """Write-only file object xz compressing what's written to it into fileobj using all cores.
+
+    The data is cut into blocks which are compressed independently into complete xz streams on a
+    thread pool (lzma releases the GIL while compressing). Any xz decoder reads the concatenated
+    streams as one.
+    """
+
+    def __init__(self, fileobj, preset=None):
+        self._fileobj = fileobj
+        self._preset = preset
+        self._block_size = XZ_PARALLEL_BLOCK_SIZE
+        self._buffer = bytearray()
+        self._max_workers = os.cpu_count() or 1
+        self._executor = ThreadPoolExecutor(max_workers=self._max_workers)
+        self._pending = collections.deque()
+        self._blocks = 0
+
+    def write(self, data):
+        self._buffer += data
+        while len(self._buffer) >= self._block_size:
+            self._compress(bytes(self._buffer[:self._block_size]))
+            del self._buffer[:self._block_size]
+        return len(data)
+
+    def _compress(self, block):
+        self._blocks += 1
+        self._pending.append(self._executor.submit(lzma.compress, block, preset=self._preset))
+        # Write out compressed blocks in order as they finish, keeping the memory used bounded.
+        while len(self._pending) > 2 * self._max_workers or (self._pending and self._pending[0].done()):
+            self._fileobj.write(self._pending.popleft().result())
+
+    def close(self):
+        try:
+            if self._buffer or self._blocks == 0:
+                self._compress(bytes(self._buffer))
+                self._buffer = bytearray()
+            while self._pending:
+                self._fileobj.write(self._pending.popleft().result())
+        finally:
+            self._executor.shutdown()
+
+
+@contextmanager
+def open_tar_writer(result_filename, compression=None):
+    """Open a tarfile.TarFile writing a tarball to result_filename, for use in a with statement.
+
+    compression is '<codec>[:<level>]' (see get_compression() for the default) with codec one of:
+    - xz: xz on a single core, level is the preset (0-9, default 6).
+    - xz-parallel: xz compressed in independent blocks on all cores. Slightly larger than xz, but
+      any xz decoder can read it.
+    - zstd: zstd on all cores using the `zstd` command, level defaults to 3. Only for tarballs
+      which never leave the build hosts (caches), as hosts may not be able to decompress it. It
+      has to be passed explicitly, PKGPANDA_COMPRESSION can't select it.
+    - gz: gzip, level defaults to 9.
+    extract_tarball() and open_tar_stream() read all of them.
+    """
+    codec, level = parse_compression(get_compression(compression))
+
+    if codec == 'gz' or codec == 'xz':
+        kwargs = dict()
+        if level is not None:
+            kwargs['compresslevel' if codec == 'gz' else 'preset'] = level
+        with tarfile.open(name=str(result_filename), mode='w:' + codec, **kwargs) as tar:
+            yield tar
+    elif codec == 'xz-parallel':
+        with open(str(result_filename), 'wb') as f:
+            writer = _ParallelXzWriter(f, level)
+            try:
+                with tarfile.open(fileobj=writer, mode='w|') as tar:
+                    yield tar
+            finally:
+                writer.close()
     else:
-        tar_mode = 'w:xz'
+        assert codec == 'zstd'
+        cmd = ['zstd', '-q', '-T0', '-{}'.format(3 if level is None else level)]
+        if level is not None and level > 19:
+            cmd.append('--ultra')
+        with open(str(result_filename), 'wb') as f:
+            proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=f)
+            try:
+                with tarfile.open(fileobj=proc.stdin, mode='w|') as tar:
+                    yield tar
+            finally:
+                proc.stdin.close()
+                returncode = proc.wait()
+            if returncode != 0:
+                raise subprocess.CalledProcessError(returncode, cmd)
+
+
+class _ReadAheadReader:
+    """Read-only file object reading fileobj ahead on a thread.
+
+    Decompressing the data (lzma and zlib release the GIL) then overlaps with processing it.
+    """
+
+    def __init__(self, fileobj):
+        self._queue = queue.Queue(maxsize=READ_AHEAD_CHUNKS)
+        self._closed = threading.Event()
+        self._chunk = b''
+        self._pos = 0
+        self._eof = False
+        self._thread = threading.Thread(target=self._read_ahead, args=(fileobj,), daemon=True)
+        self._thread.start()
+
+    def _read_ahead(self, fileobj):
+        try:
+            while not self._closed.is_set():
+                chunk = fileobj.read(READ_AHEAD_CHUNK_SIZE)
+                self._put(chunk)
+                if not chunk:
+                    return
+        except Exception as ex:
+            # Raised to the reader.
+            self._put(ex)
+
+    def _put(self, item):
+        while not self._closed.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def read(self, size=-1):
+        parts = []
+        while size != 0:
+            if self._pos == len(self._chunk):
+                if self._eof:
+                    break
+                item = self._queue.get()
+                if isinstance(item, Exception):
+                    raise item
+                if not item:
+                    self._eof = True
+                    break
+                self._chunk, self._pos = item, 0
+            end = len(self._chunk) if size < 0 else min(len(self._chunk), self._pos + size)
+            parts.append(self._chunk[self._pos:end])
+            if size > 0:
+                size -= end - self._pos
+            self._pos = end
+        return b''.join(parts)
+
+    def close(self):
+        self._closed.set()
+        self._thread.join()
+
+
+@contextmanager
+def open_tar_stream(path, read_ahead=False):
+    """Open the tarball at path for reading its members in order, for use in a with statement.
+
+    The tarfile.TarFile is in stream mode: members must be read in order, each one's contents
+    before moving to the next. Reads every compression open_tar_writer() writes. With read_ahead
+    the tarball is decompressed on a separate thread.
+    """
+    path = str(path)
+    compression = _get_tar_compression(path)
+    if compression == 'zstd' or (compression == 'xz' and not _NATIVE_XZ_DECOMPRESSION):
+        cmd = [compression, '-q', '-d', '-c', path]
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+        try:
+            with tarfile.open(fileobj=proc.stdout, mode='r|') as tar:
+                yield tar
+        finally:
+            proc.stdout.close()
+            returncode = proc.wait()
+        # The tarball may not have been read to the end, which the command sees as a broken pipe.
+        if returncode not in (0, -signal.SIGPIPE):
+            raise subprocess.CalledProcessError(returncode, cmd)
+        return
+
+    with ExitStack() as stack:
+        # Not tarfile's own decompression: its xz stream reader stops after the first of several
+        # concatenated streams, which is what parallel xz compression writes.
+        if compression == 'xz':
+            fileobj = stack.enter_context(lzma.open(path))
+        elif compression == 'gz':
+            fileobj = stack.enter_context(gzip.open(path))
+        else:
+            fileobj = stack.enter_context(open(path, 'rb'))
+        if read_ahead:
+            fileobj = _ReadAheadReader(fileobj)
+            stack.callback(fileobj.close)
+        yield stack.enter_context(tarfile.open(fileobj=fileobj, mode='r|'))
 
-    with tarfile.open(name=str(result_filename), mode=tar_mode) as tar:
+
+def _get_member_path(target, member):
+    # The path member is extracted to in target. Members may not point outside of it.
+    name = os.path.normpath(member.name)
+    if os.path.isabs(name) or name == '..' or name.startswith('..' + os.sep):
+        raise ValidationError("Tarball member {} is outside of the extraction folder".format(member.name))
+    return name, os.path.join(target, name)
+
+
+def _get_digest_entry(kind, name, mode, data):
+    return '{} {} {:o} {}'.format(kind, name, mode, data)
+
+
+def _get_content_digest(entries):
+    return hashlib.sha256('\n'.join(sorted(entries)).encode()).hexdigest()
+
+
+def _extract_tar_stream(path, target, read_ahead):
+    # Returns the content digest of the extracted files, see get_content_digest().
+    target = os.path.realpath(target)
+    entries = []
+    file_digests = dict()
+    directories = []
+    # Folders known not to be, or to be inside, a symlink. Members inside a symlink would be
+    # extracted to wherever the symlink points.
+    safe_dirs = {target}
+    is_root = not is_windows and os.geteuid() == 0
+
+    def make_parent(dest):
+        parent = os.path.dirname(dest)
+        if parent in safe_dirs:
+            return
+        os.makedirs(parent, exist_ok=True)
+        real_parent = os.path.realpath(parent)
+        if real_parent != target and not real_parent.startswith(target + os.sep):
+            raise ValidationError("Tarball member {} is outside of the extraction folder".format(dest))
+        safe_dirs.add(parent)
+
+    with open_tar_stream(path, read_ahead) as tar:
+        for member in tar:
+            name, dest = _get_member_path(target, member)
+            if name == '.':
+                directories.append((member, target))
+                continue
+            make_parent(dest)
+            if member.isdir():
+                if not os.path.isdir(dest) or os.path.islink(dest):
+                    os.mkdir(dest)
+                safe_dirs.add(dest)
+                directories.append((member, dest))
+                continue
+
+            if os.path.lexists(dest) and not os.path.isdir(dest):
+                os.remove(dest)
+            # Whatever replaces the file, hardlinks may only be made to it again if it's a file.
+            file_digests.pop(name, None)
+            if member.isfile():
+                hasher = hashlib.sha256()
+                src = tar.extractfile(member)
+                with open(dest, 'wb') as f:
+                    while True:
+                        buf = src.read(READ_AHEAD_CHUNK_SIZE)
+                        if not buf:
+                            break
+                        f.write(buf)
+                        hasher.update(buf)
+                file_digests[name] = hasher.hexdigest()
+                entries.append(_get_digest_entry('f', name, member.mode, file_digests[name]))
+            elif member.issym():
+                os.symlink(member.linkname, dest)
+                entries.append(_get_digest_entry('l', name, 0, member.linkname))
+                continue
+            elif member.islnk():
+                link_name, link_dest = _get_member_path(target, tarfile.TarInfo(member.linkname))
+                if link_name not in file_digests or os.path.islink(link_dest):
+                    raise ValidationError("Tarball member {} links to {} which isn't a file before it".format(
+                        member.name, member.linkname))
+                os.link(link_dest, dest, follow_symlinks=False)
+                entries.append(_get_digest_entry('f', name, member.mode, file_digests[link_name]))
+                file_digests[name] = file_digests[link_name]
+            else:
+                raise ValidationError("Tarball member {} isn't a file, folder or link".format(member.name))
+
+            if is_root:
+                tar.chown(member, dest, False)
+            tar.chmod(member, dest)
+            tar.utime(member, dest)
+
+    # Set the attributes of folders last, so they may be read-only.
+    for member, dest in reversed(directories):
+        if is_root:
+            tar.chown(member, dest, False)
+        tar.chmod(member, dest)
+        tar.utime(member, dest)
+
+    return _get_content_digest(entries)
+
+
+def get_content_digest(root):
+    """Return the content digest of the files in folder root.
+
+    The digest covers the path, mode and contents of every file and the path and target of every
+    symlink, so it's the same for the files extract_tarball() extracted as the one it returned.
+    """
+    entries = []
+    for dir_path, dirs, files in os.walk(root):
+        for name in chain(dirs, files):
+            path = os.path.join(dir_path, name)
+            rel = os.path.relpath(path, root)
+            if os.path.islink(path):
+                entries.append(_get_digest_entry('l', rel, 0, os.readlink(path)))
+            elif os.path.isfile(path):
+                digest = hashlib.sha256()
+                with open(path, 'rb') as f:
+                    for buf in iter(lambda: f.read(HASH_BUFFER_SIZE), b''):
+                        digest.update(buf)
+                mode = stat.S_IMODE(os.lstat(path).st_mode)
+                entries.append(_get_digest_entry('f', rel, mode, digest.hexdigest()))
+    return _get_content_digest(entries)
+
+
+def get_tarball_content_digest(path):
+    """Return the content digest extract_tarball() would return for the tarball at path, without extracting it."""
+    entries = []
+    file_digests = dict()
+    with open_tar_stream(path) as tar:
+        for member in tar:
+            name = os.path.normpath(member.name)
+            if member.isfile():
+                hasher = hashlib.sha256()
+                src = tar.extractfile(member)
+                for buf in iter(lambda: src.read(READ_AHEAD_CHUNK_SIZE), b''):
+                    hasher.update(buf)
+                file_digests[name] = hasher.hexdigest()
+                entries.append(_get_digest_entry('f', name, member.mode, file_digests[name]))
+            elif member.issym():
+                file_digests.pop(name, None)
+                entries.append(_get_digest_entry('l', name, 0, member.linkname))
+            elif member.islnk():
+                link_name = os.path.normpath(member.linkname)
+                if link_name not in file_digests:
+                    raise ValidationError("Tarball member {} links to {} which isn't a file before it".format(
+                        member.name, member.linkname))
+                entries.append(_get_digest_entry('f', name, member.mode, file_digests[link_name]))
+                file_digests[name] = file_digests[link_name]
+    return _get_content_digest(entries)
+
+
+# Extension of the file a package's content digest is published in, next to its tarball.
+CONTENT_DIGEST_EXTENSION = '.content_digest'
+
+
+def content_digest_filename(package_filename):
+    """Return the filename the content digest of the package tarball package_filename is published in."""
+    assert package_filename.endswith('.tar.xz'), package_filename
+    return package_filename[:-len('.tar.xz')] + CONTENT_DIGEST_EXTENSION
+
+
+def write_content_digest(package_filename):
+    """Publish the content digest of the package tarball package_filename next to it and return its filename.
+
+    Nodes check packages they fetch from their peers against it, see pkgpanda.peer_fetcher().
+    """
+    filename = content_digest_filename(package_filename)
+    write_string(filename, get_tarball_content_digest(package_filename))
+    return filename
+
+
+def make_tar(result_filename, change_folder, compression=None):
+    """Make a tarball of change_folder at result_filename.
+
+    See open_tar_writer() for the supported compressions.
+    """
+    with open_tar_writer(result_filename, compression) as tar:
         tar.add(name=str(change_folder), arcname='./', filter=_tar_filter)
 
 
+def stream_tarball(folder, compresslevel=1):
+    """Yield a gzip compressed tarball of folder in chunks as it's made, like make_tar() would make it.
+
+    The tarball is written on a thread into a pipe, so only a chunk of it is in memory at a time.
+    Closing the generator early stops writing it.
+    """
+    read_fd, write_fd = os.pipe()
+    errors = []
+
+    def write():
+        try:
+            with open(write_fd, 'wb') as f, gzip.GzipFile(fileobj=f, mode='wb', compresslevel=compresslevel) as gz:
+                with tarfile.open(fileobj=gz, mode='w|') as tar:
+                    tar.add(name=str(folder), arcname='./', filter=_tar_filter)
+        except BrokenPipeError:
+            # The reader went away.
+            pass
+        except Exception as ex:
+            errors.append(ex)
+
+    thread = threading.Thread(target=write, daemon=True)
+    thread.start()
+    f = open(read_fd, 'rb')
+    try:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+            yield chunk
+    finally:
+        # Closing the pipe first makes the writer stop if the tarball wasn't read to the end.
+        f.close()
+        thread.join()
+    if errors:
+        raise errors[0]
+
+
 def rewrite_symlinks(root, old_prefix, new_prefix):
     # Find the symlinks and rewrite them from old_prefix to new_prefix
     # All symlinks not beginning with old_prefix are ignored because
@@ -513,10 +1194,13 @@ class MessageLogger:
         """
         Creates a new scope for TeamCity messages. This method is intended to be called in a ``with`` statement
 
+        The scope is also timed as a span of the ``tracer``.
+
         :param name: The name of the scope
         :param flow_id: Optional flow id that can be used if ``name`` can be non-unique
         """
         with ExitStack() as stack:
+            stack.enter_context(tracer.span(name))
             for log in self.loggers:
                 stack.enter_context(self._block(log, name, flow_id))
             yield
@@ -548,6 +1232,173 @@ class PrintLogger:
         print("completed: {}".format(name))
 
 
+class Span:
+    """A timed piece of work recorded by a Tracer. Times are from time.monotonic()."""
+
+    def __init__(self, name, category, args, parent):
+        self.name = name
+        self.category = category
+        self.args = args
+        self.parent = parent
+        self.thread_id = threading.get_ident()
+        self.thread_name = threading.current_thread().name
+        self.start = time.monotonic()
+        self.end = None
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+
+class Tracer:
+    """Records nested, timed spans of work.
+
+    Nothing is recorded until enable() is called. A span opened while another is open on the same
+    thread nests under it. Work handed to another thread should be wrapped with propagate() so its
+    spans nest under the span which handed it over.
+
+    The spans can be written out in the Chrome trace event format (see chrome://tracing) and
+    summarized as the critical path through them.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.__start = None
+        self.__spans = []
+        self.__lock = threading.Lock()
+        self.__local = threading.local()
+
+    def enable(self):
+        if not self.enabled:
+            self.__start = time.monotonic()
+            self.enabled = True
+
+    def __stack(self):
+        if not hasattr(self.__local, 'stack'):
+            self.__local.stack = []
+        return self.__local.stack
+
+    @contextmanager
+    def span(self, name, category='scope', **args):
+        """Time the body of the with statement as a span called name.
+
+        The extra keyword arguments are kept with the span and shown in the trace."""
+        if not self.enabled:
+            yield
+            return
+
+        stack = self.__stack()
+        span = Span(name, category, args, stack[-1] if stack else None)
+        stack.append(span)
+        try:
+            yield
+        except BaseException as ex:
+            span.args['error'] = type(ex).__name__
+            raise
+        finally:
+            span.end = time.monotonic()
+            stack.pop()
+            with self.__lock:
+                self.__spans.append(span)
+
+    def propagate(self, fn):
+        """Return fn wrapped so the spans it opens on any thread nest under the span open now."""
+        stack = self.__stack()
+        parent = stack[-1] if stack else None
+        if not self.enabled or parent is None:
+            return fn
+
+        def wrapper(*args, **kwargs):
+            # Thread pools reuse their threads, so put back whatever was open before.
+            previous = self.__stack()
+            self.__local.stack = [parent]
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.__local.stack = previous
+        return wrapper
+
+    def spans(self):
+        """Return the finished spans, in the order they finished."""
+        with self.__lock:
+            return list(self.__spans)
+
+    def chrome_trace(self):
+        """Return the finished spans as a Chrome trace, with one row per thread."""
+        pid = os.getpid()
+        thread_ids = {}
+        events = []
+        for span in sorted(self.spans(), key=lambda span: span.start):
+            if span.thread_id not in thread_ids:
+                thread_ids[span.thread_id] = len(thread_ids)
+                events.append({
+                    'name': 'thread_name',
+                    'ph': 'M',
+                    'pid': pid,
+                    'tid': thread_ids[span.thread_id],
+                    'args': {'name': span.thread_name}})
+            events.append({
+                'name': span.name,
+                'cat': span.category,
+                'ph': 'X',
+                'ts': round((span.start - self.__start) * 1e6),
+                'dur': round(span.duration * 1e6),
+                'pid': pid,
+                'tid': thread_ids[span.thread_id],
+                'args': span.args})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def write_chrome_trace(self, filename):
+        write_json(filename, self.chrome_trace())
+
+    def critical_path(self):
+        """Return the spans which determined how long the traced work took, as (depth, span) pairs.
+
+        Of the top level spans, the path takes the one which finished last, then the one which
+        finished last before that one started, and so on back to the first. Each span on the path is
+        then broken down the same way into the spans nested under it.
+        """
+        children = {}
+        for span in self.spans():
+            children.setdefault(span.parent, []).append(span)
+
+        path = []
+
+        def add_chain(spans, end, depth):
+            chain = []
+            # Spans may take no time at all, which leaves end where it was, so every span is taken only once.
+            remaining = list(spans)
+            while True:
+                finished = [span for span in remaining if span.end <= end]
+                if not finished:
+                    break
+                # Of spans which finished at the same time, the one recorded last is taken as the last one.
+                last = max(reversed(finished), key=lambda span: (span.end, span.start))
+                remaining.remove(last)
+                chain.append(last)
+                end = last.start
+            for span in reversed(chain):
+                path.append((depth, span))
+                add_chain(children.get(span, []), span.end, depth + 1)
+
+        add_chain(children.get(None, []), float('inf'), 0)
+        return path
+
+    def format_critical_path(self):
+        path = self.critical_path()
+        if not path:
+            return "Critical path: no spans recorded"
+
+        top_level = [span for depth, span in path if depth == 0]
+        total = top_level[-1].end - top_level[0].start
+        lines = ["Critical path ({:.3f}s):".format(total)]
+        for depth, span in path:
+            lines.append("{:>10.3f}s {:>5.1f}%  {}{}".format(
+                span.duration, 100 * span.duration / total if total else 100, '  ' * depth, span.name))
+        return '\n'.join(lines)
+
+
+tracer = Tracer()
 logger = MessageLogger()
 
 
@@ -7,6 +7,7 @@ Co-ordinates across all gen.build_deploy
 """
 
 import argparse
+import concurrent.futures
 import copy
 import importlib
 import inspect
@@ -15,6 +16,7 @@ import logging
 import os.path
 import subprocess
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from distutils.version import LooseVersion
 from typing import Optional
 
@@ -27,7 +29,15 @@ import pkgpanda.util
 import release.storage
 from gen.calc import DCOS_VERSION
 from pkgpanda.constants import DOCKERFILE_DIR
-from pkgpanda.util import is_windows, logger
+from pkgpanda.util import is_windows, logger, tracer
+
+
+# Number of uploads run at once against each storage provider.
+STORAGE_COMMAND_WORKERS = 8
+
+# Default number of core artifacts fetched at once from the preferred storage provider. Set
+# options.fetch_workers in the release config to change it.
+FETCH_ARTIFACT_WORKERS = 8
 
 
 class ConfigError(Exception):
@@ -217,7 +227,7 @@ class Repository():
                         action['args']['content_type'] = artifact['content_type']
                     return action
 
-            assert artifact.keys() <= {'reproducible_path', 'channel_path', 'content_type',
+            assert artifact.keys() <= {'reproducible_path', 'channel_path', 'content_type', 'size', 'sha256',
                                        'local_path', 'local_content', 'local_copy_from'}, artifact
 
             action_count = 0
@@ -266,6 +276,13 @@ def get_package_artifact(package_id_str):
         'local_path': 'packages/cache/' + package_filename}
 
 
+def get_content_digest_artifact(package_id_str):
+    digest_filename = pkgpanda.util.content_digest_filename(make_package_filename(package_id_str))
+    return {
+        'reproducible_path': digest_filename,
+        'local_path': 'packages/cache/' + digest_filename}
+
+
 def get_gen_package_artifact(package_id_str):
     package_filename = make_package_filename(package_id_str)
     return {
@@ -348,6 +365,7 @@ def make_stable_artifacts(cache_repository_url, tree_variants):
             return
         metadata['packages'].add(package_id)
         add_file(get_package_artifact(package_id))
+        add_file(get_content_digest_artifact(package_id))
 
     # Add the bootstrap, active.json, packages as reproducible_path artifacts
     # Add the <variant>.bootstrap.latest as a channel_path
@@ -359,12 +377,29 @@ def make_stable_artifacts(cache_repository_url, tree_variants):
         for package_id in sorted(info['packages']):
             add_package(package_id)
 
+    # Record what each artifact should contain so fetch_key_artifacts can verify downloads and
+    # reuse the ones already in packages/cache.
+    for artifact in metadata['core_artifacts']:
+        artifact['size'] = os.path.getsize(artifact['local_path'])
+        artifact['sha256'] = pkgpanda.util.sha256(artifact['local_path'])
+
     # Sets aren't json serializable, so transform to a list for future use.
     metadata['packages'] = list(sorted(metadata['packages']))
 
     return metadata
 
 
+def artifact_matches(artifact, path):
+    """Return true iff the file at path has the size and sha256 recorded for the artifact.
+
+    Artifacts from metadata that predates the recorded size and sha256 match any file."""
+    if 'size' in artifact and os.path.getsize(path) != artifact['size']:
+        return False
+    if 'sha256' in artifact and pkgpanda.util.sha256(path) != artifact['sha256']:
+        return False
+    return True
+
+
 def built_resource_to_artifacts(built_resource: dict):
     # Type switch
     if 'packages' in built_resource:
@@ -669,21 +704,123 @@ def get_storage_provider_factory(kind):
     return module.factories[name]
 
 
-def apply_storage_commands(storage_providers: dict, storage_commands: dict) -> None:
+def _plan_storage_commands(provider_name, commands, existing_paths):
+    """Split the commands of a stage into waves, each of which may run concurrently.
+
+    A copy from a path another command of the stage writes goes in a later wave than that
+    command, as does a second write to the same path, so a wave only depends on the ones before
+    it."""
+    waves = []
+    written = {}
+    for artifact in commands:
+        path = artifact['args']['destination_path']
+        # If it is only supposed to be if the artifact does not exist, skip it when it already
+        # exists or an earlier command of the stage is going to write it.
+        if artifact['if_not_exists'] and (path in existing_paths or path in written):
+            print("Store to", provider_name, "artifact", path, "skipped because it already exists")
+            continue
+
+        wave = 0
+        source_path = artifact['args'].get('source_path')
+        if source_path in written:
+            wave = written[source_path] + 1
+        if path in written:
+            wave = max(wave, written[path] + 1)
+        written[path] = wave
+
+        while len(waves) <= wave:
+            waves.append([])
+        waves[wave].append(artifact)
+    return waves
+
+
+def _apply_storage_command(provider_name, provider, exists_index, artifact):
+    path = artifact['args']['destination_path']
+    print("Store to", provider_name, "artifact", path, "by method", artifact['method'])
+    with tracer.span('{} {}'.format(artifact['method'], path), 'storage', provider=provider_name):
+        getattr(provider, artifact['method'])(**artifact['args'])
+    exists_index.add(path)
+
+
+def _apply_copies(provider_name, provider, exists_index, copies):
+    for args in copies:
+        print("Store to", provider_name, "artifact", args['destination_path'], "by method copy")
+    with tracer.span('copy {} artifacts'.format(len(copies)), 'storage', provider=provider_name):
+        provider.copy_many([(args['source_path'], args['destination_path']) for args in copies])
+    for args in copies:
+        exists_index.add(args['destination_path'])
+
+
+def _apply_provider_storage_commands(stage, provider_name, provider, commands, executor, exists_index):
+    with tracer.span('{} on {}'.format(stage, provider_name), 'storage'):
+        check_paths = {artifact['args']['destination_path'] for artifact in commands if artifact['if_not_exists']}
+        existing_paths = set()
+        if check_paths:
+            with tracer.span('Check {} artifacts exist'.format(len(check_paths)), 'storage', provider=provider_name):
+                existing_paths = exists_index.exists_many(check_paths)
+
+        for wave in _plan_storage_commands(provider_name, commands, existing_paths):
+            # Uploads go on the provider's pool. The copies are handed to the provider's copy_many
+            # in one batch, which runs them alongside the uploads.
+            copies = [artifact['args'] for artifact in wave if artifact['method'] == 'copy']
+            apply_storage_command = tracer.propagate(_apply_storage_command)
+            futures = [
+                executor.submit(apply_storage_command, provider_name, provider, exists_index, artifact)
+                for artifact in wave if artifact['method'] != 'copy']
+            try:
+                if copies:
+                    _apply_copies(provider_name, provider, exists_index, copies)
+            finally:
+                # Let every command of the wave finish before raising the first error, so nothing
+                # is still writing when the caller gives up.
+                concurrent.futures.wait(futures)
+            for future in futures:
+                future.result()
+
+
+def apply_storage_commands(
+        storage_providers: dict,
+        storage_commands: dict,
+        max_workers: int=STORAGE_COMMAND_WORKERS,
+        exists_indexes: Optional[dict]=None) -> None:
+    """Run the storage commands of both stages against every storage provider.
+
+    The providers are worked on concurrently, each running up to max_workers uploads at a time
+    while its copies go through its copy_many. All of stage1 is done on every provider before any
+    of stage2 starts.
+
+    exists_indexes maps provider names to the release.storage.ExistsIndex to check and record
+    paths in. Fresh ones are used for any provider without one."""
     assert storage_commands.keys() == {'stage1', 'stage2'}
 
-    for stage in ['stage1', 'stage2']:
-        commands = storage_commands[stage]
-        for provider_name, provider in storage_providers.items():
-            for artifact in commands:
-                path = artifact['args']['destination_path']
-                # If it is only supposed to be if the artifact does not exist, check for existence
-                # and skip if it exists.
-                if artifact['if_not_exists'] and provider.exists(path):
-                    print("Store to", provider_name, "artifact", path, "skipped because it already exists")
-                    continue
-                print("Store to", provider_name, "artifact", path, "by method", artifact['method'])
-                getattr(provider, artifact['method'])(**artifact['args'])
+    if not storage_providers:
+        return
+
+    exists_indexes = dict(exists_indexes or {})
+    for name, provider in storage_providers.items():
+        if name not in exists_indexes:
+            exists_indexes[name] = release.storage.ExistsIndex(provider)
+
+    executors = {name: ThreadPoolExecutor(max_workers=max_workers) for name in storage_providers}
+    try:
+        with ThreadPoolExecutor(max_workers=len(storage_providers)) as provider_executor:
+            for stage in ['stage1', 'stage2']:
+                futures = [
+                    provider_executor.submit(
+                        tracer.propagate(_apply_provider_storage_commands),
+                        stage,
+                        provider_name,
+                        provider,
+                        storage_commands[stage],
+                        executors[provider_name],
+                        exists_indexes[provider_name])
+                    for provider_name, provider in storage_providers.items()]
+                concurrent.futures.wait(futures)
+                for future in futures:
+                    future.result()
+    finally:
+        for executor in executors.values():
+            executor.shutdown()
 
 
 # Two stages of uploading artifacts. First puts all the artifacts into their places / uploads
@@ -719,11 +856,16 @@ class ReleaseManager():
 
             self.__storage_providers[name] = storage
 
+        # Remembers what exists in each storage provider for the rest of the run.
+        self.__exists_indexes = {
+            name: release.storage.ExistsIndex(storage) for name, storage in self.__storage_providers.items()}
+
     def __init__(self, config, noop, provider_names):
         self._setup_storage(config.get('storage', dict()))
         self.__noop = noop
         self.__config = config
         self.__provider_names = provider_names
+        self.__fetch_workers = config.get('options', dict()).get('fetch_workers', FETCH_ARTIFACT_WORKERS)
 
         preferred_name = config.get('options', dict()).get('preferred')
         if preferred_name:
@@ -738,6 +880,26 @@ class ReleaseManager():
         assert metadata['reproducible_artifact_path'][-1] != '/'
         assert metadata['repository_path'][-1] != '/'
 
+        def download(artifact, src_path, local_path):
+            # Skip artifacts already in the cache, unless they don't have the recorded contents.
+            if os.path.exists(local_path) and artifact_matches(artifact, local_path):
+                print("Using cached core artifact", local_path)
+                return
+
+            # Download beside the destination and only move into place once verified, so the
+            # cache never holds a partial or corrupt artifact.
+            local_path_tmp = local_path + '.fetch.tmp'
+            try:
+                with tracer.span('fetch {}'.format(src_path), 'fetch'):
+                    self.__preferred_provider.download(src_path, local_path_tmp)
+                if not artifact_matches(artifact, local_path_tmp):
+                    raise RuntimeError("Core artifact {} doesn't have the size and sha256 recorded in the "
+                                       "release metadata".format(src_path))
+                os.replace(local_path_tmp, local_path)
+            except Exception:
+                pkgpanda.util.if_exists(os.remove, local_path_tmp)
+                raise
+
         def fetch_artifact(artifact):
             print("Fetching core artifact if it doesn't exist: ", artifact)
             if 'channel_path' in artifact:
@@ -752,7 +914,11 @@ class ReleaseManager():
                     dest_path = 'packages/cache/complete/' + dest_path
                 else:
                     dest_path = 'packages/cache/bootstrap/' + dest_path
-                self.__preferred_provider.download(src_path, dest_path)
+                # Channel artifacts predating the recorded sha256 may be stale in the cache, so
+                # always fetch those.
+                if 'sha256' not in artifact:
+                    pkgpanda.util.if_exists(os.remove, dest_path)
+                download(artifact, src_path, dest_path)
                 artifact['local_copy_from'] = src_path
                 artifact['local_path'] = artifact['channel_path']
             if 'reproducible_path' in artifact:
@@ -762,12 +928,19 @@ class ReleaseManager():
 
                 src_path = metadata['repository_path'] + '/' + artifact['reproducible_path']
 
-                self.__preferred_provider.download_if_not_exist(src_path, local_path)
+                download(artifact, src_path, local_path)
                 artifact['local_copy_from'] = src_path
                 artifact['local_path'] = local_path
 
-        for artifact in metadata['core_artifacts']:
-            fetch_artifact(artifact)
+        # The artifacts are independent, so fetch them concurrently. Let every fetch finish before
+        # raising the first error.
+        with tracer.span('Fetching core artifacts', 'fetch'), \
+                ThreadPoolExecutor(max_workers=self.__fetch_workers) as executor:
+            fetch = tracer.propagate(fetch_artifact)
+            futures = [executor.submit(fetch, artifact) for artifact in metadata['core_artifacts']]
+            concurrent.futures.wait(futures)
+            for future in futures:
+                future.result()
 
     def promote(self, src_channel, destination_repository, destination_channel):
         metadata = self.get_metadata(src_channel)
@@ -848,7 +1021,8 @@ class ReleaseManager():
             return
 
         with logger.scope("Uploading artifacts"):
-            apply_storage_commands(self.__storage_providers, storage_commands)
+            apply_storage_commands(
+                self.__storage_providers, storage_commands, exists_indexes=self.__exists_indexes)
 
 
 _config = None
@@ -883,6 +1057,11 @@ def main():
         help="YAML configuration file",
         default="dcos-release.config.yaml")
 
+    parser.add_argument(
+        '--trace',
+        help="Time the phases of the run, write them to the given file as a Chrome trace "
+             "(chrome://tracing) and print the critical path through them at the end.")
+
     # Moves the latest of a given release name to the given release name.
     promote = subparsers.add_parser('promote')
     promote.set_defaults(action='promote')
@@ -944,16 +1123,28 @@ def main():
     if options.local:
         provider_names = ['bash']
 
-    release_manager = ReleaseManager(config, options.noop, provider_names)
-    if options.action == 'promote':
-        release_manager.promote(options.source_channel, options.destination_repository, options.destination_channel)
-    elif options.action == 'create':
-        variants = [None if variant == "default" else variant for variant in options.tree_variant]
-        release_manager.create('testing', options.channel, options.tag, variants)
-    elif options.action == 'create-installer':
-        release_manager.create_installer(options.src_channel)
-    else:
-        raise ValueError("Unexpection options.action {}".format(options.action))
+    if options.trace:
+        tracer.enable()
+
+    try:
+        with tracer.span(options.action, 'release'):
+            release_manager = ReleaseManager(config, options.noop, provider_names)
+            if options.action == 'promote':
+                release_manager.promote(
+                    options.source_channel, options.destination_repository, options.destination_channel)
+            elif options.action == 'create':
+                variants = [None if variant == "default" else variant for variant in options.tree_variant]
+                release_manager.create('testing', options.channel, options.tag, variants)
+            elif options.action == 'create-installer':
+                release_manager.create_installer(options.src_channel)
+            else:
+                raise ValueError("Unexpection options.action {}".format(options.action))
+    finally:
+        # Written for failed runs too, they're often the ones worth looking at.
+        if options.trace:
+            tracer.write_chrome_trace(options.trace)
+            print("Wrote trace to", options.trace)
+            print(tracer.format_critical_path())
 
 
 if __name__ == '__main__':
@@ -1,13 +1,31 @@
 import abc
+import concurrent.futures
 import os.path
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from pkgpanda.util import make_directory
 
 
+# Number of existence checks / listings a storage provider runs at once in exists_many.
+EXISTS_MANY_WORKERS = 8
+
+# Number of copies a storage provider runs at once in copy_many.
+COPY_MANY_WORKERS = 8
+
+
 class UnsupportedOperation(RuntimeError):
     pass
 
 
+def group_by_folder(paths):
+    """Return a dictionary from folder to the set of the given paths directly inside it."""
+    folders = {}
+    for path in paths:
+        folders.setdefault(os.path.dirname(path), set()).add(path)
+    return folders
+
+
 class AbstractStorageProvider(metaclass=abc.ABCMeta):
 
     @abc.abstractmethod
@@ -17,6 +35,17 @@ class AbstractStorageProvider(metaclass=abc.ABCMeta):
         """Copy the file and all metadata from destination_path to source_path."""
         pass
 
+    def copy_many(self, copies):
+        """Copy each of the given (source_path, destination_path) pairs as copy() does.
+
+        The copies must be independent of each other, they're run concurrently."""
+        with ThreadPoolExecutor(max_workers=COPY_MANY_WORKERS) as executor:
+            futures = [executor.submit(self.copy, source_path, destination_path)
+                       for source_path, destination_path in copies]
+            concurrent.futures.wait(futures)
+            for future in futures:
+                future.result()
+
     @abc.abstractmethod
     def upload(self,
                destination_path,
@@ -49,6 +78,22 @@ class AbstractStorageProvider(metaclass=abc.ABCMeta):
         """Return true iff the given file / path exists."""
         pass
 
+    def exists_many(self, paths):
+        """Return the subset of the given paths which exist.
+
+        The default lists each folder holding several of the paths once rather than checking every
+        path. Providers should override this with whatever bulk query they support."""
+        existing = set()
+        for folder, folder_paths in group_by_folder(paths).items():
+            if len(folder_paths) > 1:
+                try:
+                    existing |= folder_paths & self.list_recursive(folder)
+                    continue
+                except (NotImplementedError, UnsupportedOperation):
+                    pass
+            existing |= {path for path in folder_paths if self.exists(path)}
+        return existing
+
     @abc.abstractmethod
     def fetch(self, path):
         """Download the given file and return bytes. Do not use on large files.
@@ -97,6 +142,9 @@ class ReadOnlyProxy(AbstractStorageProvider):
              destination_path):
         raise UnsupportedOperation("copy on read-only storage")
 
+    def copy_many(self, copies):
+        raise UnsupportedOperation("copy_many on read-only storage")
+
     def upload(self,
                destination_path,
                blob=None,
@@ -111,6 +159,9 @@ class ReadOnlyProxy(AbstractStorageProvider):
     def exists(self, path):
         return self._storage_provider.exists(path)
 
+    def exists_many(self, paths):
+        return self._storage_provider.exists_many(paths)
+
     def fetch(self, path):
         return self._storage_provider.fetch(path)
 
@@ -126,3 +177,34 @@ class ReadOnlyProxy(AbstractStorageProvider):
     @property
     def read_only(self):
         return True
+
+
+class ExistsIndex():
+    """Memoised answers to whether paths exist in a storage provider.
+
+    Meant to live for a single release run, during which nothing but the run itself writes to the
+    storage provider. Paths the run writes should be recorded with add()."""
+
+    def __init__(self, storage_provider: AbstractStorageProvider):
+        self._storage_provider = storage_provider
+        self.__known = {}
+        self.__lock = threading.Lock()
+
+    def exists_many(self, paths):
+        paths = set(paths)
+        with self.__lock:
+            unknown = paths - self.__known.keys()
+        if unknown:
+            existing = self._storage_provider.exists_many(unknown)
+            with self.__lock:
+                for path in unknown:
+                    self.__known.setdefault(path, path in existing)
+        with self.__lock:
+            return {path for path in paths if self.__known[path]}
+
+    def exists(self, path):
+        return path in self.exists_many({path})
+
+    def add(self, path):
+        with self.__lock:
+            self.__known[path] = True
@@ -1,9 +1,22 @@
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional
 
 import boto3
 import botocore
+from boto3.s3.transfer import TransferConfig
 
-from release.storage import AbstractStorageProvider
+from release.storage import AbstractStorageProvider, EXISTS_MANY_WORKERS, group_by_folder
+
+# Objects at least this large are uploaded and copied in parts of this size, several parts at a
+# time. S3 requires parts of at least 5 MiB.
+MULTIPART_THRESHOLD = 64 * 1024 * 1024
+MULTIPART_CONCURRENCY = 8
+
+# The metadata a multipart copy has to carry over from the source object itself.
+COPIED_METADATA = ['CacheControl', 'ContentDisposition', 'ContentEncoding', 'ContentLanguage', 'ContentType',
+                   'Metadata']
 
 
 def get_aws_session(access_key_id, secret_access_key, region_name=None):
@@ -31,18 +44,29 @@ class S3StorageProvider(AbstractStorageProvider):
     name = 'aws'
 
     def __init__(self, bucket, object_prefix, download_url,
-                 access_key_id=None, secret_access_key=None, region_name=None):
+                 access_key_id=None, secret_access_key=None, region_name=None, endpoint_url=None,
+                 multipart_threshold=MULTIPART_THRESHOLD):
         """ If access_key_id and secret_acccess_key are unset, boto3 will
         try to authenticate by other methods. See here for other credential options:
         http://boto3.readthedocs.io/en/latest/guide/configuration.html#configuring-credentials
+
+        endpoint_url points the provider at an S3 compatible service other than AWS, such as a
+        local one for testing.
         """
         if object_prefix is not None:
             assert object_prefix and not object_prefix.startswith('/') and not object_prefix.endswith('/')
 
         self.__session = get_aws_session(access_key_id, secret_access_key, region_name)
-        self.__bucket = self.__session.resource('s3').Bucket(bucket)
+        self.__bucket = self.__session.resource('s3', endpoint_url=endpoint_url).Bucket(bucket)
         self.__object_prefix = object_prefix
         self.__url = download_url
+        self.__transfer_config = TransferConfig(
+            multipart_threshold=multipart_threshold,
+            multipart_chunksize=multipart_threshold,
+            max_concurrency=MULTIPART_CONCURRENCY)
+        # Sizes of the objects this provider uploaded, copied or listed, by path, so copy() doesn't
+        # have to look them up.
+        self.__sizes = {}
 
     @property
     def object_prefix(self):
@@ -76,11 +100,27 @@ class S3StorageProvider(AbstractStorageProvider):
         return self.__url
 
     def copy(self, source_path, destination_path):
-        src_object = self.get_object(source_path)
-        new_object = self.get_object(destination_path)
-        old_path = src_object.bucket_name + '/' + src_object.key
-
-        new_object.copy_from(CopySource=old_path)
+        client = self.__bucket.meta.client
+        copy_source = {'Bucket': self.__bucket.name, 'Key': self.get_object(source_path).key}
+        destination_key = self.get_object(destination_path).key
+
+        # A single CopyObject carries the metadata along, but only works up to 5 GB. Larger objects
+        # are copied in parts, which needs the metadata passed explicitly. The source is only looked
+        # up when its size isn't known, or for that metadata.
+        size = self.__sizes.get(source_path)
+        head = None
+        if size is None:
+            head = client.head_object(**copy_source)
+            size = head['ContentLength']
+        if size < self.__transfer_config.multipart_threshold:
+            client.copy_object(CopySource=copy_source, Bucket=self.__bucket.name, Key=destination_key)
+        else:
+            if head is None:
+                head = client.head_object(**copy_source)
+            extra_args = {name: head[name] for name in COPIED_METADATA if name in head}
+            client.copy(copy_source, self.__bucket.name, destination_key, ExtraArgs=extra_args,
+                        Config=self.__transfer_config)
+        self.__sizes[destination_path] = size
 
     def upload(self,
                destination_path: str,
@@ -96,21 +136,54 @@ class S3StorageProvider(AbstractStorageProvider):
 
         s3_object = self.get_object(destination_path)
 
+        # Large artifacts (bootstraps, installers) go up in parts, several at a time.
         assert local_path is None or blob is None
         if local_path:
-            with open(local_path, 'rb') as data:
-                s3_object.put(Body=data, **extra_args)
+            size = os.path.getsize(local_path)
+            s3_object.upload_file(local_path, ExtraArgs=extra_args, Config=self.__transfer_config)
         else:
             assert isinstance(blob, bytes)
-            s3_object.put(Body=blob, **extra_args)
+            size = len(blob)
+            s3_object.upload_fileobj(io.BytesIO(blob), ExtraArgs=extra_args, Config=self.__transfer_config)
+        self.__sizes[destination_path] = size
 
     def exists(self, path):
+        s3_object = self.get_object(path)
         try:
-            self.get_object(path).load()
+            s3_object.load()
+            self.__sizes[path] = s3_object.content_length
             return True
         except botocore.client.ClientError:
             return False
 
+    def _list_folder(self, folder):
+        """Return the names of the objects directly inside the given folder.
+
+        Uses the client rather than the bucket resource since it is safe to share between threads."""
+        prefix = self._get_path(folder + '/') if folder else self.object_prefix
+        prefix_len = len(self.object_prefix)
+        client = self.__bucket.meta.client
+        names = set()
+        for page in client.get_paginator('list_objects_v2').paginate(
+                Bucket=self.__bucket.name, Prefix=prefix, Delimiter='/'):
+            for summary in page.get('Contents', []):
+                name = summary['Key'][prefix_len:]
+                names.add(name)
+                self.__sizes[name] = summary['Size']
+        return names
+
+    def exists_many(self, paths):
+        # List each folder without descending into its subfolders, so a folder with many objects
+        # costs a request per thousand keys instead of one per path, and a folder with few costs
+        # the same as a HEAD.
+        folders = group_by_folder(paths)
+        existing = set()
+        with ThreadPoolExecutor(max_workers=EXISTS_MANY_WORKERS) as executor:
+            listings = executor.map(self._list_folder, folders.keys())
+            for folder_paths, names in zip(folders.values(), listings):
+                existing |= folder_paths & names
+        return existing
+
     def list_recursive(self, path):
         prefix_len = len(self.object_prefix)
         names = set()
@@ -127,8 +200,10 @@ class S3StorageProvider(AbstractStorageProvider):
         return names
 
     def remove_recursive(self, path):
+        prefix_len = len(self.object_prefix)
         for obj in self._get_objects_with_prefix(path):
             obj.delete()
+            self.__sizes.pop(obj.key[prefix_len:], None)
 
 
 factories = {
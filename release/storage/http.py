@@ -1,8 +1,9 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
 
-from release.storage import AbstractStorageProvider
+from release.storage import AbstractStorageProvider, EXISTS_MANY_WORKERS
 
 
 class HttpStorageProvider(AbstractStorageProvider):
@@ -46,13 +47,21 @@ class HttpStorageProvider(AbstractStorageProvider):
                 pass
             raise
 
-    def exists(self, path):
+    def exists(self, path, session=requests):
         url = self._get_absolute(path)
 
         # TODO(cmaloney): 200 is overly restrictive here... After hitting more
         # webservers expand to include other common / valid status codes that
         # indicate resource is found / exists.
-        return requests.head(url=url).status_code == 200
+        return session.head(url=url).status_code == 200
+
+    def exists_many(self, paths):
+        # There's no listing over plain http, so HEAD each path, concurrently and over pooled
+        # connections.
+        paths = list(paths)
+        with requests.Session() as session, ThreadPoolExecutor(max_workers=EXISTS_MANY_WORKERS) as executor:
+            found = executor.map(lambda path: self.exists(path, session), paths)
+            return {path for path, exists in zip(paths, found) if exists}
 
     def fetch(self, path):
         r = requests.get(url=self._get_absolute(path))
@@ -58,6 +58,10 @@ class LocalStorageProvider(AbstractStorageProvider):
         assert not is_absolute_path(path)
         return os.path.exists(self.__full_path(path))
 
+    def exists_many(self, paths):
+        # A stat per path is cheaper than walking the folders.
+        return {path for path in paths if self.exists(path)}
+
     def remove_recursive(self, path):
         full_path = self.__full_path(path)
 
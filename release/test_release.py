@@ -1,16 +1,22 @@
 import copy
+import hashlib
+import http.server
 import logging
 import os
 import subprocess
+import threading
 import uuid
 
 import boto3
 import pytest
 
+import pkgpanda.util
 import release
 import release.storage.aws
+import release.storage.http
+import release.storage.local
 from pkgpanda.build import BuildError
-from pkgpanda.util import is_windows, make_directory, variant_prefix, write_json, write_string
+from pkgpanda.util import is_windows, make_directory, sha256, variant_prefix, write_json, write_string
 from . import load_provider_names
 
 
@@ -171,6 +177,32 @@ def exercise_storage_provider(tmpdir, name, config):
         store.copy(upload_file_path, copy_dest_path)
         check_file(copy_dest_path, upload_file)
 
+        # Test uploading a file large enough to go up in parts where the provider does that.
+        upload_large = make_content("upload_large") * (6 * 1024 * 1024 // 45 + 1)
+        upload_large_path = get_path('upload_large.txt')
+        upload_large_local = tmpdir.join('upload_large.txt')
+        upload_large_local.write(upload_large, mode='wb')
+        store.upload(
+            upload_large_path,
+            local_path=str(upload_large_local),
+            **upload_extra_args)
+        check_file(upload_large_path, upload_large)
+
+        # Test copying several files at once.
+        store.copy_many([
+            (upload_large_path, get_path('copy_many/large.txt')),
+            (upload_bytes_path, get_path('copy_many/bytes.txt'))])
+        check_file(get_path('copy_many/large.txt'), upload_large)
+        check_file(get_path('copy_many/bytes.txt'), upload_bytes)
+
+        assert store.exists_many({
+            upload_bytes_path,
+            upload_file_path,
+            upload_bytes_dir_path,
+            get_path('missing.txt'),
+            get_path('missing_dir/missing.txt')
+        }) == {upload_bytes_path, upload_file_path, upload_bytes_dir_path}
+
         # Check that listing all the files in the storage provider gives the list of
         # files we've uploaded / checked and only that list of files.
         assert store.list_recursive(test_base_path) == {
@@ -178,7 +210,10 @@ def exercise_storage_provider(tmpdir, name, config):
             get_path('upload_bytes.txt'),
             get_path('dir1/bar/upload_bytes2.txt'),
             get_path('new_dir/copy_path.txt'),
-            get_path('copy_file.txt')
+            get_path('copy_file.txt'),
+            get_path('upload_large.txt'),
+            get_path('copy_many/large.txt'),
+            get_path('copy_many/bytes.txt')
         }
 
         # Check that cleanup removes everything
@@ -198,14 +233,17 @@ def test_storage_provider_azure(release_config_azure, tmpdir):
 # TODO(cmaloney): Add skipping when not run under CI with the environment variables
 # So devs without the variables don't see expected failures https://pytest.org/latest/skipping.html
 def test_storage_provider_aws(release_config_aws, tmpdir):
-    s3 = boto3.session.Session().resource('s3')
+    # Set testing.aws.endpoint_url to run against a local S3 compatible service instead of AWS.
+    s3 = boto3.session.Session().resource('s3', endpoint_url=release_config_aws.get('endpoint_url'))
     bucket = release_config_aws['bucket']
     s3_bucket = s3.Bucket(bucket)
     assert s3_bucket in s3.buckets.all(), (
         "Bucket '{}' must exist with full write access to AWS testing account and created objects must be globally "
         "downloadable from: {}").format(bucket, release_config_aws['download_url'])
 
-    exercise_storage_provider(tmpdir, 'aws_s3', release_config_aws)
+    # Use the smallest part size S3 allows so the large upload and copy go in parts.
+    config = dict(release_config_aws, multipart_threshold=5 * 1024 * 1024)
+    exercise_storage_provider(tmpdir, 'aws_s3', config)
 
 
 # TODO: DCOS_OSS-3460 - muted Windows tests requiring investigation
@@ -216,6 +254,90 @@ def test_storage_provider_local(tmpdir):
     exercise_storage_provider(work_dir, 'local_path', {'path': str(repo_dir)})
 
 
+def test_storage_provider_http_exists_many(monkeypatch, tmpdir):
+    tmpdir.join('stable/1.txt').write('1', ensure=True)
+    tmpdir.join('stable/packages/2.txt').write('2', ensure=True)
+
+    # SimpleHTTPRequestHandler serves the working directory.
+    monkeypatch.chdir(tmpdir)
+    server = http.server.HTTPServer(('127.0.0.1', 0), http.server.SimpleHTTPRequestHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        store = release.storage.http.HttpStorageProvider('http://127.0.0.1:{}'.format(server.server_port))
+        assert store.exists_many(['stable/1.txt', 'stable/packages/2.txt', 'stable/3.txt']) == {
+            'stable/1.txt', 'stable/packages/2.txt'}
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+class CountingStorageProvider(release.storage.local.LocalStorageProvider):
+    # Check existence the way providers without a bulk query do.
+    exists_many = release.storage.AbstractStorageProvider.exists_many
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.calls = []
+
+    def exists(self, path):
+        self.calls.append(('exists', path))
+        return super().exists(path)
+
+    def list_recursive(self, path):
+        self.calls.append(('list_recursive', path))
+        return super().list_recursive(path)
+
+
+def test_apply_storage_commands(tmpdir):
+    stores = {name: CountingStorageProvider(str(tmpdir.mkdir(name))) for name in ['a', 'b']}
+    tmpdir.join('a/stable/1.txt').write('old', ensure=True)
+
+    def upload(path, blob, if_not_exists):
+        return {'method': 'upload', 'if_not_exists': if_not_exists,
+                'args': {'destination_path': path, 'blob': blob}}
+
+    def copy(source_path, destination_path):
+        return {'method': 'copy', 'if_not_exists': False,
+                'args': {'source_path': source_path, 'destination_path': destination_path}}
+
+    storage_commands = {
+        'stage1': [
+            upload('stable/1.txt', b'1', True),
+            upload('stable/2.txt', b'2', True),
+            # Depends on the upload before it in the same stage.
+            copy('stable/2.txt', 'stable/commit/2.txt'),
+            upload('stable/packages/3.txt', b'3', True),
+            # Skipped since the stage already writes it.
+            upload('stable/2.txt', b'other', True)],
+        # Depends on stage1 being complete on every provider.
+        'stage2': [copy('stable/commit/2.txt', 'stable/latest.txt')]}
+    exists_indexes = {name: release.storage.ExistsIndex(store) for name, store in stores.items()}
+    release.apply_storage_commands(stores, storage_commands, exists_indexes=exists_indexes)
+
+    assert stores['a'].fetch('stable/1.txt') == b'old'
+    for store in stores.values():
+        assert store.fetch('stable/2.txt') == b'2'
+        assert store.fetch('stable/commit/2.txt') == b'2'
+        assert store.fetch('stable/packages/3.txt') == b'3'
+        assert store.fetch('stable/latest.txt') == b'2'
+        # The folder with several candidates is listed once, the lone one is checked directly.
+        assert sorted(store.calls) == [('exists', 'stable/packages/3.txt'), ('list_recursive', 'stable')]
+
+    # Running again in the same run skips everything without asking the providers.
+    release.apply_storage_commands(stores, storage_commands, exists_indexes=exists_indexes)
+    for store in stores.values():
+        assert len(store.calls) == 2
+
+    # A failing stage1 command stops stage2 from running.
+    with pytest.raises(subprocess.CalledProcessError):
+        release.apply_storage_commands(stores, {
+            'stage1': [copy('stable/missing.txt', 'stable/4.txt')],
+            'stage2': [copy('stable/2.txt', 'stable/5.txt')]})
+    for store in stores.values():
+        assert not store.exists('stable/5.txt')
+
+
 copy_make_commands_result = {'stage1': [
     {
         'if_not_exists': True,
@@ -440,16 +562,32 @@ def test_get_package_artifact(tmpdir):
     }
 
 
+def test_get_content_digest_artifact(tmpdir):
+    assert release.get_content_digest_artifact('foo--test') == {
+        'reproducible_path': 'packages/foo/foo--test.content_digest',
+        'local_path': 'packages/cache/packages/foo/foo--test.content_digest'
+    }
+
+
 def mock_do_build_packages(cache_repository_url, tree_variants):
     make_directory('packages/cache/bootstrap')
     write_string("packages/cache/bootstrap/bootstrap_id.bootstrap.tar.xz", "bootstrap_contents")
     write_json("packages/cache/bootstrap/bootstrap_id.active.json", ['a--b', 'c--d'])
     write_string("packages/cache/bootstrap/bootstrap.latest", "bootstrap_id")
     write_string("packages/cache/bootstrap/installer.bootstrap.latest", "installer_bootstrap_id")
+    write_string("packages/cache/bootstrap/installer_bootstrap_id.bootstrap.tar.xz", "installer_bootstrap_contents")
     write_json("packages/cache/bootstrap/installer_bootstrap_id.active.json", ['c--d', 'e--f'])
     write_string("packages/cache/bootstrap/downstream.installer.bootstrap.latest", "downstream_installer_bootstrap_id")
+    write_string(
+        "packages/cache/bootstrap/downstream_installer_bootstrap_id.bootstrap.tar.xz",
+        "downstream_installer_bootstrap_contents")
     write_json("packages/cache/bootstrap/downstream_installer_bootstrap_id.active.json", [])
 
+    for package_id in ['a--b', 'c--d', 'e--f']:
+        make_directory('packages/cache/packages/' + package_id[0])
+        write_string('packages/cache/packages/{}/{}.tar.xz'.format(package_id[0], package_id), package_id)
+        write_string('packages/cache/packages/{}/{}.content_digest'.format(package_id[0], package_id), package_id)
+
     make_directory('packages/cache/complete')
     write_json(
         "packages/cache/complete/complete.latest.json",
@@ -481,8 +619,12 @@ stable_artifacts_metadata = {
          'channel_path': 'complete.latest.json'},
         {'local_path': 'packages/cache/packages/a/a--b.tar.xz',
             'reproducible_path': 'packages/a/a--b.tar.xz'},
+        {'local_path': 'packages/cache/packages/a/a--b.content_digest',
+            'reproducible_path': 'packages/a/a--b.content_digest'},
         {'local_path': 'packages/cache/packages/c/c--d.tar.xz',
             'reproducible_path': 'packages/c/c--d.tar.xz'},
+        {'local_path': 'packages/cache/packages/c/c--d.content_digest',
+            'reproducible_path': 'packages/c/c--d.content_digest'},
         {'local_path': 'packages/cache/bootstrap/downstream_installer_bootstrap_id.bootstrap.tar.xz',
          'reproducible_path': 'bootstrap/downstream_installer_bootstrap_id.bootstrap.tar.xz'},
         {'local_path': 'packages/cache/bootstrap/downstream_installer_bootstrap_id.active.json',
@@ -501,6 +643,8 @@ stable_artifacts_metadata = {
          'channel_path': 'installer.complete.latest.json'},
         {'local_path': 'packages/cache/packages/e/e--f.tar.xz',
             'reproducible_path': 'packages/e/e--f.tar.xz'},
+        {'local_path': 'packages/cache/packages/e/e--f.content_digest',
+            'reproducible_path': 'packages/e/e--f.content_digest'},
     ],
     'packages': ['a--b', 'c--d', 'e--f'],
     'bootstrap_dict': {None: "bootstrap_id"},
@@ -531,6 +675,28 @@ def mock_failed_build_packages(cache_repository_url, tree_variants):
     raise BuildError('This build failed!')
 
 
+def test_apply_storage_commands_trace(monkeypatch, tmpdir):
+    tracer = pkgpanda.util.Tracer()
+    tracer.enable()
+    monkeypatch.setattr(release, 'tracer', tracer)
+
+    store = release.storage.local.LocalStorageProvider(str(tmpdir))
+    release.apply_storage_commands({'local': store}, {
+        'stage1': [
+            {'method': 'upload', 'if_not_exists': True, 'args': {'destination_path': 'stable/1.txt', 'blob': b'1'}}],
+        'stage2': [
+            {'method': 'copy', 'if_not_exists': False,
+             'args': {'source_path': 'stable/1.txt', 'destination_path': 'stable/latest.txt'}}]})
+
+    # The commands run on the provider's pool still nest under their stage.
+    assert [(depth, span.name) for depth, span in tracer.critical_path()] == [
+        (0, 'stage1 on local'),
+        (1, 'Check 1 artifacts exist'),
+        (1, 'upload stable/1.txt'),
+        (0, 'stage2 on local'),
+        (1, 'copy 1 artifacts')]
+
+
 # TODO(cmaloney): Add test for do_build_packages returning multiple bootstraps
 # containing overlapping
 def test_make_stable_artifacts(monkeypatch, tmpdir):
@@ -539,7 +705,15 @@ def test_make_stable_artifacts(monkeypatch, tmpdir):
 
     with tmpdir.as_cwd():
         metadata = release.make_stable_artifacts("http://test", [None])
-        assert metadata == stable_artifacts_metadata
+
+        # Every core artifact records the size and sha256 of its contents.
+        expected_metadata = copy.deepcopy(stable_artifacts_metadata)
+        for artifact in expected_metadata['core_artifacts']:
+            artifact['size'] = os.path.getsize(artifact['local_path'])
+            artifact['sha256'] = sha256(artifact['local_path'])
+        assert metadata == expected_metadata
+        assert metadata['core_artifacts'][0]['size'] == len('bootstrap_contents')
+        assert metadata['core_artifacts'][0]['sha256'] == hashlib.sha256(b'bootstrap_contents').hexdigest()
 
     # Check that a BuildError is propogated
     monkeypatch.setattr("release.do_build_packages", mock_failed_build_packages)
@@ -547,6 +721,52 @@ def test_make_stable_artifacts(monkeypatch, tmpdir):
         release.make_stable_artifacts("http://test", [None])
 
 
+def test_fetch_key_artifacts(tmpdir):
+    repository = tmpdir.join('repository')
+    manager = release.ReleaseManager({
+        'storage': {'local': {'kind': 'local_path', 'path': str(repository)}},
+        'options': {'preferred': 'local', 'fetch_workers': 2}}, False, [])
+
+    def add_artifact(path, contents, recorded_contents=None):
+        repository.join('stable', path).write(contents, ensure=True)
+        recorded_contents = contents if recorded_contents is None else recorded_contents
+        return {
+            'reproducible_path': path,
+            'size': len(recorded_contents),
+            'sha256': hashlib.sha256(recorded_contents.encode()).hexdigest()}
+
+    def make_metadata(core_artifacts):
+        return {
+            'reproducible_artifact_path': 'stable/commit/abc',
+            'repository_path': 'stable',
+            'core_artifacts': core_artifacts}
+
+    with tmpdir.as_cwd():
+        cached = add_artifact('packages/a/a--b.tar.xz', 'a--b')
+        tmpdir.join('packages/cache/packages/a/a--b.tar.xz').write('a--b', ensure=True)
+        stale = add_artifact('packages/c/c--d.tar.xz', 'c--d')
+        tmpdir.join('packages/cache/packages/c/c--d.tar.xz').write('stale', ensure=True)
+        missing = add_artifact('packages/e/e--f.tar.xz', 'e--f')
+        # Metadata from before the sizes and hashes were recorded.
+        unrecorded = {'reproducible_path': 'packages/g/g--h.tar.xz'}
+        repository.join('stable/packages/g/g--h.tar.xz').write('g--h', ensure=True)
+
+        # The cached copy matching the metadata isn't fetched again.
+        repository.join('stable/packages/a/a--b.tar.xz').remove()
+
+        metadata = make_metadata([cached, stale, missing, unrecorded])
+        manager.fetch_key_artifacts(metadata)
+        for artifact, contents in zip(metadata['core_artifacts'], ['a--b', 'c--d', 'e--f', 'g--h']):
+            assert tmpdir.join(artifact['local_path']).read() == contents
+            assert artifact['local_copy_from'] == 'stable/' + artifact['reproducible_path']
+
+        # A download that doesn't match the metadata is rejected and not left in the cache.
+        corrupt = add_artifact('packages/i/i--j.tar.xz', 'corrupt', 'i--j')
+        with pytest.raises(RuntimeError):
+            manager.fetch_key_artifacts(make_metadata([corrupt]))
+        assert tmpdir.join('packages/cache/packages/i').listdir() == []
+
+
 # NOTE: Implicitly tests all gen.build_deploy do_create functions since it calls them.
 # TODO(cmaloney): Test make_channel_artifacts, module do_create functions
 def mock_make_installer_docker(variant, bootstrap_id, installer_bootstrap_id):